@@ -0,0 +1,266 @@
+#! /usr/bin/env python3.6
+
+import sqlite3, subprocess, threading, time, sys, argparse, json
+from shared_functions import dataset_path
+
+CATALOG_FILE_NAME = "catalog.db" #Stored in the mount point of the root dataset of each backup job
+USABLE_STATUSES = ("successful", "unknown") #Backups that can be used as a base for diff and inc backups
+
+class BackupCatalog:
+    """
+    SQLite catalog of every backup in a backup job. Each row is one backup dataset,
+    with its type, timestamp, the snapshot it was cloned from, its status, size, verification
+    and the replica it was replicated to.
+    The catalog is kept up to date by the executor, so looking up the last backup
+    is an index lookup instead of a 'zfs list' of the whole job. If the catalog is
+    lost it can be rebuilt from ZFS with rebuild_from_zfs.
+
+    Parameters
+    ----------
+    root_dataset_name :     ZFS name of the root dataset of the backup job. Example: 'backup/job1'
+    path :                  Path to the catalog file. Defaults to catalog.db in the root dataset
+
+    """
+
+    def __init__(self, root_dataset_name, path=None):
+        self.root_dataset_name = root_dataset_name
+        self.path = path or dataset_path(root_dataset_name)+"/"+CATALOG_FILE_NAME
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS backups (
+                dataset TEXT PRIMARY KEY,
+                backup_type TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                parent_snapshot TEXT,
+                status TEXT NOT NULL,
+                used_bytes INTEGER,
+                updated REAL NOT NULL,
+                verification TEXT,
+                replicated_to TEXT,
+                replicated REAL)""")
+            #Catalogs from before verification and replication were added lack their columns
+            columns = [column[1] for column in self.connection.execute("PRAGMA table_info(backups)")]
+            for (column, column_type) in (("verification", "TEXT"), ("replicated_to", "TEXT"), ("replicated", "REAL")):
+                if column not in columns:
+                    self.connection.execute("ALTER TABLE backups ADD COLUMN "+column+" "+column_type)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS backups_by_time ON backups (timestamp)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS backups_by_type ON backups (backup_type, timestamp)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS backups_by_parent ON backups (parent_snapshot)")
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+    def _execute(self, statement, parameters=()):
+        with self._lock, self.connection:
+            return self.connection.execute(statement, parameters).fetchall()
+
+    def add_backup(self, dataset, backup_type, timestamp, parent_snapshot=None, status="running"):
+        """
+        Records a new backup dataset. An existing row for the dataset is replaced.
+
+        Parameters
+        ----------
+        dataset :           ZFS name of the backup dataset
+        backup_type :       'full', 'diff' or 'inc'
+        timestamp :         Timestamp of the backup, as used in the dataset name
+        parent_snapshot :   The snapshot the dataset was cloned from, or None for a full backup
+        status :            Status of the backup: 'running', 'successful', 'failed' or 'unknown'
+
+        """
+        self._execute("INSERT OR REPLACE INTO backups (dataset, backup_type, timestamp, parent_snapshot, status, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                      (dataset, backup_type, timestamp, parent_snapshot, status, time.time()))
+
+    def set_status(self, dataset, status, used_bytes=None):
+        """
+        Updates the status, and if given the size, of a backup dataset
+
+        """
+        if used_bytes is None:
+            self._execute("UPDATE backups SET status = ?, updated = ? WHERE dataset = ?", (status, time.time(), dataset))
+        else:
+            self._execute("UPDATE backups SET status = ?, used_bytes = ?, updated = ? WHERE dataset = ?", (status, used_bytes, time.time(), dataset))
+
+    def set_verification(self, dataset, verification):
+        """
+        Stores the results of the verification of a backup dataset
+
+        Parameters
+        ----------
+        dataset :       ZFS name of the backup dataset
+        verification :  Dictionary with the result of the verification of each volume, stored as JSON
+
+        """
+        self._execute("UPDATE backups SET verification = ?, updated = ? WHERE dataset = ?", (json.dumps(verification, sort_keys=True), time.time(), dataset))
+
+    def set_replicated(self, dataset, target):
+        """
+        Records that a backup dataset has been replicated to a target, see replication.py
+
+        Parameters
+        ----------
+        dataset :   ZFS name of the backup dataset
+        target :    The target it was replicated to, like 'offsite.example.com:tank/zfsync'
+
+        """
+        self._execute("UPDATE backups SET replicated_to = ?, replicated = ?, updated = ? WHERE dataset = ?", (target, time.time(), time.time(), dataset))
+
+    def unreplicated(self, target, statuses=USABLE_STATUSES):
+        """
+        Returns the backups that have not been replicated to a target yet, oldest first,
+        as a list of dictionaries. Only backups with one of the statuses are returned.
+
+        """
+        rows = self._execute("SELECT * FROM backups WHERE (replicated_to IS NULL OR replicated_to != ?) AND status IN (" + ",".join("?" * len(statuses)) + ") ORDER BY timestamp",
+                             [target] + list(statuses))
+        return [dict(row) for row in rows]
+
+    def last_replicated(self, target):
+        """
+        Returns the newest backup that has been replicated to a target as a dictionary, or None
+
+        """
+        rows = self._execute("SELECT * FROM backups WHERE replicated_to = ? ORDER BY timestamp DESC LIMIT 1", (target,))
+        return dict(rows[0]) if rows else None
+
+    def set_parent_snapshot(self, dataset, parent_snapshot):
+        """
+        Updates the snapshot a backup dataset is cloned from, like after a 'zfs promote'
+
+        """
+        self._execute("UPDATE backups SET parent_snapshot = ?, updated = ? WHERE dataset = ?", (parent_snapshot, time.time(), dataset))
+
+    def remove_backup(self, dataset):
+        """
+        Removes a backup dataset from the catalog, after it has been destroyed
+
+        """
+        self._execute("DELETE FROM backups WHERE dataset = ?", (dataset,))
+
+    def get_backup(self, dataset):
+        """
+        Returns the row of a backup dataset as a dictionary, or None if it is not in the catalog
+
+        """
+        rows = self._execute("SELECT * FROM backups WHERE dataset = ?", (dataset,))
+        return dict(rows[0]) if rows else None
+
+    def last_backup(self, backup_type=None, statuses=USABLE_STATUSES, not_after=None):
+        """
+        Returns the newest backup as a dictionary, or None if there is none.
+
+        Parameters
+        ----------
+        backup_type :   Only look at backups of this type. None means any type
+        statuses :      Only look at backups with one of these statuses. None means any status
+        not_after :     Only look at backups with a timestamp up to this one, like for a restore as of a point in time
+
+        """
+        conditions = []
+        parameters = []
+        if backup_type is not None:
+            conditions.append("backup_type = ?")
+            parameters.append(backup_type)
+        if statuses is not None:
+            conditions.append("status IN (" + ",".join("?" * len(statuses)) + ")")
+            parameters.extend(statuses)
+        if not_after is not None:
+            conditions.append("timestamp <= ?")
+            parameters.append(not_after)
+        where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+        rows = self._execute("SELECT * FROM backups" + where + " ORDER BY timestamp DESC LIMIT 1", parameters)
+        return dict(rows[0]) if rows else None
+
+    def backups(self, older_than=None):
+        """
+        Returns all backups, oldest first, as a list of dictionaries
+
+        Parameters
+        ----------
+        older_than :    Only return backups with a timestamp lower than this
+
+        """
+        if older_than is None:
+            rows = self._execute("SELECT * FROM backups ORDER BY timestamp")
+        else:
+            rows = self._execute("SELECT * FROM backups WHERE timestamp < ? ORDER BY timestamp", (older_than,))
+        return [dict(row) for row in rows]
+
+    def clones_of(self, dataset):
+        """
+        Returns the backups that were cloned from a snapshot of the given dataset
+
+        """
+        rows = self._execute("SELECT * FROM backups WHERE parent_snapshot >= ? AND parent_snapshot < ? ORDER BY timestamp", (dataset+"@", dataset+"A"))
+        return [dict(row) for row in rows]
+
+    def is_empty(self):
+        return not self._execute("SELECT 1 FROM backups LIMIT 1")
+
+    def rebuild_from_zfs(self):
+        """
+        Replaces the content of the catalog with the backup datasets found in ZFS.
+        The status of a backup can not be read from ZFS, so rebuilt rows get status 'unknown'.
+        Returns the number of backups found, or -1 if 'zfs list' failed.
+
+        """
+        datasets = subprocess.run(['zfs', 'list', '-H', '-p', '-t', 'filesystem', '-o', 'name,origin,used', '-r', self.root_dataset_name],
+                                  encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if datasets.returncode:
+            return -1
+        rows = []
+        for line in datasets.stdout.splitlines()[1:]: #The first line is the root dataset of the backup job
+            (name, origin, used) = line.split("\t")
+            parts = name.split("/")[-1].split("_")
+            if len(parts) < 2 or parts[-1] not in ("full", "diff", "inc"):
+                continue
+            rows.append((name, parts[-1], "_".join(parts[:-1]), None if origin == "-" else origin, "unknown", int(used), time.time()))
+        with self._lock, self.connection:
+            self.connection.execute("DELETE FROM backups")
+            self.connection.executemany("INSERT INTO backups (dataset, backup_type, timestamp, parent_snapshot, status, used_bytes, updated) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+
+def open_catalog(root_dataset_name):
+    """
+    Opens the catalog of a backup job, and rebuilds it from ZFS if it is empty,
+    like the first time a job runs after the catalog was introduced
+
+    Parameters
+    ----------
+    root_dataset_name :     ZFS name of the root dataset of the backup job
+
+    """
+    catalog = BackupCatalog(root_dataset_name)
+    if catalog.is_empty():
+        catalog.rebuild_from_zfs()
+    return catalog
+
+
+def get_used_bytes(dataset):
+    """
+    Returns the 'used' property of a ZFS dataset in bytes, or None if it can not be read
+
+    """
+    used = subprocess.run(['zfs', 'get', '-H', '-p', '-o', 'value', 'used', dataset], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if used.returncode:
+        return None
+    return int(used.stdout.strip())
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='Show or rebuild the backup catalog of a backup job.')
+    arg_parser.add_argument("root_dataset_name", help="Name of the root dataset of the backup job. Example: backup/job1")
+    arg_parser.add_argument('-r','--rebuild', action='store_true', help='Rebuild the catalog from ZFS before showing it')
+    arguments = arg_parser.parse_args()
+    catalog = BackupCatalog(arguments.root_dataset_name)
+    if arguments.rebuild:
+        found = catalog.rebuild_from_zfs()
+        if found < 0:
+            print("Unable to list the datasets of "+arguments.root_dataset_name)
+            sys.exit(2)
+        print("Catalog rebuilt with "+str(found)+" backups")
+    for backup in catalog.backups():
+        print(backup["timestamp"], backup["backup_type"], backup["status"], backup["used_bytes"], backup["dataset"], backup["parent_snapshot"] or "-")
@@ -0,0 +1,1422 @@
+import subprocess, os.path, sys, argparse, time, threading, concurrent.futures, collections, tempfile, glob, sqlite3
+from datetime import datetime
+from shared_functions import *
+from rsync_stats import parse_rsync_stats, parse_progress2_line, stats_record_path, read_stats_record, write_stats_record
+from rsync_shards import scan_tree, list_only_tree, plan_shards, sum_stats
+from backup_catalog import open_catalog, get_used_bytes
+from status_journal import StatusJournal
+from block_transfer import receive_changed_blocks, DEFAULT_BLOCK_SIZE
+from budgets import TransferBudget
+from wire_compression import choose_compression, compression_options, achieved_ratio, local_rsync_version, RESAMPLE_AFTER
+from metrics import Metrics, METRICS_DIRECTORY
+from locks import FileLock, LockHeld, describe_owner
+from client_agent import ClientAgent, AgentError
+from content_manifest import read_manifest, compare_manifests
+from replication import Replicator, DEFAULT_BUFFER_SIZE
+from backup_planner import plan_backup_type
+
+main_log_file = zfsync_path("/backup/backupexecutor.log")
+client_snapshot_mount_path = zfsync_path("/mnt/rsyncbackup")
+manifest_script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "content_manifest.py") #Hashes the backup of a volume for verify_volume
+client_script_path = zfsync_path("/opt/zfsync/client_backup.py")
+ssh_user = "root"
+PROGRESS_INTERVAL = 60 #Seconds between progress messages when --progress-mode is 'aggregate'
+WALKING_METHODS = ("stat-scan", "sample-compression") #Agent methods that read through a whole volume. Started on their own, see client_command
+
+def job_arg_parser():
+    """
+    Returns the argument parser for the options of a backup job, shared by server_backupExecutor.py
+    and the in-process runner of server_backupInitiator.py
+
+    """
+    arg_parser = argparse.ArgumentParser(description='Server side script that does the main execution of the backup job.')
+    arg_parser.add_argument("volumes", nargs='*',help="Full path of all the logical volumes to back up")
+    arg_parser.add_argument('-c','--client', help='DNS solvable hostname/FQDN, or IP address of the client', required=True)
+    arg_parser.add_argument('-p','--dataset-name', help='Name of the root dataset where the backupjob is stored', required=True)
+    arg_parser.add_argument('-t','--backup-type', help="Type of backup to perform. 'auto' picks full, diff or inc from the clone chain of the job and the estimated bytes to transfer, see backup_planner.py",choices=['full','diff','inc','auto'], required=True)
+    arg_parser.add_argument('--diff-every', type=int, default=0, help="With '-t auto', make at least every Nth backup a diff or full backup, like diff_every in the job file. 0 leaves it to the estimates")
+    arg_parser.add_argument('--full-every', type=int, default=0, help="With '-t auto', make at least every Nth backup a full backup, like full_every in the job file. 0 leaves it to the estimates")
+    arg_parser.add_argument('--transfer-mode', choices=['rsync','block'], default='rsync', help="'rsync' copies the files of the mounted snapshot. 'block' copies the changed blocks of the snapshot device into an image file, for volumes with large single files like VM images")
+    arg_parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE, help='Block size in bytes for --transfer-mode block')
+    arg_parser.add_argument('--changed-files-only', action='store_true', help="For diff and inc backups, let the client compare the snapshot with the file index of the base backup, and only give rsync the paths that changed, instead of letting rsync walk the whole volume")
+    arg_parser.add_argument('--index-verify-every', type=int, default=7, help='With --changed-files-only, do a normal rsync of the whole volume every N backups, to catch any change the file index missed')
+    arg_parser.add_argument('--verify-percent', type=int, default=0, help='After rsync, compare the digests of this share of the files in the backup with the snapshot. Each backup takes the next share, so 15 verifies every file once every 7 backups, and 100 verifies all of them. 0 turns verification off')
+    arg_parser.add_argument('--verify-workers', type=int, default=4, help='Number of processes that hash the files for --verify-percent, on the client and on the server each')
+    arg_parser.add_argument('--shards', type=int, default=1, help='Split each volume into this many parts of about the same size, and copy them with one rsync each at the same time. Only used when rsync walks the whole volume')
+    arg_parser.add_argument('--compression', choices=['auto','none','zlib','lz4','zstd'], default='auto', help="Compression of the rsync transfer. 'auto' picks one for each volume from a sample of its files, or the stats of the last backup. lz4 and zstd need rsync 3.2 on both ends")
+    arg_parser.add_argument('--progress-mode', choices=['lines','aggregate'], default='lines', help="'lines' echoes rsync's per file progress. 'aggregate' only logs the overall progress every PROGRESS_INTERVAL seconds, which is much cheaper on volumes with many files")
+    arg_parser.add_argument('--log-format', choices=['text','json'], default='text', help="Format of the log files. 'json' writes one JSON object per line")
+    arg_parser.add_argument('--job-file', help='The job file the backup job was started from. Its bwlimit, ionice, nice and io_read_max settings are the budget of the job')
+    arg_parser.add_argument('--config', default=zfsync_path("/etc/zfsync/zfsync.cfg"), help='Central config file with the global, per client and per pool budgets')
+    arg_parser.add_argument('--metrics-dir', default=METRICS_DIRECTORY, help='Directory for the Prometheus textfile of the job, for the textfile collector of node_exporter. The timing spans of every phase are also written as JSON next to the job log')
+    arg_parser.add_argument('-v','--verbosity-level',nargs='?', const=3, type=int, default=3, help='Level of verbosity for logging and printing. 0 = no logging/printing, 1 = errors, 2 = warning + error, 3 = warning+error+info')
+    arg_parser.add_argument('--consistent-snapshot', action='store_true', help='Snapshot all the volumes in one call to the client, with their file systems frozen, so that the snapshots are one consistent point in time')
+    arg_parser.add_argument('--client-mode', choices=['agent','exec'], default='agent', help="'agent' runs the control commands on the client as requests to one 'client_backup.py agent' for the whole job. 'exec' starts client_backup.py for each command. Jobs fall back to 'exec' if the agent can not be started")
+    arg_parser.add_argument('--replicate-to', help="After a successful backup, replicate the backups of the job that are not there yet to another pool with zfs send and receive. 'tank/zfsync' for a pool on this server, 'host:tank/zfsync' for a pool on another host. The job is replicated to TARGET/JOBNAME")
+    arg_parser.add_argument('--replication-buffer', type=int, default=DEFAULT_BUFFER_SIZE, help='Megabytes of a replication stream that may be buffered between zfs send and zfs receive')
+    arg_parser.add_argument('-j','--parallel', type=int, default=1, help='Number of volumes to back up at the same time. Each volume gets its own log file, and a failed volume does not stop the others when this is higher than 1')
+    return arg_parser
+
+
+class JobResult:
+    """
+    The outcome of a backup job
+
+    Parameters
+    ----------
+    exit_code :         EXIT_OK, EXIT_WARNING or EXIT_CRITICAL, like the exit code of server_backupExecutor.py
+    message :           What happened, for the log of the caller
+    dataset :           Name of the dataset the job backed up into, or None if it did not get that far
+    volume_results :    Dictionary with the exit code of each volume that was attempted
+
+    """
+
+    def __init__(self, exit_code, message, dataset=None, volume_results=None):
+        self.exit_code = exit_code
+        self.message = message
+        self.dataset = dataset
+        self.volume_results = volume_results or {}
+
+
+class BackupJob:
+    """
+    One run of a backup job: creates the dataset, backs up every volume of the client into it,
+    and records the result in the catalog and the status journal. Everything the run needs is
+    kept on the object, so many jobs can run in one process at the same time, sharing one
+    SSHConnectionManager. run() returns a JobResult, and never exits the process.
+
+    Parameters
+    ----------
+    options :           The options of the job, as parsed by job_arg_parser()
+    ssh_connections :   SSHConnectionManager for the client. Shared by the jobs of a process
+    echo_output :       Print the output of rsync when volumes are backed up one at a time. Only
+                        for jobs that have a terminal to themselves; otherwise it goes to the log
+
+    """
+
+    def __init__(self, options, ssh_connections, echo_output=False):
+        self.options = options
+        self.ssh_connections = ssh_connections
+        self.echo_output = echo_output
+        self.time_now = datetime.today().strftime('%Y-%m-%dT%H-%M-%S')
+        self.lv_suffix = "_rsyncbackup_"+self.time_now
+        self.lock = FileLock(dataset_path(options.dataset_name)+"/lock", "backup "+options.backup_type+" "+self.time_now) #Held while the job runs
+        self.job_log_file = dataset_path(options.dataset_name)+"/"+self.time_now+"_"+options.backup_type+".log"
+        self.metrics = Metrics(job=options.dataset_name, client=options.client) #Timing spans of every phase, and byte and file counters
+        self.catalog = None #Backup catalog of the job. Opened by run_job(), closed by run()
+        self.current_dataset = None #Dataset of the backup of this run, once run_job() has created it
+        self.transfer_budget = None #Bandwidth and I/O budgets of the job. Read by run_job()
+        self.agent = None #ClientAgent of the job, if --client-mode is 'agent'. Started by run_job()
+        self.verifications = {} #Result of the verification of each volume, see verify_volume
+        self.pending_indexes = {} #Volumes with a file index from scan_client_changes -> whether rsync walked the whole volume. Committed once the job has succeeded
+
+    def run(self):
+        """
+        Runs the backup job and returns a JobResult. An unexpected error only fails this job:
+        it is logged and returned as EXIT_CRITICAL, the backup is marked failed (see
+        fail_unfinished_backup), and the lock of the job is released.
+        The metrics of the run are exported at the end, see export_metrics.
+
+        """
+        job_start_time = time.time()
+        try:
+            result = self.run_job()
+        except Exception as e:
+            log_and_print(self.options.verbosity_level,"critical","Unhandled error in backup job "+self.options.dataset_name+": "+repr(e),main_log_file)
+            self.fail_unfinished_backup()
+            self.lock.release()
+            result = JobResult(EXIT_CRITICAL, "Unhandled error: "+repr(e), self.current_dataset)
+        finally:
+            if self.agent is not None:
+                self.agent.close()
+            if self.catalog is not None:
+                self.catalog.close()
+        self.export_metrics(job_start_time, result.exit_code)
+        #The files would otherwise stay open in the scheduler's pool for as long as it runs
+        for log_file in [self.job_log_file] + [self.volume_log_file(volume) for volume in self.options.volumes]:
+            close_log(log_file)
+        return result
+
+    def run_job(self):
+        log_and_print(self.options.verbosity_level,"info", "Starting backupjob", main_log_file)
+        log_and_print(self.options.verbosity_level,"info", str(self.options), main_log_file)
+
+        #Check that the root dataset for the backup job exists.
+        if not os.path.isdir(dataset_path(self.options.dataset_name)):
+            log_and_print(self.options.verbosity_level,"critical", "Root dataset for backup job, "+self.options.dataset_name+" does not exist. Exiting!", main_log_file)
+            return JobResult(EXIT_CRITICAL, "Root dataset does not exist")
+
+        #Only one run of a backup job at a time
+        try:
+            self.lock.acquire()
+        except LockHeld as e:
+            log_and_print(self.options.verbosity_level,"warning", "Backup job is locked: "+str(e)+". Exiting!", self.job_log_file)
+            return JobResult(EXIT_WARNING, "Backup job is locked")
+        if self.lock.stale_owner:
+            log_and_print(self.options.verbosity_level,"warning", "Took over the lock of the backup job, left by "+describe_owner(self.lock.stale_owner), self.job_log_file)
+
+        with self.metrics.span("catalog_open"):
+            self.catalog = open_catalog(self.options.dataset_name)
+        #The transfers that can run at the same time, which share the bandwidth limits of the job
+        streams = max(1, min(self.options.parallel, len(self.options.volumes))) * (max(1, self.options.shards) if self.options.transfer_mode == "rsync" else 1)
+        self.transfer_budget = TransferBudget(self.options.config, self.options.job_file, self.options.client, self.options.dataset_name.split("/")[0], self.options.dataset_name, streams)
+        if self.options.backup_type == "auto":
+            self.choose_backup_type()
+
+        #Creating new dataset for the running backup job
+        returncode,current_dataset = self.create_dataset(self.options.dataset_name,self.options.backup_type)
+        if returncode:
+            log_and_print(self.options.verbosity_level,"critical", "Error while creating dataset", self.job_log_file)
+            self.lock.release()
+            return JobResult(EXIT_CRITICAL, "Error while creating dataset")
+        else:
+            log_and_print(self.options.verbosity_level,"info", "Dataset created", self.job_log_file)
+        self.current_dataset = current_dataset
+
+        if self.options.client_mode == "agent":
+            self.start_agent()
+
+        #For each logical volume specified, initiate client and run rsync
+        volume_results = self.run_volume_pipelines(self.options.volumes, current_dataset, self.options.parallel)
+        failed_volumes = [volume for volume in volume_results if volume_results[volume]]
+        for volume in self.options.volumes:
+            if volume not in volume_results:
+                log_and_print(self.options.verbosity_level,"warning","Volume was not backed up: "+volume,self.job_log_file)
+            elif volume_results[volume]:
+                log_and_print(self.options.verbosity_level,"critical","Backup failed for volume: "+volume+" (exit code "+str(volume_results[volume])+")",self.job_log_file)
+            else:
+                log_and_print(self.options.verbosity_level,"info","Backup succeeded for volume: "+volume,self.job_log_file)
+
+        job_failed = failed_volumes or len(volume_results) < len(self.options.volumes)
+        with self.metrics.span("catalog_update"):
+            self.catalog.set_status(current_dataset, "failed" if job_failed else "successful", get_used_bytes(current_dataset))
+            if self.verifications:
+                self.catalog.set_verification(current_dataset, self.verifications)
+            StatusJournal(self.options.dataset_name).append("failed" if job_failed else "successful", current_dataset.split("/")[-1], self.verification_summary())
+        if not job_failed:
+            #The next backup is cloned from this one, so the client may now compare with the indexes of this backup.
+            #After a failed backup the older indexes stay, and the next one finds the changes since the older base.
+            for (volume, verified) in self.pending_indexes.items():
+                self.commit_client_index(self.options.client, ssh_user, volume, current_dataset, verified, self.volume_log_file(volume))
+        self.lock.release()
+        if job_failed:
+            log_and_print(self.options.verbosity_level,"critical","BackupExecutor finished with failed volumes. Exiting.",self.job_log_file)
+            log_and_print(self.options.verbosity_level,"critical","BackupExecutor finished with failed volumes. Exiting.",main_log_file)
+            return JobResult(EXIT_CRITICAL, str(len(self.options.volumes) - len(volume_results) + len(failed_volumes))+" of "+str(len(self.options.volumes))+" volumes failed", current_dataset, volume_results)
+
+        if self.options.replicate_to and self.replicate():
+            return JobResult(EXIT_WARNING, "Backup successful, but replication to "+self.options.replicate_to+" failed", current_dataset, volume_results)
+
+        log_and_print(self.options.verbosity_level,"info","BackupExecutor has run successfully! Exiting.",self.job_log_file)
+        log_and_print(self.options.verbosity_level,"info","BackupExecutor has run successfully! Exiting.",main_log_file)
+        return JobResult(EXIT_OK, "Backup successful", current_dataset, volume_results)
+
+    def fail_unfinished_backup(self):
+        """
+        Marks the backup of this run 'failed' in the catalog and the status journal after an
+        unhandled error, if it is still 'running', so that it is never used as a base, and
+        retention expires it like any other failed backup. Errors here are only logged.
+
+        """
+        if self.catalog is None or self.current_dataset is None:
+            return
+        try:
+            backup = self.catalog.get_backup(self.current_dataset)
+            if backup is None or backup["status"] != "running":
+                return
+            self.catalog.set_status(self.current_dataset, "failed", get_used_bytes(self.current_dataset))
+            StatusJournal(self.options.dataset_name).append("failed", self.current_dataset.split("/")[-1], self.verification_summary())
+        except (OSError, sqlite3.Error) as e:
+            log_and_print(self.options.verbosity_level,"critical","Unable to mark backup "+self.current_dataset+" as failed: "+repr(e),main_log_file)
+
+    def choose_backup_type(self):
+        """
+        Replaces '-t auto' with the backup type that plan_backup_type picks, and renames the job log,
+        so that the logs and the stats records of the run are named after the type it really is.
+
+        """
+        with self.metrics.span("plan_backup_type"):
+            plan = plan_backup_type(self.catalog, self.options.dataset_name, self.options.diff_every, self.options.full_every)
+        self.options.backup_type = plan["backup_type"]
+        auto_log_file = self.job_log_file
+        self.job_log_file = dataset_path(self.options.dataset_name)+"/"+self.time_now+"_"+self.options.backup_type+".log"
+        close_log(auto_log_file)
+        flush_logs()
+        if os.path.exists(auto_log_file):
+            os.replace(auto_log_file, self.job_log_file)
+        for (backup_type, estimate) in plan["estimates"].items():
+            if estimate is not None:
+                self.metrics.gauge("zfsync_planned_bytes", estimate, backup_type=backup_type)
+        self.metrics.gauge("zfsync_chain_depth", plan["chain_depth"])
+        log_and_print(self.options.verbosity_level,"info","Backup type 'auto' is "+plan["backup_type"]+": "+plan["reason"]+" (estimated bytes: "+
+                      ", ".join(backup_type+" "+("unknown" if estimate is None else str(estimate)) for (backup_type, estimate) in sorted(plan["estimates"].items()))+")",self.job_log_file)
+
+    def replicate(self):
+        """
+        Replicates the backups of the job to --replicate-to, see Replicator, after the lock of the
+        job has been released. Returns the exit code of the replication. Its metrics are written to
+        a textfile of their own, next to the one of the job.
+
+        """
+        replicator = Replicator(self.options.dataset_name, self.options.replicate_to, self.catalog, self.options.verbosity_level, self.job_log_file,
+                                self.options.replication_buffer * 1024 * 1024, self.ssh_connections)
+        exit_code = replicator.run()
+        replicator.export_metrics(self.options.metrics_dir)
+        return exit_code
+
+
+    def run_volume_pipelines(self, volumes, dataset, parallel):
+        """
+        Runs the snapshot -> rsync -> cleanup pipeline for every volume, and returns
+        a dictionary with the exit code of each volume that was attempted.
+        With parallel <= 1 the volumes are backed up one at a time, and the job stops
+        at the first failed volume, like it always has. With parallel > 1 up to
+        'parallel' volumes are backed up at the same time, and a failed volume does
+        not stop the others.
+
+        Parameters
+        ----------
+        volumes :   List of full paths of the logical volumes to back up
+        dataset :   Name of the ZFS dataset the volumes are backed up into
+        parallel :  Maximum number of volumes to back up at the same time
+
+        """
+
+        volume_results = {}
+        snapshot_ready = False
+        if self.options.consistent_snapshot:
+            volumes, volume_results = self.initiate_client_volumes(self.options.client, ssh_user, volumes, self.lv_suffix)
+            snapshot_ready = True
+
+        if parallel <= 1:
+            for volume in volumes:
+                volume_results[volume] = self.backup_volume(volume, dataset, snapshot_ready)
+                if volume_results[volume]:
+                    break
+            #Snapshots taken up front for volumes that were never backed up must still be removed
+            for volume in volumes:
+                if snapshot_ready and volume not in volume_results:
+                    self.end_client(self.options.client, ssh_user, volume, self.lv_suffix, self.volume_log_file(volume))
+            return volume_results
+
+        log_and_print(self.options.verbosity_level,"info","Backing up "+str(len(volumes))+" volumes with "+str(parallel)+" parallel workers",self.job_log_file)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = {executor.submit(self.backup_volume, volume, dataset, snapshot_ready): volume for volume in volumes}
+            for future in concurrent.futures.as_completed(futures):
+                volume = futures[future]
+                try:
+                    volume_results[volume] = future.result()
+                except BaseException as e:
+                    log_and_print(self.options.verbosity_level,"critical","Unhandled error while backing up volume "+volume+": "+repr(e),self.job_log_file)
+                    volume_results[volume] = EXIT_CRITICAL
+        return volume_results
+
+
+    def initiate_client_volumes(self, client, username, volumes, lv_suffix):
+        """
+        Snapshots all the volumes with a single call to 'client_backup.py' on the client.
+        The file systems of the volumes are frozen while the snapshots are created, so
+        that the snapshots are one consistent point in time across the volumes.
+        Returns a list of the volumes that were snapshotted and mounted, and a dictionary
+        with the exit code of each volume that failed.
+
+        Parameters
+        ----------
+        client :        Hostname or IP address of the client
+        username :      The username that will be used to connect to the client.
+        volumes :       List of full paths of the logical volumes to snapshot
+        lv_suffix :     Suffix to add to the snapshot names
+
+        """
+
+        log_and_print(self.options.verbosity_level,"info", "initiate_client_volumes function invoked with parameters:", self.job_log_file)
+        log_and_print(self.options.verbosity_level,"info", "volumes = "+str(volumes), self.job_log_file)
+
+        command = client_script_path + " initiate-backup -f -o json" + self.snapshot_options() + " -l " + " ".join(volumes) + " -s "+lv_suffix+" -v "+str(self.options.verbosity_level)
+        try:
+            with self.metrics.span("initiate_client") as span:
+                (result, output, exit_code) = self.client_command("snapshot", {"lv_paths": volumes, "snap_suffix": lv_suffix, "freeze": True, "mount": self.options.transfer_mode != "block"}, command)
+                if exit_code:
+                    span["status"] = "error"
+        except Exception as e:
+            log_and_print(self.options.verbosity_level,"critical","Unable to initiate client", self.job_log_file)
+            log_and_print(self.options.verbosity_level,"critical", str(e), self.job_log_file)
+            result = None
+
+        if result is None:
+            result = {"volumes": {}}
+        self.metrics.add_spans(result.get("spans"))
+        initiated_volumes = []
+        failed_volumes = {}
+        for volume in volumes:
+            volume_result = result["volumes"].get(volume, {"exit_code": EXIT_CRITICAL, "message": "No result from client"})
+            if volume_result["exit_code"]:
+                log_and_print(self.options.verbosity_level,"critical","Error while initiating client for volume "+volume+": "+str(volume_result["message"]),self.volume_log_file(volume))
+                failed_volumes[volume] = EXIT_CRITICAL
+            else:
+                log_and_print(self.options.verbosity_level,"info","Snapshot of volume "+volume+" mounted at "+volume_result["mount_path"],self.volume_log_file(volume))
+                initiated_volumes.append(volume)
+        return initiated_volumes, failed_volumes
+
+
+    def backup_volume(self, volume, dataset, snapshot_ready=False):
+        """
+        Runs the whole backup pipeline for one logical volume: creates and mounts the
+        snapshot on the client, rsyncs it into the dataset, and removes the snapshot again.
+        The snapshot is always cleaned up once the client has been initiated, no matter
+        how the transfer went. Everything is logged to the volume's own log file.
+        Returns EXIT_OK if the volume was backed up, or else EXIT_CRITICAL.
+
+        Parameters
+        ----------
+        volume :            Full path of the logical volume to back up
+        dataset :           Name of the ZFS dataset the volume is backed up into
+        snapshot_ready :    True if the snapshot has already been created and mounted
+
+        """
+
+        log_file = self.volume_log_file(volume)
+        log_and_print(self.options.verbosity_level,"info","Starting backup of volume: "+volume+" (log file: "+log_file+")",self.job_log_file)
+
+        if snapshot_ready:
+            (ic_result, ic_output, ic_exit_code) = (None, [], EXIT_OK)
+        else:
+            #Control commands on the client only lock the logical volumes they work on, so volumes are initiated at the same time
+            (ic_result, ic_output, ic_exit_code) = self.initiate_client(self.options.client, ssh_user, volume, self.lv_suffix, log_file)
+        if ic_exit_code:
+            log_and_print(self.options.verbosity_level,"critical", "Error while initiating client", log_file)
+            volume_status = EXIT_CRITICAL
+        else:
+            log_and_print(self.options.verbosity_level,"info", "Client initiated successfully", log_file)
+            log_and_print(self.options.verbosity_level,"info", str(ic_output), log_file)
+            # Rsync files, or send the changed blocks
+            use_index = self.options.changed_files_only and self.options.transfer_mode == "rsync"
+            files_from = None
+            if use_index:
+                (use_index, files_from) = self.scan_client_changes(self.options.client, ssh_user, volume, self.lv_suffix, dataset, log_file)
+            with self.metrics.span("transfer", volume=volume) as span:
+                if self.options.transfer_mode == "block":
+                    rsync_status = self.block_transfer_files(self.options.client, volume, self.lv_suffix, dataset, log_file)
+                else:
+                    rsync_status = self.rsync_files(self.options.client, volume, self.lv_suffix, dataset, log_file, files_from)
+                if rsync_status:
+                    span["status"] = "error"
+            if use_index and not rsync_status:
+                #The new index is only made the base of the next backup by run_job, once the whole backup has succeeded
+                self.pending_indexes[volume] = files_from is None
+            if rsync_status:
+                log_and_print(self.options.verbosity_level,"critical","Rsync failed for volume: "+volume+self.lv_suffix,log_file)
+                volume_status = EXIT_CRITICAL
+            else:
+                log_and_print(self.options.verbosity_level,"info","Rsync succeeded for volume: "+volume+self.lv_suffix,log_file)
+                volume_status = EXIT_OK
+                if self.options.verify_percent > 0 and self.options.transfer_mode == "rsync":
+                    #The snapshot must still be mounted, so this runs before end_client
+                    with self.metrics.span("verify", volume=volume) as span:
+                        verification = self.verify_volume(self.options.client, volume, self.lv_suffix, dataset, log_file)
+                        if verification["status"] != "ok":
+                            span["status"] = "error"
+                    if verification["status"] == "mismatch":
+                        volume_status = EXIT_CRITICAL
+
+        #Clean up the snapshot even if initiating failed half way, so that it is not left behind on the client
+        (ec_result, ec_output, ec_exit_code) = self.end_client(self.options.client, ssh_user, volume, self.lv_suffix, log_file)
+        if ec_exit_code:
+            log_and_print(self.options.verbosity_level,"critical","Unable to end_client for volume: "+volume+self.lv_suffix,log_file)
+            log_and_print(self.options.verbosity_level,"critical",str(ec_output),log_file)
+        else:
+            log_and_print(self.options.verbosity_level,"info","end_client successful for volume: "+volume+self.lv_suffix,log_file)
+            log_and_print(self.options.verbosity_level,"info",str(ec_output),log_file)
+
+        telemetry = self.snapshot_telemetry(ec_result, volume)
+        if telemetry is not None:
+            log_and_print(self.options.verbosity_level,"info","Snapshot telemetry: "+str(round(telemetry["peak_used_mb"]))+"M used of "+str(telemetry["size_mb"])+"M ("+str(telemetry["peak_percent"])+"%), "+str(telemetry["extensions"])+" extensions, "+str(round(telemetry["write_rate_mb_s"], 3))+" MB/s written on the client",log_file)
+            stats = read_stats_record(stats_record_path(log_file))
+            if stats is not None:
+                stats["snapshot"] = telemetry
+                write_stats_record(stats_record_path(log_file), stats)
+            if telemetry["invalid"] and volume_status == EXIT_OK:
+                #The snapshot overflowed while it was copied, so the copy is not one point in time
+                log_and_print(self.options.verbosity_level,"critical","The snapshot of volume "+volume+" was invalidated during the transfer. The backup of the volume is not consistent",log_file)
+                volume_status = EXIT_CRITICAL
+
+        return volume_status
+
+
+    def verify_volume(self, client, volume, lv_suffix, dataset, log_file=None):
+        """
+        Checks the backup of a volume against its snapshot, which must still be mounted on the client.
+        The client and the server each hash the same sample of the files, see build_manifest in
+        content_manifest.py, and the two manifests are compared as they come in. The sample moves
+        on with every backup of the volume, so all the files are verified over a number of backups.
+        Returns the result, which is also added to the stats record of the volume. Its status is
+        'ok', 'mismatch' if the backup differs from the snapshot, or 'error' if it could not be verified.
+
+        Parameters
+        ----------
+        client :        Hostname or IP address of the client
+        volume :        Full path of the logical volume
+        lv_suffix :     Suffix of the snapshot
+        dataset :       Name of the ZFS dataset the volume was backed up into
+        log_file :      The log file to write to
+
+        """
+        log_file = log_file or self.job_log_file
+
+        lv_name = volume.split("/")[3]
+        previous = (self.previous_stats_record(volume, log_file) or {}).get("verification") or {}
+        percent = min(self.options.verify_percent, 100)
+        rotation = previous.get("rotation", -1) + 1
+        manifest_options = ["--verify-percent", str(percent), "--rotation", str(rotation), "--workers", str(self.options.verify_workers)]
+        #Hashing reads the whole sample from the snapshot, so it runs with the I/O and CPU priority of the budget
+        command = " ".join(self.transfer_budget.remote_command_prefix() + [client_script_path, "content-manifest", "-l", volume, "-s", lv_suffix] + manifest_options + ["-v", str(self.options.verbosity_level)])
+        log_and_print(self.options.verbosity_level,"info","Verifying "+str(percent)+"% of the files, rotation "+str(rotation)+": "+command,log_file)
+
+        result = {"percent": percent, "rotation": rotation, "start_time": time.time()}
+        server_manifest = None
+        try:
+            (ssh_stdin, ssh_stdout, ssh_stderr) = self.ssh_connections.open_command(client, ssh_user, command, self.metrics)
+            ssh_stdin.channel.shutdown_write()
+            stderr_lines = []
+            stderr_reader = threading.Thread(target=lambda: stderr_lines.extend(ssh_stderr.readlines()), daemon=True)
+            stderr_reader.start()
+            #The backup is hashed by a process of its own, so the worker processes are not forked from the threads of this one
+            server_manifest = subprocess.Popen([sys.executable, manifest_script_path, dataset_path(dataset)+"/"+lv_name] + manifest_options,
+                                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            #Drained like the client's, so warnings of the hashing workers can not fill the pipe and stall the manifest
+            server_stderr_lines = []
+            server_stderr_reader = threading.Thread(target=lambda: server_stderr_lines.extend(server_manifest.stderr.readlines()), daemon=True)
+            server_stderr_reader.start()
+            result.update(compare_manifests(read_manifest(ssh_stdout), read_manifest(server_manifest.stdout)))
+            client_exit_code = ssh_stdout.channel.recv_exit_status()
+            stderr_reader.join()
+            server_exit_code = server_manifest.wait()
+            server_stderr_reader.join()
+            for line in stderr_lines + server_stderr_lines:
+                write_log(line if isinstance(line, str) else line.decode('utf-8', 'replace'), log_file)
+            if client_exit_code or server_exit_code:
+                raise RuntimeError("content-manifest exited with exit code "+str(client_exit_code)+" on the client, and "+str(server_exit_code)+" on the server: "+b"".join(server_stderr_lines).decode('utf-8', 'replace').strip())
+        except Exception as e:
+            log_and_print(self.options.verbosity_level,"warning","Unable to verify volume "+volume+": "+str(e),log_file)
+            result.update({"status": "error", "error": str(e)})
+        finally:
+            if server_manifest is not None and server_manifest.poll() is None:
+                server_manifest.kill()
+                server_manifest.wait()
+        result["duration"] = time.time() - result["start_time"]
+
+        if "status" not in result:
+            differences = result["mismatched"] + result["missing"] + result["extra"] + result["unreadable"]
+            result["status"] = "mismatch" if differences else "ok"
+            if differences:
+                log_and_print(self.options.verbosity_level,"critical","Backup of volume "+volume+" differs from the snapshot in "+str(differences)+" of "+str(result["files"])+" files checked: "+", ".join(result["examples"]),log_file)
+            else:
+                log_and_print(self.options.verbosity_level,"info","Backup of volume "+volume+" verified: "+str(result["files"])+" files, "+str(result["bytes"])+" bytes in "+str(round(result["duration"], 3))+" seconds",log_file)
+        self.metrics.count("verified_files", result.get("files", 0), volume=volume)
+        self.metrics.count("verified_bytes", result.get("bytes", 0), volume=volume)
+
+        stats = read_stats_record(stats_record_path(log_file))
+        if stats is not None:
+            stats["verification"] = result
+            write_stats_record(stats_record_path(log_file), stats)
+        self.verifications[volume] = result
+        return result
+
+
+    def verification_summary(self):
+        """
+        Returns the result of the verification of the job in a few words, for the status journal,
+        like 'verify:15%:ok', or '' if no volume was verified
+
+        """
+        if not self.verifications:
+            return ""
+        statuses = [verification["status"] for verification in self.verifications.values()]
+        percent = min(verification["percent"] for verification in self.verifications.values())
+        if "mismatch" in statuses:
+            status = str(sum(verification["mismatched"] + verification["missing"] + verification["extra"] + verification["unreadable"]
+                             for verification in self.verifications.values() if verification["status"] == "mismatch")) + "bad"
+        elif "error" in statuses:
+            status = "error"
+        else:
+            status = "ok"
+        return "verify:"+str(percent)+"%:"+status
+
+
+    def snapshot_telemetry(self, end_backup_result, volume):
+        """
+        Returns the snapshot telemetry of a volume from the result of end_client:
+        how full the snapshot got, how often it was extended, and the write rate on the client.
+        Returns None if the client did not report any.
+
+        """
+        result = end_backup_result
+        if result is None:
+            return None
+        return result.get("volumes", {}).get(volume, {}).get("telemetry")
+
+
+    def snapshot_options(self):
+        """
+        Returns the extra options for 'client_backup.py initiate-backup' that the transfer mode needs.
+        Block level transfers read the snapshot device, so the snapshot is not mounted.
+
+        """
+        if self.options.transfer_mode == "block":
+            return " -m"
+        return ""
+
+
+    def volume_log_file(self, volume):
+        """
+        Returns the path of the log file for one logical volume in the running backup job.
+        The file is placed next to the job log, with the name of the logical volume appended.
+
+        Parameters
+        ----------
+        volume :    Full path of the logical volume
+
+        """
+        return dataset_path(self.options.dataset_name)+"/"+self.time_now+"_"+self.options.backup_type+"_"+volume.split("/")[3]+".log"
+
+
+    def scan_client_changes(self, client, username, volume, lv_suffix, dataset, log_file=None):
+        """
+        Lets the client compare the mounted snapshot with the file index of the base backup,
+        the last backup for inc and the last full backup for diff, and write the paths that
+        changed to a file on the client. Returns a tuple: whether the index should be committed
+        after the backup, and the path of the changes file on the client, or None if rsync must
+        walk the whole volume. That is the case for full backups, when there is no index to
+        compare with, when the index is not of the backup the dataset is cloned from, like after
+        a failed commit of the index, and every --index-verify-every backups.
+
+        Parameters
+        ----------
+        client :        Hostname or IP address of the client
+        username :      The username that will be used to connect to the client
+        volume :        Full path of the logical volume
+        lv_suffix :     Suffix of the snapshot
+        dataset :       Name of the ZFS dataset the volume is backed up into. Ends with the backup type
+        log_file :      The log file to write to
+
+        """
+        log_file = log_file or self.job_log_file
+
+        backup_type = dataset.split("_")[-1]
+        base = "full" if backup_type == "diff" else "last"
+        prefix = self.transfer_budget.remote_command_prefix()
+        command = " ".join(prefix) + " " + client_script_path + " scan-changes -o json -l " + volume + " -p " + self.options.dataset_name + " -s " + lv_suffix + " --base " + base + " -v " + str(self.options.verbosity_level)
+        log_and_print(self.options.verbosity_level,"info","Scanning for changed files: "+command,log_file)
+        try:
+            with self.metrics.span("client_scan_changes", volume=volume):
+                (result, output, exit_code) = self.client_command("stat-scan", {"lv_path": volume, "dataset_name": self.options.dataset_name, "snap_suffix": lv_suffix, "base": base}, command, log_file, budgeted=bool(prefix))
+        except Exception as e:
+            log_and_print(self.options.verbosity_level,"warning","Unable to scan for changed files, rsync walks the whole volume: "+str(e),log_file)
+            return (False, None)
+        if result is not None:
+            self.metrics.add_spans(result.get("spans"), volume=volume)
+        if exit_code or result is None:
+            log_and_print(self.options.verbosity_level,"warning","Unable to scan for changed files, rsync walks the whole volume: "+str(output),log_file)
+            return (False, None)
+
+        log_and_print(self.options.verbosity_level,"info","Changed files since the "+base+" backup: "+str(result["changed"])+" changed, "+str(result["deleted"])+" deleted",log_file)
+        if backup_type == "full":
+            return (True, None)
+        if not result["base_found"]:
+            log_and_print(self.options.verbosity_level,"info","No file index of the "+base+" backup. rsync walks the whole volume",log_file)
+            return (True, None)
+        #The changes are only those since the backup the index was committed for, which must be the one the dataset is cloned from
+        parent_snapshot = self.catalog.get_backup(dataset)["parent_snapshot"]
+        catalog_base = parent_snapshot.split("@")[0] if parent_snapshot else None
+        if result.get("base_dataset") != catalog_base:
+            log_and_print(self.options.verbosity_level,"info","The file index is of "+str(result.get("base_dataset"))+", not of the base backup "+str(catalog_base)+". rsync walks the whole volume",log_file)
+            return (True, None)
+        if result["runs_since_verify"] + 1 >= self.options.index_verify_every:
+            log_and_print(self.options.verbosity_level,"info","Verification run: rsync walks the whole volume",log_file)
+            return (True, None)
+        return (True, result["changes_path"])
+
+
+    def commit_client_index(self, client, username, volume, dataset, verified, log_file=None):
+        """
+        Makes the file index from scan_client_changes the base for the next backup of the volume.
+        Only called once the backup is 'successful' in the catalog, as the next backup is cloned from it.
+        A failure is only logged: the index is then not of the backup the next one is cloned from,
+        and scan_client_changes lets rsync walk the whole volume.
+
+        Parameters
+        ----------
+        client :        Hostname or IP address of the client
+        username :      The username that will be used to connect to the client
+        volume :        Full path of the logical volume
+        dataset :       Name of the ZFS dataset the volume was backed up into. Ends with the backup type
+        verified :      True if rsync walked the whole volume
+        log_file :      The log file to write to
+
+        """
+        log_file = log_file or self.job_log_file
+
+        backup_type = dataset.split("_")[-1]
+        command = client_script_path + " commit-index -l " + volume + " -p " + self.options.dataset_name + " --backup-dataset " + dataset + " -t " + backup_type + (" --verified" if verified else "") + " -v " + str(self.options.verbosity_level)
+        try:
+            with self.metrics.span("client_commit_index", volume=volume):
+                (result, output, exit_code) = self.client_command("commit-index", {"lv_path": volume, "dataset_name": self.options.dataset_name, "backup_dataset": dataset, "backup_type": backup_type, "verified": verified}, command, log_file)
+        except Exception as e:
+            (output, exit_code) = ([str(e)], EXIT_CRITICAL)
+        if exit_code:
+            log_and_print(self.options.verbosity_level,"warning","Unable to commit the file index of volume "+volume+": "+str(output),log_file)
+        else:
+            log_and_print(self.options.verbosity_level,"info","File index committed for volume "+volume,log_file)
+
+
+    def rsync_files(self, client, volume, lv_suffix, dataset, log_file=None, files_from=None):
+        """
+        Copies the mounted snapshot of a volume into the dataset with rsync. Returns 0 if OK, or 1 on error.
+        If files_from is given, it is the path of a file on the client with the paths to copy,
+        relative to the snapshot, and rsync neither walks nor deletes anything else. Paths in
+        the list that no longer exist on the client are deleted on the server.
+
+        """
+        log_file = log_file or self.job_log_file
+        log_and_print(self.options.verbosity_level,"info", "rsync_files function invoked with parameters:", log_file)
+        log_and_print(self.options.verbosity_level,"info", "client = "+client, log_file)
+        log_and_print(self.options.verbosity_level,"info", "volume = "+volume, log_file)
+        log_and_print(self.options.verbosity_level,"info", "lv_suffix = "+lv_suffix, log_file)
+        log_and_print(self.options.verbosity_level,"info", "dataset = "+dataset, log_file)
+
+        rsync_returncode = -1
+        def run_rsync_and_yield(cmd):
+            nonlocal rsync_returncode
+            rsync_process = subprocess.Popen(cmd,encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+            for stdout_line in iter(rsync_process.stdout.readline, ""):
+                yield stdout_line
+            rsync_process.stdout.close()
+            rsync_returncode = rsync_process.wait()
+
+        try:
+
+            lv_name = volume.split("/")[3]
+            lv_mount_path = client_snapshot_mount_path+"/"+lv_name+lv_suffix+"/" #We add a trailing slash to copy contents and not the directory itself
+            lv_snapshot_name = volume+lv_suffix
+            backup_dest_dir = dataset_path(dataset)+"/"+lv_name
+            if self.options.progress_mode == "aggregate":
+                progress_options = ['--info=progress2']
+            else:
+                progress_options = ['--progress']
+            if files_from is None:
+                selection_options = ['--delete']
+            else:
+                log_and_print(self.options.verbosity_level,"info", "files_from = "+files_from, log_file)
+                #The changes only name the top most directory of a deleted tree, which rsync only deletes with --force
+                selection_options = ['--files-from=:'+files_from, '--delete-missing-args', '--force']
+            transfer_options = ['-e', self.ssh_connections.rsync_ssh_command(client, ssh_user, self.metrics), ssh_user+'@'+client+':'+lv_mount_path, backup_dest_dir]
+            new_dir = subprocess.run(['mkdir','-p',backup_dest_dir ])
+
+            if new_dir.stderr:
+                log_and_print(self.options.verbosity_level,"critical","Unable to create directory: "+backup_dest_dir, log_file)
+                log_and_print(self.options.verbosity_level,"critical",str(new_dir.stderr),log_file)
+                return 1 # 1 = error
+            else:
+                log_and_print(self.options.verbosity_level,"info","New directory created successfully: "+backup_dest_dir, log_file)
+                with self.metrics.span("compression_select", volume=volume):
+                    compression = self.select_compression(client, volume, lv_suffix, log_file)
+                selection_options = selection_options + compression_options(compression)
+                shard_rules = []
+                if files_from is None and self.options.shards > 1:
+                    with self.metrics.span("shard_plan", volume=volume):
+                        shard_rules = self.plan_volume_shards(transfer_options, dataset, lv_name, log_file)
+                log_and_print(self.options.verbosity_level,"info","Starting rsync", log_file)
+                rsync_start_time = time.time()
+                with self.metrics.span("rsync", volume=volume) as span:
+                    if shard_rules:
+                        #The progress of the shards can only be added up from --info=progress2
+                        rsync_command = ['rsync', '--info=progress2', '--stats', '-aAX'] + selection_options
+                        (rsync_returncode, stats) = self.run_rsync_shards(rsync_command, transfer_options, shard_rules, lv_snapshot_name, log_file)
+                    else:
+                        with self.transfer_budget.lease() as lease:
+                            rsync_command = ['rsync'] + progress_options + ['--stats', '-aAX'] + selection_options + self.budget_options(lease, lv_snapshot_name, log_file) + transfer_options
+                            output_tail = self.handle_rsync_output(run_rsync_and_yield(rsync_command), log_file)
+                        stats = parse_rsync_stats(output_tail)
+                    if rsync_returncode:
+                        span["status"] = "error"
+                rsync_execution_time = time.time() - rsync_start_time
+                log_and_print(self.options.verbosity_level,"info","Rsync finished executing in: "+str(rsync_execution_time)+" seconds", log_file)
+
+                stats.update({"job": self.options.dataset_name, "client": client, "volume": volume, "dataset": dataset,
+                              "backup_type": self.options.backup_type, "start_time": rsync_start_time,
+                              "duration": rsync_execution_time, "returncode": rsync_returncode,
+                              "compression": compression, "compression_ratio": achieved_ratio(stats) if compression["algorithm"] != "none" else None})
+                write_stats_record(stats_record_path(log_file), stats)
+                self.metrics.count_stats(stats, volume=volume)
+                log_and_print(self.options.verbosity_level,"info","Rsync stats: "+str(stats.get("files_transferred"))+" files transferred, "+str(stats.get("literal_bytes"))+" literal bytes, "+str(stats.get("matched_bytes"))+" matched bytes, "+str(stats.get("transfer_rate"))+" bytes/sec", log_file)
+
+                if rsync_returncode == None:
+                    log_and_print(self.options.verbosity_level,"critical","Process still running!",log_file)
+                    return 1 # 1 = error
+                elif rsync_returncode == 0:
+                    log_and_print(self.options.verbosity_level,"info","Rsync finished successfully",log_file)
+                    return 0 # 0 = OK
+                elif rsync_returncode == -1:
+                    log_and_print(self.options.verbosity_level,"critical","Unhandled error",log_file)
+                    return 1 # 1 = error
+                else:
+                    log_and_print(self.options.verbosity_level,"critical","Rsync exited with an error",log_file)
+                    return 1 # 1 = error
+
+        except subprocess.SubprocessError as e:
+            log_and_print(self.options.verbosity_level,"critical", "Error while running: "+str(e.cmd), log_file)
+            return 1 # 1 = error
+
+        except Exception as e:
+
+            #The caller cleans up the snapshot on the client
+            log_and_print(self.options.verbosity_level,"critical", str(e), log_file)
+            return 1 # 1 = error
+
+
+    def previous_stats_record(self, volume, log_file):
+        """
+        Returns the stats record of the last earlier backup of a volume in the job, or None
+
+        Parameters
+        ----------
+        volume :        Full path of the logical volume
+        log_file :      The log file of the running backup of the volume, whose stats record is skipped
+
+        """
+        lv_name = volume.split("/")[3]
+        current_path = stats_record_path(log_file)
+        paths = []
+        for path in glob.glob(dataset_path(self.options.dataset_name)+"/*_"+glob.escape(lv_name)+".stats.json"):
+            #The records are named 'timestamp_type_lv.stats.json', and lv names can contain '_'
+            prefix = os.path.basename(path)[:-len("_"+lv_name+".stats.json")]
+            if path != current_path and len(prefix.split("_")) == 2:
+                paths.append(path)
+        for path in sorted(paths, reverse=True):
+            record = read_stats_record(path)
+            if record is not None:
+                return record
+        return None
+
+
+    def select_compression(self, client, volume, lv_suffix, log_file=None):
+        """
+        Picks the wire compression for a volume with --compression auto, see choose_compression.
+        How well the volume compresses is taken from the last backup: the ratio rsync achieved,
+        if it compressed, or else the estimate the last backup was based on. The client samples
+        the files in the snapshot when there is no estimate, or it is older than RESAMPLE_AFTER.
+        Returns the choice, with the estimate and where it came from, for the stats record.
+
+        Parameters
+        ----------
+        client :        Hostname or IP address of the client
+        volume :        Full path of the logical volume
+        lv_suffix :     Suffix of the snapshot
+        log_file :      The log file to write to
+
+        """
+        log_file = log_file or self.job_log_file
+
+        levels = {"none": None, "zlib": 1, "lz4": None, "zstd": 3}
+        if self.options.compression != "auto":
+            return {"algorithm": self.options.compression, "level": levels[self.options.compression], "source": "option"}
+
+        previous = self.previous_stats_record(volume, log_file) or {}
+        estimate = previous.get("compression") or {}
+        if estimate.get("estimated_ratio") is not None and time.time() - estimate.get("decided", 0) < RESAMPLE_AFTER:
+            ratio = estimate["estimated_ratio"]
+            if previous.get("compression_ratio") is not None:
+                ratio = previous["compression_ratio"]
+            (remote_version, source, decided) = (estimate.get("remote_rsync_version"), "stats", estimate["decided"])
+        else:
+            prefix = self.transfer_budget.remote_command_prefix()
+            command = " ".join(prefix) + " " + client_script_path + " sample-compression -l " + volume + " -s " + lv_suffix + " -v " + str(self.options.verbosity_level)
+            try:
+                (result, output, exit_code) = self.client_command("sample-compression", {"lv_path": volume, "snap_suffix": lv_suffix}, command, log_file, budgeted=bool(prefix))
+            except Exception as e:
+                (output, exit_code, result) = ([str(e)], EXIT_CRITICAL, None)
+            if exit_code or result is None:
+                log_and_print(self.options.verbosity_level,"warning","Unable to sample the compressibility of volume "+volume+", it is sent uncompressed: "+str(output),log_file)
+                return {"algorithm": "none", "level": None, "source": "default"}
+            self.metrics.add_spans(result.get("spans"), volume=volume)
+            (ratio, remote_version, source, decided) = (result["ratio"], result["rsync_version"], "sample", time.time())
+
+        choice = choose_compression(ratio, local_rsync_version(), tuple(remote_version) if remote_version else None, previous.get("transfer_rate"))
+        choice.update({"estimated_ratio": ratio, "source": source, "decided": decided, "remote_rsync_version": remote_version})
+        log_and_print(self.options.verbosity_level,"info","Wire compression for volume "+volume+": "+choice["algorithm"]+" (expected ratio "+str(round(ratio, 3))+", from "+source+")",log_file)
+        return choice
+
+
+    def budget_options(self, lease, snapshot_device, log_file=None):
+        """
+        Returns the rsync options that enforce the budget of the job: --bwlimit with the rate of
+        the lease, and --rsync-path to run rsync on the client with the I/O and CPU priority of the budget
+
+        Parameters
+        ----------
+        lease :             BudgetLease of the transfer
+        snapshot_device :   Path of the snapshot on the client, for the read limit of the budget
+        log_file :          The log file to write to
+
+        """
+        log_file = log_file or self.job_log_file
+        options = []
+        if lease.rate:
+            #rsync takes the limit in KiB/s
+            options.append('--bwlimit='+str(max(1, lease.rate // 1024)))
+            log_and_print(self.options.verbosity_level,"info","Bandwidth limit: "+str(lease.rate)+" bytes/sec, after waiting "+str(round(lease.waited))+" seconds for it",log_file)
+        prefix = self.transfer_budget.remote_command_prefix(snapshot_device)
+        if prefix:
+            options.append('--rsync-path='+" ".join(prefix + ['rsync']))
+        return options
+
+
+    def plan_volume_shards(self, transfer_options, dataset, lv_name, log_file=None):
+        """
+        Splits a volume into --shards parts of about the same weight, for rsync streams that run
+        at the same time. The weights are taken from the copy of the volume in the previous backup:
+        the dataset itself for diff and inc backups, since it is a clone, or else the last backup in
+        the catalog. Without a previous copy, only the top level of the snapshot is listed.
+        Returns the filter rules of each shard, or an empty list if the volume is not split.
+
+        Parameters
+        ----------
+        transfer_options :  The '-e', source and destination arguments for rsync
+        dataset :           Name of the ZFS dataset the volume is backed up into
+        lv_name :           Name of the logical volume
+        log_file :          The log file to write to
+
+        """
+        log_file = log_file or self.job_log_file
+
+        previous_copy = dataset_path(dataset)+"/"+lv_name
+        if dataset.endswith("_full"):
+            previous_backup = self.catalog.last_backup()
+            previous_copy = dataset_path(previous_backup["dataset"])+"/"+lv_name if previous_backup else None
+        if previous_copy and os.path.isdir(previous_copy) and os.listdir(previous_copy):
+            log_and_print(self.options.verbosity_level,"info","Scanning "+previous_copy+" to split the volume into shards",log_file)
+            tree = scan_tree(previous_copy)
+        else:
+            log_and_print(self.options.verbosity_level,"info","No previous copy of the volume. Splitting it into shards by its top level",log_file)
+            listing = subprocess.run(['rsync', '--list-only'] + transfer_options[:3], encoding='utf-8', errors='surrogateescape', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if listing.returncode:
+                log_and_print(self.options.verbosity_level,"warning","Unable to list the volume, it is copied with a single rsync: "+listing.stderr,log_file)
+                return []
+            tree = list_only_tree(listing.stdout.splitlines())
+
+        shard_rules = plan_shards(tree, self.options.shards)
+        if not shard_rules:
+            log_and_print(self.options.verbosity_level,"info","The volume is too small to split, it is copied with a single rsync",log_file)
+        else:
+            log_and_print(self.options.verbosity_level,"info","Volume split into "+str(len(shard_rules))+" shards",log_file)
+        return shard_rules
+
+
+    def run_rsync_shards(self, rsync_command, transfer_options, shard_rules, snapshot_device, log_file=None):
+        """
+        Runs one rsync per shard at the same time, each with the filter rules of its shard, and
+        logs their combined progress every PROGRESS_INTERVAL seconds. Other output is written to
+        the log file, marked with the number of the shard.
+        Returns a tuple with the exit code, the first non-zero exit code of the shards or 0,
+        and the stats of the shards added up.
+
+        Parameters
+        ----------
+        rsync_command :     The rsync command and options, without the transfer options
+        transfer_options :  The '-e', source and destination arguments for rsync
+        shard_rules :       The filter rules of each shard, from plan_volume_shards
+        snapshot_device :   Path of the snapshot on the client, for the read limit of the budget
+        log_file :          The log file to write to
+
+        """
+        log_file = log_file or self.job_log_file
+
+        progress = [None] * len(shard_rules)
+        progress_lock = threading.Lock()
+        next_progress_time = [time.time() + PROGRESS_INTERVAL]
+
+        def log_progress():
+            #Called with progress_lock held
+            if time.time() < next_progress_time[0]:
+                return
+            next_progress_time[0] = time.time() + PROGRESS_INTERVAL
+            running = [shard for shard in progress if shard is not None]
+            log_and_print(self.options.verbosity_level,"info","Rsync progress: "+str(sum(shard["bytes"] for shard in running))+" bytes, "
+                          +str(sum(shard.get("files_transferred", 0) for shard in running))+" files transferred, shards at "
+                          +", ".join(str(shard["percent"])+"%" for shard in running),log_file)
+
+        def run_shard(number, filter_path):
+            output_tail = collections.deque(maxlen=40)
+            with self.transfer_budget.lease() as lease, self.metrics.span("rsync_shard", volume=snapshot_device[:-len(self.lv_suffix)], shard=number) as span:
+                rsync_process = subprocess.Popen(rsync_command + self.budget_options(lease, snapshot_device, log_file) + ['--filter=. '+filter_path] + transfer_options,
+                                                 encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+                for output in iter(rsync_process.stdout.readline, ""):
+                    shard_progress = parse_progress2_line(output)
+                    if shard_progress is None:
+                        if output.strip():
+                            write_log("[shard "+str(number)+"] "+output, log_file)
+                            output_tail.append(output)
+                    else:
+                        with progress_lock:
+                            progress[number] = shard_progress
+                            log_progress()
+                rsync_process.stdout.close()
+                returncode = rsync_process.wait()
+                if returncode:
+                    span["status"] = "error"
+            return (returncode, parse_rsync_stats(output_tail))
+
+        filter_paths = []
+        try:
+            for rules in shard_rules:
+                (fd, filter_path) = tempfile.mkstemp(prefix="zfsync-shard-", suffix=".rules")
+                with open(fd, "w", encoding="utf-8", errors="surrogateescape") as filter_file:
+                    filter_file.write("\n".join(rules)+"\n")
+                filter_paths.append(filter_path)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(shard_rules)) as executor:
+                results = list(executor.map(run_shard, range(len(shard_rules)), filter_paths))
+        finally:
+            for filter_path in filter_paths:
+                os.remove(filter_path)
+
+        for number, (returncode, stats) in enumerate(results):
+            log_and_print(self.options.verbosity_level,"info" if not returncode else "critical","Shard "+str(number)+" exited with exit code "+str(returncode)+": "+str(stats.get("files_transferred"))+" files transferred",log_file)
+        stats = sum_stats([stats for (returncode, stats) in results])
+        stats["shards"] = len(results)
+        return (next((returncode for (returncode, stats) in results if returncode), 0), stats)
+
+
+    def block_transfer_files(self, client, volume, lv_suffix, dataset, log_file=None):
+        """
+        Copies the blocks of the volume's snapshot that have changed since the last backup into
+        an image file in the dataset. The client hashes the snapshot device in blocks and compares
+        them with the block manifest that is stored next to the image; only the changed blocks are
+        sent. For diff and inc backups the dataset is a clone, so the image and manifest of the base
+        backup are already there. Returns 0 if OK, or 1 on error.
+
+        Parameters
+        ----------
+        client :        Hostname or IP address of the client
+        volume :        Full path of the logical volume
+        lv_suffix :     Suffix of the snapshot
+        dataset :       Name of the ZFS dataset the image is stored in
+        log_file :      The log file to write to
+
+        """
+        log_file = log_file or self.job_log_file
+
+        log_and_print(self.options.verbosity_level,"info", "block_transfer_files function invoked with parameters:", log_file)
+        log_and_print(self.options.verbosity_level,"info", "volume = "+volume, log_file)
+        log_and_print(self.options.verbosity_level,"info", "dataset = "+dataset, log_file)
+
+        lv_name = volume.split("/")[3]
+        image_path = dataset_path(dataset)+"/"+lv_name+".img"
+        manifest_path = dataset_path(dataset)+"/"+lv_name+".blockmap"
+        manifest_data = b""
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, "rb") as manifest:
+                manifest_data = manifest.read()
+
+        transfer_start_time = time.time()
+        lease = self.transfer_budget.lease()
+        command = " ".join(self.transfer_budget.remote_command_prefix(volume+lv_suffix) + [client_script_path + " block-send -l " + volume + " -s " + lv_suffix + " -b " + str(self.options.block_size) + " -v " + str(self.options.verbosity_level)])
+        if lease.rate:
+            command += " --bwlimit " + str(lease.rate)
+            log_and_print(self.options.verbosity_level,"info","Bandwidth limit: "+str(lease.rate)+" bytes/sec, after waiting "+str(round(lease.waited))+" seconds for it",log_file)
+        try:
+            (ssh_stdin, ssh_stdout, ssh_stderr) = self.ssh_connections.open_command(client, ssh_user, command, self.metrics)
+            #Drain stderr in the background, so a chatty client can not stall the stream
+            stderr_lines = []
+            stderr_reader = threading.Thread(target=lambda: stderr_lines.extend(ssh_stderr.readlines()), daemon=True)
+            stderr_reader.start()
+            ssh_stdin.write(manifest_data)
+            ssh_stdin.flush()
+            ssh_stdin.channel.shutdown_write()
+            result = receive_changed_blocks(ssh_stdout, image_path, manifest_path)
+            exit_code = ssh_stdout.channel.recv_exit_status()
+            stderr_reader.join()
+        except Exception as e:
+            log_and_print(self.options.verbosity_level,"critical","Block transfer failed for volume "+volume+": "+str(e),log_file)
+            return 1 # 1 = error
+        finally:
+            lease.release()
+        transfer_time = time.time() - transfer_start_time
+
+        for line in stderr_lines:
+            write_log(line if isinstance(line, str) else line.decode('utf-8', 'replace'), log_file)
+        if exit_code:
+            log_and_print(self.options.verbosity_level,"critical","block-send exited with exit code "+str(exit_code),log_file)
+            return 1 # 1 = error
+
+        unchanged_bytes = result["device_size"] - result["bytes_received"]
+        stats = {"job": self.options.dataset_name, "client": client, "volume": volume, "dataset": dataset,
+                 "backup_type": self.options.backup_type, "start_time": transfer_start_time, "duration": transfer_time,
+                 "returncode": exit_code, "transfer_mode": "block", "block_size": result["block_size"],
+                 "blocks_transferred": result["blocks_received"], "total_file_size": result["device_size"],
+                 "literal_bytes": result["bytes_received"], "matched_bytes": unchanged_bytes,
+                 "transfer_rate": result["bytes_received"] / transfer_time if transfer_time else None}
+        write_stats_record(stats_record_path(log_file), stats)
+        self.metrics.count_stats(stats, volume=volume)
+        log_and_print(self.options.verbosity_level,"info","Block transfer finished in "+str(transfer_time)+" seconds: "+str(result["blocks_received"])+" changed blocks, "+str(result["bytes_received"])+" bytes",log_file)
+        return 0 # 0 = OK
+
+
+    def handle_rsync_output(self, output_lines, log_file):
+        """
+        Echoes or logs the output of rsync, and returns the last lines of output, which
+        hold the '--stats' block. With --progress-mode 'lines' every line is printed, or
+        written to the volume's log file when volumes run in parallel or the job does not
+        echo its output. With 'aggregate'
+        the progress lines are only parsed, and a progress message is logged every
+        PROGRESS_INTERVAL seconds. Other lines, like errors, are written to the log file.
+
+        Parameters
+        ----------
+        output_lines :  Iterator over the lines of output from rsync
+        log_file :      The log file of the volume
+
+        """
+
+        output_tail = collections.deque(maxlen=40)
+        if self.options.progress_mode == "aggregate":
+            next_progress_time = time.time() + PROGRESS_INTERVAL
+            for output in output_lines:
+                progress = parse_progress2_line(output)
+                if progress is None:
+                    if output.strip():
+                        write_log(output, log_file)
+                        output_tail.append(output)
+                elif time.time() >= next_progress_time:
+                    next_progress_time = time.time() + PROGRESS_INTERVAL
+                    log_and_print(self.options.verbosity_level,"info","Rsync progress: "+str(progress["bytes"])+" bytes, "+str(progress["percent"])+"%, "+progress["rate"]+", "+str(progress.get("files_transferred"))+" files transferred",log_file)
+        elif self.options.parallel > 1 or not self.echo_output:
+            #Output from parallel rsyncs, or from jobs that share the process, would be interleaved on stdout,
+            #so it goes to the volume's log file instead
+            for output in output_lines:
+                write_log(output, log_file)
+                output_tail.append(output)
+        else:
+            for output in output_lines:
+                print(output, end="")
+                output_tail.append(output)
+        return list(output_tail)
+
+
+    def create_dataset(self, root_dataset_name, backup_type):
+
+        """
+        This function creates a ZFS dataset.
+        The function takes two parameters: root_dataset_name, and backup_type
+        The root dataset for the backup job must already exist, or else this function will fail and exit.
+        The function returns a return code and the name of the new dataset.
+        Return code = 0 = OK
+        Return code = 1 = Fail
+
+        Parameters
+        ----------
+        root_dataset_name : Should be the ZFS name for the root dataset of the backup job.
+                            The new dataset for this backup will be created here
+
+        backup_type :   is either 'full', 'diff', or 'inc'
+                        If backup type == 'full', a new empty dataset is created under the specified root_dataset_name
+                        If backup_type == 'diff', a clone is made from the last successful full backup
+                        If backup_type == 'inc' a clone from the previous successful backup is made, regardless of type
+                        The previous backups are looked up in the backup catalog of the job
+
+        """
+
+        log_and_print(self.options.verbosity_level,"info", "create_dataset function invoked with parameters:", self.job_log_file)
+        log_and_print(self.options.verbosity_level,"info", "root_dataset_name = "+root_dataset_name, self.job_log_file)
+        log_and_print(self.options.verbosity_level,"info", "backup_type = "+backup_type, self.job_log_file)
+
+        #Look up the base for the new backup in the backup catalog
+        if backup_type == "diff":
+            base_backup = self.catalog.last_backup("full")
+        else:
+            base_backup = self.catalog.last_backup()
+        if base_backup is None:
+            #If there are no previous backups to use as a base, we will force a full backup
+            if backup_type != "full":
+                log_and_print(self.options.verbosity_level,"info","No previous backups. backup_type forced to 'full'", self.job_log_file)
+            backup_type = "full"
+
+        if backup_type == "full":
+            new_dataset_name = root_dataset_name +'/' + self.time_now + "_full"
+            with self.metrics.span("zfs_create") as span:
+                new_dataset = subprocess.run(['zfs', 'create','-p', new_dataset_name],encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                if new_dataset.stderr:
+                    span["status"] = "error"
+            if new_dataset.stderr:
+                log_and_print(self.options.verbosity_level,"critical",new_dataset.stderr, self.job_log_file)
+                return 1,""
+            else:
+                log_and_print(self.options.verbosity_level,"info", "New dataset created successfuly: " + new_dataset_name, self.job_log_file)
+                self.catalog.add_backup(new_dataset_name, "full", self.time_now)
+                return 0,new_dataset_name
+
+        elif backup_type in ("diff", "inc"):
+            #diff is cloned from the last full backup, inc from the last backup of any type
+            returncode, new_dataset_name = self.snap_and_clone_dataset(base_backup["dataset"],backup_type)
+            if returncode:
+                log_and_print(self.options.verbosity_level,"critical", "Error while snapshoting and cloning dataset", self.job_log_file)
+                return returncode,""
+            else:
+                log_and_print(self.options.verbosity_level,"info", "Snaphot and clone successful", self.job_log_file)
+                self.catalog.add_backup(new_dataset_name, backup_type, self.time_now, base_backup["dataset"]+'@'+self.time_now+"_snap")
+                return returncode,new_dataset_name
+
+        else:
+            log_and_print(self.options.verbosity_level,"critical", "Backup type does not have a valid value", self.job_log_file)
+            return 1,""
+
+    def snap_and_clone_dataset(self, dataset_name,backup_type):
+        """
+        This function creates a ZFS snapshot of specified dataset and makes a clone
+        of that snapshot. The function returns a return code and the name of the new dataset.
+        Return code = 0 = OK
+        Return code = 1 = Fail
+        The function takes two parameters: dataset_name and backup_type
+
+        Parameters
+        ----------
+        dataset_name :  Should be the ZFS name for the dataset to be snapshotted and
+                        cloned. Will be on the form "backup/jobname/datetime_backuptype"
+        backup_type :   Should be either 'diff' or 'inc'. Will be appended to the name
+                        of the new dataset to mark what type of backup it contains
+
+        """
+
+        log_and_print(self.options.verbosity_level,"info", "snap_and_clone_dataset function invoked with parameters:", self.job_log_file)
+        log_and_print(self.options.verbosity_level,"info", "dataset_name = "+dataset_name, self.job_log_file)
+        log_and_print(self.options.verbosity_level,"info", "backup_type = "+backup_type, self.job_log_file)
+
+        root_backup_dataset_name = dataset_name.split("/")[0]+"/"+dataset_name.split("/")[1]
+
+        snapshot_name = dataset_name +'@' + self.time_now + "_snap"
+        clone_name = root_backup_dataset_name + '/' + self.time_now + "_" +backup_type
+
+        #Take snapshot
+        with self.metrics.span("zfs_snapshot") as span:
+            snap = subprocess.run(['zfs', 'snapshot', snapshot_name],encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if snap.stderr:
+                span["status"] = "error"
+        if snap.stderr:
+            log_and_print(self.options.verbosity_level,"critical", snap.stderr, self.job_log_file)
+            return 1,""
+        else:
+            log_and_print(self.options.verbosity_level,"info", "Snapshot created: " +snapshot_name, self.job_log_file)
+        #Make clone
+        with self.metrics.span("zfs_clone") as span:
+            clone = subprocess.run(['zfs', 'clone', snapshot_name, clone_name],encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if clone.stderr:
+                span["status"] = "error"
+        if clone.stderr:
+            log_and_print(self.options.verbosity_level,"critical", clone.stderr, self.job_log_file)
+            return 1,""
+        else:
+            log_and_print(self.options.verbosity_level,"info", "Clone created: " +clone_name, self.job_log_file)
+            return 0,clone_name
+
+
+    def initiate_client(self, client, username,lv_path,lv_suffix,log_file=None):
+        """
+        This function initiates a backup on a client by calling 'client_backup.py' on
+        the client, see client_command. The function returns the result from the client,
+        the lines of output, and the exit code.
+        The function takes five parameters: client, username, lv_path, lv_suffix and log_file
+        Errors are returned as a non-zero exit code, so that the caller can clean up
+
+        Parameters
+        ----------
+        client :        Hostname or IP address of the client where we want to initiate
+                        a backup
+        username :      The username that we will be used to connect to the client.
+        lv_path:             The path to the logical volume to be snapshotted
+        lv_suffix:      Suffix to add to the snapshot name
+        log_file:       The log file to write to. Defaults to the log file of the backup job
+
+        """
+        log_file = log_file or self.job_log_file
+
+        log_and_print(self.options.verbosity_level,"info", "initiate_client function invoked with parameters:", log_file)
+        log_and_print(self.options.verbosity_level,"info", "client= "+client, log_file)
+        log_and_print(self.options.verbosity_level,"info", "username = "+username, log_file)
+        log_and_print(self.options.verbosity_level,"info", "lv_path = "+lv_path, log_file)
+        log_and_print(self.options.verbosity_level,"info", "lv_suffix = "+lv_suffix, log_file)
+
+        try:
+            with self.metrics.span("initiate_client", volume=lv_path) as span:
+                (result, output, exit_code) = self.client_command("snapshot", {"lv_paths": [lv_path], "snap_suffix": lv_suffix, "mount": self.options.transfer_mode != "block"},
+                                                                  client_script_path + " initiate-backup -o json" + self.snapshot_options() + " -l " + lv_path + " -s "+lv_suffix +" -v "+str(self.options.verbosity_level), log_file)
+                if exit_code:
+                    span["status"] = "error"
+            if result is not None:
+                self.metrics.add_spans(result.get("spans"), volume=lv_path)
+            if exit_code:
+
+
+                log_and_print(self.options.verbosity_level,"critical","Output:" +str(output), log_file)
+            else:
+                log_and_print(self.options.verbosity_level,"info",str(output),log_file)
+            return (result, output, exit_code)
+
+        except Exception as e:
+
+            log_and_print(self.options.verbosity_level,"critical","Unable to initiate client", log_file)
+            log_and_print(self.options.verbosity_level,"critical", str(e), log_file)
+            return (None, [str(e)], EXIT_CRITICAL)
+
+
+    def end_client(self, client, username,lv_path,lv_suffix,log_file=None):
+
+        """
+        This function ends a backup on a client by calling 'client_backup.py' on
+        the client. 'client_backup.py' then unmounts the specified snapshot and deletes it on the client
+        The command is run with client_command. The function returns the result from the client,
+        the lines of output, and the exit code.
+        The function takes five parameters: client, username, lv_path, lv_suffix and log_file
+        Errors are returned as a non-zero exit code, so that the caller can clean up
+
+        Parameters
+        ----------
+        client :        Hostname or IP address of the client where we want to initiate
+                        a backup
+        username :      The username that we will be used to connect to the client.
+        lv_path:        The path to the logical volume snapshot
+        lv_suffix:      Suffix of the snapshot
+        log_file:       The log file to write to. Defaults to the log file of the backup job
+
+        """
+        log_file = log_file or self.job_log_file
+
+        log_and_print(self.options.verbosity_level,"info", "end_client function invoked with parameters:", log_file)
+        log_and_print(self.options.verbosity_level,"info", "client= "+client, log_file)
+        log_and_print(self.options.verbosity_level,"info", "username = "+username, log_file)
+        log_and_print(self.options.verbosity_level,"info", "lv_path = "+lv_path, log_file)
+        log_and_print(self.options.verbosity_level,"info", "lv_suffix = "+lv_suffix, log_file)
+
+        try:
+            with self.metrics.span("end_client", volume=lv_path) as span:
+                (result, output, exit_code) = self.client_command("cleanup", {"lv_paths": [lv_path], "snap_suffix": lv_suffix},
+                                                                  client_script_path + " end-backup -o json -l " + lv_path + " -s "+lv_suffix+" -v "+str(self.options.verbosity_level), log_file)
+                if exit_code:
+                    span["status"] = "error"
+            if result is not None:
+                self.metrics.add_spans(result.get("spans"), volume=lv_path)
+            if exit_code:
+
+                log_and_print(self.options.verbosity_level,"critical", str(output), log_file)
+            else:
+                log_and_print(self.options.verbosity_level,"info",str(output),log_file)
+            return (result, output, exit_code)
+
+        except Exception as e:
+
+            log_and_print(self.options.verbosity_level,"critical", str(e), log_file)
+            return (None, [str(e)], EXIT_CRITICAL)
+
+
+    def start_agent(self):
+        """
+        Starts the agent on the client, that runs the control commands of the job, see ClientAgent.
+        If it can not be started, the job starts client_backup.py for each command instead.
+
+        """
+        agent = ClientAgent(self.ssh_connections, self.options.client, ssh_user, client_script_path + " agent -v " + str(self.options.verbosity_level), self.metrics)
+        try:
+            with self.metrics.span("agent_start"):
+                greeting = agent.start()
+            log_and_print(self.options.verbosity_level,"info","Agent started on the client, pid "+str(greeting.get("pid")),self.job_log_file)
+            self.agent = agent
+        except Exception as e:
+            log_and_print(self.options.verbosity_level,"warning","Unable to start the agent on the client, client_backup.py is started for each command: "+str(e),self.job_log_file)
+
+
+    def client_command(self, method, params, command, log_file=None, budgeted=False):
+        """
+        Runs a control command on the client: as a request to the agent of the job, or else by
+        starting client_backup.py with 'command'. Commands with the budget of the job in front
+        (see remote_command_prefix) are always started on their own, so they run with the budget.
+        So are the WALKING_METHODS: the agent serves one request at a time, and a walk of one volume
+        would hold up the commands of all the other volumes, like their snapshots and cleanups.
+        If the agent stops, the job goes on without it.
+        Returns a tuple with the result from the client, or None if there is none, the lines of
+        output, and the exit code. Errors from SSH are raised, like from exec_command.
+
+        Parameters
+        ----------
+        method :    Name of the method of the agent, like 'snapshot'
+        params :    Dictionary with the parameters of the method
+        command :   The same command as a command line for client_backup.py
+        log_file :  The log file to write to
+        budgeted :  True if 'command' starts with the budget of the job
+
+        """
+        log_file = log_file or self.job_log_file
+        agent = self.agent
+        if agent is not None and not budgeted and method not in WALKING_METHODS:
+            try:
+                return agent.call(method, **params)
+            except AgentError as e:
+                log_and_print(self.options.verbosity_level,"warning","The agent on the client stopped, client_backup.py is started for each command: "+str(e),log_file)
+                agent.close()
+                self.agent = None
+        (stdout, stderr, exit_code) = self.ssh_connections.exec_command(self.options.client, ssh_user, command, self.metrics)
+        return (parse_result(stdout), stdout + stderr, exit_code)
+
+
+    def check_last_backup_status(self, root_dataset_name):
+        """
+        Checks the status from the last run of the bacup. Will return status and date of last
+        backup, date of last successful backup. If there are no last backups, or no successful
+        backups, the return value will be None
+        The status is read from the status journal, /backup/jobname/status.txt, without
+        reading through the whole history.
+
+        Parameters
+        ----------
+        root_dataset_name :         Name of the ZFS root dataset for backupjob to check
+                                    Example: 'backup/job1'
+
+        """
+
+        log_and_print(self.options.verbosity_level,"info", "check_last_backup_status function invoked with parameters:", self.job_log_file)
+        log_and_print(self.options.verbosity_level,"info", "root_dataset_name= "+root_dataset_name, self.job_log_file)
+
+        last_successful_date = None
+        last_backup_date = None
+        last_backup_status = None
+
+        journal = StatusJournal(root_dataset_name)
+        last_record = journal.last_status()
+        if last_record is not None:
+            last_backup_status = last_record[0]
+            last_backup_date = last_record[1].split("_")[0]
+        last_success = journal.last_success()
+        if last_success is not None:
+            last_successful_date = last_success[1].split("_")[0]
+
+        return last_successful_date, last_backup_date, last_backup_status
+
+
+    def export_metrics(self, job_start_time, exit_code):
+        """
+        Adds the span of the whole job, and writes the spans and counters of the run as JSON next to
+        the job log, and as a Prometheus textfile in --metrics-dir. Failures are only logged, so
+        that they never change the outcome of the backup.
+
+        Parameters
+        ----------
+        job_start_time :    Time the job was started
+        exit_code :         Exit code of the job
+
+        """
+        self.metrics.add_spans([{"phase": "job", "start": job_start_time, "duration": time.time() - job_start_time,
+                            "status": "ok" if exit_code == EXIT_OK else "error"}])
+        if not os.path.isdir(dataset_path(self.options.dataset_name)):
+            return
+        try:
+            self.metrics.write_json(os.path.splitext(self.job_log_file)[0] + ".metrics.json")
+            self.metrics.write_prometheus(self.options.dataset_name.replace("/", "_"), self.options.metrics_dir)
+        except OSError as e:
+            log_and_print(self.options.verbosity_level,"warning","Unable to write the metrics of the job: "+str(e),main_log_file)
@@ -0,0 +1,143 @@
+#! /usr/bin/env python3.6
+
+import argparse, glob, os, subprocess, sys
+from shared_functions import *
+from backup_catalog import open_catalog
+from rsync_stats import read_stats_record
+
+FULL_CHANGE_RATIO = 0.6 #Take a full backup when a diff would transfer this share of what a full backup transfers
+CHEAP_DIFF_RATIO = 1.5 #Take a diff instead of an inc when it would transfer at most this many times the bytes of an inc
+DEFAULT_MAX_INCS = 13 #Inc backups in a row before a diff, for jobs without a diff_every
+
+def backup_chain(catalog, backup):
+    """
+    Returns the backups that a backup was cloned from, following the parent snapshots in the
+    catalog, as a list that starts with the backup and ends with the full backup at the root of
+    the chain. The list ends early if a parent is not in the catalog.
+
+    """
+    chain = [backup]
+    while chain[-1]["parent_snapshot"] and len(chain) <= 10000:
+        parent = catalog.get_backup(chain[-1]["parent_snapshot"].split("@", 1)[0])
+        if parent is None:
+            break
+        chain.append(parent)
+    return chain
+
+
+def zfs_properties(dataset, properties):
+    """
+    Returns a dictionary with the numeric ZFS properties of a dataset, like 'referenced' or
+    'written@backup/job1/2019-01-01T01-00-00_full@2019-01-02T01-00-00_snap'.
+    Returns an empty dictionary if they can not be read.
+
+    """
+    process = subprocess.run(['zfs', 'get', '-H', '-p', '-o', 'property,value', ",".join(properties), dataset], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode:
+        return {}
+    values = {}
+    for line in process.stdout.splitlines():
+        (name, value) = line.split("\t")
+        if value.isdigit():
+            values[name] = int(value)
+    return values
+
+
+def transferred_bytes(root_dataset_name, backup):
+    """
+    Returns the bytes that rsync or the block transfer sent for a backup, summed over the stats
+    records of its volumes, or None if it has no stats records
+
+    """
+    paths = glob.glob(dataset_path(root_dataset_name)+"/"+glob.escape(backup["timestamp"]+"_"+backup["backup_type"])+"_*.stats.json")
+    records = [record for record in (read_stats_record(path) for path in paths) if record is not None]
+    if not records:
+        return None
+    return sum(record.get("literal_bytes") or 0 for record in records)
+
+
+def plan_backup_type(catalog, root_dataset_name, diff_every=0, full_every=0):
+    """
+    Picks the type of the next backup of a job, for '-t auto'. Returns a dictionary with the
+    backup type, the reason, the estimated bytes to transfer for each type and the depth of the
+    clone chain of the last backup. The policy of the job comes first: a full backup after
+    full_every - 1 backups since the last full, and a diff after diff_every - 1 inc backups in a
+    row, like the scheduler's run counters would (DEFAULT_MAX_INCS without a diff_every). Between
+    those, the estimates decide:
+    * full, when a diff would transfer FULL_CHANGE_RATIO of a full backup: the full backup costs
+      little more, and starts a new chain
+    * diff, when it would transfer at most CHEAP_DIFF_RATIO times an inc: the chain gets shorter
+      for little more than an inc costs
+    * inc otherwise
+    A diff is estimated with 'written@' the snapshot the chain was cloned from, on the last backup:
+    what changed since the full backup, plus an inc. An inc is estimated from the bytes the last
+    inc transferred, and a full from 'referenced' of the last backup. Unknown estimates are left
+    out of the decision.
+
+    Parameters
+    ----------
+    catalog :               BackupCatalog of the job
+    root_dataset_name :     ZFS name of the root dataset of the backup job
+    diff_every :            diff_every of the schedule in the job file. 0 means no policy
+    full_every :            full_every of the schedule in the job file. 0 means no policy
+
+    """
+    last = catalog.last_backup()
+    last_full = catalog.last_backup("full")
+    plan = {"backup_type": "inc", "reason": "", "estimates": {"full": None, "diff": None, "inc": None}, "chain_depth": 0}
+    if last is None or last_full is None:
+        plan.update(backup_type="full", reason="there is no full backup to start from")
+        return plan
+
+    chain = backup_chain(catalog, last)
+    plan["chain_depth"] = len(chain) - 1
+    incs_in_a_row = 0
+    while incs_in_a_row < len(chain) and chain[incs_in_a_row]["backup_type"] == "inc":
+        incs_in_a_row += 1
+    since_full = len([backup for backup in catalog.backups() if backup["timestamp"] > last_full["timestamp"] and backup["status"] in ("successful", "unknown")])
+
+    #The estimates
+    properties = ["referenced"]
+    if len(chain) > 1 and chain[-2]["parent_snapshot"]:
+        properties.append("written@" + chain[-2]["parent_snapshot"])
+    values = zfs_properties(last["dataset"], properties)
+    last_inc = catalog.last_backup("inc")
+    inc_bytes = transferred_bytes(root_dataset_name, last_inc) if last_inc is not None else None
+    full_bytes = values.get("referenced")
+    if len(chain) == 1:
+        diff_bytes = inc_bytes #The last backup is the full backup, so a diff is an inc
+    elif len(properties) > 1 and properties[1] in values and inc_bytes is not None:
+        diff_bytes = values[properties[1]] + inc_bytes
+    else:
+        diff_bytes = None
+    plan["estimates"] = {"full": full_bytes, "diff": diff_bytes, "inc": inc_bytes}
+
+    if full_every and since_full >= full_every - 1:
+        plan.update(backup_type="full", reason=str(since_full)+" backups since the last full backup, full_every is "+str(full_every))
+    elif chain[-1]["dataset"] != last_full["dataset"]:
+        plan.update(backup_type="full", reason="the last backup is not cloned from the last full backup")
+    elif full_bytes and diff_bytes is not None and diff_bytes >= FULL_CHANGE_RATIO * full_bytes:
+        plan.update(backup_type="full", reason="a diff would transfer "+str(diff_bytes)+" of "+str(full_bytes)+" bytes")
+    elif incs_in_a_row >= (diff_every - 1 if diff_every else DEFAULT_MAX_INCS):
+        plan.update(backup_type="diff", reason=str(incs_in_a_row)+" inc backups in a row"+(", diff_every is "+str(diff_every) if diff_every else ""))
+    elif len(chain) > 1 and diff_bytes is not None and inc_bytes is not None and diff_bytes <= CHEAP_DIFF_RATIO * inc_bytes:
+        plan.update(backup_type="diff", reason="a diff would transfer "+str(diff_bytes)+" bytes, an inc about "+str(inc_bytes))
+    else:
+        plan.update(reason="chain depth "+str(plan["chain_depth"])+", "+str(incs_in_a_row)+" inc backups in a row")
+    return plan
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Show which backup type '-t auto' would pick for the next backup of a backup job, and why.")
+    arg_parser.add_argument("root_dataset_name", help="Name of the root dataset of the backup job. Example: backup/job1")
+    arg_parser.add_argument('--diff-every', type=int, default=0, help='diff_every of the schedule in the job file')
+    arg_parser.add_argument('--full-every', type=int, default=0, help='full_every of the schedule in the job file')
+    arguments = arg_parser.parse_args()
+    if not os.path.isdir(dataset_path(arguments.root_dataset_name)):
+        print("Backup job "+arguments.root_dataset_name+" does not exist")
+        sys.exit(EXIT_CRITICAL)
+    plan = plan_backup_type(open_catalog(arguments.root_dataset_name), arguments.root_dataset_name, arguments.diff_every, arguments.full_every)
+    print(plan["backup_type"]+": "+plan["reason"])
+    print("chain depth: "+str(plan["chain_depth"]))
+    for (backup_type, estimate) in sorted(plan["estimates"].items()):
+        print("estimated bytes for "+backup_type+": "+("unknown" if estimate is None else str(estimate)))
@@ -0,0 +1,177 @@
+#! /usr/bin/env python3
+"""
+Creates and changes the synthetic directory trees and volume images that the benchmarks back up.
+Everything is seeded, so the same profile and seed always give the same bytes.
+
+"""
+
+import argparse, os, random, sys
+
+#files: number of files, size: (smallest, largest) file size in bytes, fanout: entries per directory
+TREE_PROFILES = {
+    "small-files": {"files": 20000, "size": (512, 16 * 1024), "fanout": 100},
+    "large-files": {"files": 40, "size": (16 * 1024**2, 64 * 1024**2), "fanout": 10},
+    "mixed": {"files": 5000, "size": (1024, 4 * 1024**2), "fanout": 50},
+}
+#changed: share of the files rewritten, created: new files as a share of the tree,
+#deleted: share of the files removed, append: share of the files that grow by a tenth
+CHURN_PROFILES = {
+    "light": {"changed": 0.01, "created": 0.005, "deleted": 0.002, "append": 0.0},
+    "heavy": {"changed": 0.2, "created": 0.05, "deleted": 0.05, "append": 0.0},
+    "append": {"changed": 0.0, "created": 0.001, "deleted": 0.0, "append": 0.2},
+}
+WORDS = [b"backup", b"volume", b"snapshot", b"dataset", b"rsync", b"client", b"server", b"retention",
+         b"the", b"of", b"and", b"to", b"in", b"is", b"for", b"with", b"0", b"1", b"42", b"\n"]
+
+def file_content(generator, size, compressible):
+    """
+    Returns size bytes of data: text made of WORDS, which compresses to about a third,
+    or random bytes that do not compress at all
+
+    """
+    if not compressible:
+        return generator.getrandbits(size * 8).to_bytes(size, "little") if size else b""
+    content = bytearray()
+    while len(content) < size:
+        content += b" ".join(generator.choice(WORDS) for i in range(64)) + b" "
+    return bytes(content[:size])
+
+def file_path(root_path, number, fanout):
+    """
+    Returns the path of file number 'number', in a tree of directories with fanout entries each
+
+    """
+    directories = []
+    position = number // fanout
+    while position:
+        directories.append("d%d" % (position % fanout))
+        position //= fanout
+    return os.path.join(root_path, *reversed(directories), "f%d" % number)
+
+def tree_files(root_path):
+    paths = []
+    for (directory, directories, files) in os.walk(root_path):
+        directories.sort()
+        paths.extend(os.path.join(directory, name) for name in sorted(files))
+    return paths
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as new_file:
+        new_file.write(content)
+
+def generate_tree(root_path, profile, seed, compressible=True, scale=1.0):
+    """
+    Fills root_path with the files of a profile from TREE_PROFILES. Returns the number of
+    files and bytes written.
+
+    Parameters
+    ----------
+    root_path :     The directory to fill, like the files of a logical volume
+    profile :       Name of a profile in TREE_PROFILES
+    seed :          Seed for the sizes and the content
+    compressible :  Text content if True, random bytes if False
+    scale :         Factor for the number of files, to make quicker or bigger runs
+
+    """
+    settings = TREE_PROFILES[profile]
+    generator = random.Random(seed)
+    total = 0
+    count = max(1, int(settings["files"] * scale))
+    for number in range(count):
+        size = generator.randint(*settings["size"])
+        write_file(file_path(root_path, number, settings["fanout"]), file_content(generator, size, compressible))
+        total += size
+    return (count, total)
+
+def churn_tree(root_path, profile, seed, compressible=True):
+    """
+    Changes the files in root_path the way a profile from CHURN_PROFILES says. Returns a dictionary
+    with the number of files changed, created, deleted and appended to, and the bytes written.
+
+    """
+    settings = CHURN_PROFILES[profile]
+    generator = random.Random(seed)
+    paths = tree_files(root_path)
+    counts = {"changed": 0, "created": 0, "deleted": 0, "appended": 0, "bytes": 0}
+    if not paths:
+        return counts
+    for path in generator.sample(paths, int(len(paths) * settings["changed"])):
+        size = os.path.getsize(path)
+        write_file(path, file_content(generator, size, compressible))
+        counts["changed"] += 1
+        counts["bytes"] += size
+    for path in generator.sample(paths, int(len(paths) * settings["append"])):
+        size = max(1, os.path.getsize(path) // 10)
+        with open(path, "ab") as appended_file:
+            appended_file.write(file_content(generator, size, compressible))
+        counts["appended"] += 1
+        counts["bytes"] += size
+    sizes = [os.path.getsize(path) for path in generator.sample(paths, min(len(paths), 100))]
+    for number in range(int(len(paths) * settings["created"])):
+        size = generator.choice(sizes)
+        write_file(os.path.join(os.path.dirname(generator.choice(paths)), "new-%d-%d" % (seed, number)), file_content(generator, size, compressible))
+        counts["created"] += 1
+        counts["bytes"] += size
+    for path in generator.sample(paths, int(len(paths) * settings["deleted"])):
+        if os.path.exists(path):
+            os.remove(path)
+            counts["deleted"] += 1
+    return counts
+
+def generate_image(image_path, size, seed, compressible=True, chunk_size=1024**2):
+    """
+    Writes a volume image of size bytes, for the block mode benchmarks
+
+    """
+    generator = random.Random(seed)
+    with open(image_path, "wb") as image:
+        for offset in range(0, size, chunk_size):
+            image.write(file_content(generator, min(chunk_size, size - offset), compressible))
+    return size
+
+def churn_image(image_path, profile, seed, compressible=True, block_size=64 * 1024):
+    """
+    Rewrites blocks of a volume image: the share of the blocks that the 'changed' setting of a
+    profile from CHURN_PROFILES gives, and grows the image for 'append'. Returns the bytes written.
+
+    """
+    settings = CHURN_PROFILES[profile]
+    generator = random.Random(seed)
+    size = os.path.getsize(image_path)
+    blocks = size // block_size
+    written = 0
+    with open(image_path, "r+b") as image:
+        for block in sorted(generator.sample(range(blocks), int(blocks * settings["changed"]))):
+            image.seek(block * block_size)
+            image.write(file_content(generator, block_size, compressible))
+            written += block_size
+        if settings["append"]:
+            image.seek(0, os.SEEK_END)
+            appended = int(size * settings["append"] / 10) // block_size * block_size
+            image.write(file_content(generator, appended, compressible))
+            written += appended
+    return written
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Creates or changes a synthetic tree or volume image for the benchmarks')
+    arg_parser.add_argument('action', choices=['tree', 'churn', 'image', 'churn-image'])
+    arg_parser.add_argument('path', help='Directory of the tree, or path of the image')
+    arg_parser.add_argument('-p', '--profile', default='mixed', help='Tree profile ('+", ".join(TREE_PROFILES)+') or churn profile ('+", ".join(CHURN_PROFILES)+')')
+    arg_parser.add_argument('--seed', type=int, default=1)
+    arg_parser.add_argument('--scale', type=float, default=1.0, help='Factor for the number of files in the tree')
+    arg_parser.add_argument('--size', type=int, default=256 * 1024**2, help='Size of a new image in bytes')
+    arg_parser.add_argument('--random', action='store_true', help='Random content that does not compress, instead of text')
+    arguments = arg_parser.parse_args()
+    compressible = not arguments.random
+    if arguments.action == "tree":
+        print(generate_tree(arguments.path, arguments.profile, arguments.seed, compressible, arguments.scale))
+    elif arguments.action == "churn":
+        print(churn_tree(arguments.path, arguments.profile, arguments.seed, compressible))
+    elif arguments.action == "image":
+        print(generate_image(arguments.path, arguments.size, arguments.seed, compressible))
+    else:
+        print(churn_image(arguments.path, arguments.profile, arguments.seed, compressible))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,232 @@
+#! /usr/bin/env python3
+"""
+Runs the backup executor and the client script against local stand-ins for ssh, LVM and ZFS
+(see shim.py), and reports the wall time, peak memory, subprocesses and time per phase of
+full, diff and inc backups of synthetic volumes.
+Everything happens under a scratch directory, which becomes ZFSYNC_ROOT for the executor and
+the client, so nothing outside it is touched. Results are written as JSON, and can be compared
+with the results of an earlier run to catch regressions.
+
+"""
+
+import argparse, glob, json, os, shutil, subprocess, sys, tempfile, time
+from generate_tree import generate_tree, churn_tree, generate_image, churn_image
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIRECTORY = os.path.dirname(BENCHMARK_DIRECTORY)
+SHIM_DIRECTORY = BENCHMARK_DIRECTORY + "/shims"
+POOL = "bench"
+JOB = "bench/job1"
+VG_NAME = "benchvg"
+CLIENT = "localhost"
+
+arg_parser = argparse.ArgumentParser(description='Benchmarks backups of synthetic volumes against local stand-ins for ssh, LVM and ZFS')
+arg_parser.add_argument('-r', '--runs', default='full,inc,diff', help='Comma separated backup types to run in order. The volumes are changed between runs')
+arg_parser.add_argument('-p', '--profile', default='mixed', help='Tree profile of the volumes: small-files, large-files or mixed')
+arg_parser.add_argument('-c', '--churn', default='light', help='Churn profile between runs: light, heavy or append')
+arg_parser.add_argument('-n', '--volumes', type=int, default=1, help='Number of logical volumes to back up')
+arg_parser.add_argument('--scale', type=float, default=0.1, help='Factor for the number of files in each volume')
+arg_parser.add_argument('--random', action='store_true', help='Random file content that does not compress, instead of text')
+arg_parser.add_argument('--seed', type=int, default=1)
+arg_parser.add_argument('--transfer-mode', choices=['rsync','block'], default='rsync')
+arg_parser.add_argument('--image-size', type=int, default=64 * 1024**2, help='Size of each volume image in bytes, for --transfer-mode block')
+arg_parser.add_argument('--root', help='Scratch directory to use. A temporary directory is created and removed if left out')
+arg_parser.add_argument('--keep', action='store_true', help='Keep the scratch directory')
+arg_parser.add_argument('-o', '--output', help='Write the results as JSON to this file')
+arg_parser.add_argument('--baseline', help='Results of an earlier run to compare with')
+arg_parser.add_argument('--tolerance', type=float, default=0.1, help='Slowdown against the baseline, as a share of its wall time, that counts as a regression')
+arg_parser.add_argument('executor_options', nargs='*', help='Extra options for the executor, after --, like -- --shards 4 --progress-mode aggregate')
+arguments = arg_parser.parse_args()
+
+def environment(root):
+    env = dict(os.environ)
+    env["PATH"] = SHIM_DIRECTORY + os.pathsep + env.get("PATH", "")
+    env["ZFSYNC_ROOT"] = root
+    env["ZFSYNC_ALLOW_FILE_DEVICES"] = "1"
+    env["ZFSYNC_SSH_TRANSPORT"] = "ssh"
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    return env
+
+def shim(env, *command):
+    subprocess.run(list(command), env=env, check=True, stdout=subprocess.DEVNULL)
+
+def setup_root(root, env):
+    """
+    Creates the fixed directories of the server and the client under the scratch directory,
+    the volume group with its logical volumes, and the root dataset of the job.
+    Returns the paths of the logical volumes.
+
+    """
+    for directory in ("backup", "etc/zfsync", "mnt/rsyncbackup", "dev", "run"):
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+    #Installed like on a client: a copy of the scripts, executable
+    os.makedirs(root + "/opt/zfsync", exist_ok=True)
+    for path in glob.glob(REPOSITORY_DIRECTORY + "/*.py"):
+        shutil.copy(path, root + "/opt/zfsync")
+        os.chmod(root + "/opt/zfsync/" + os.path.basename(path), 0o755)
+    shim(env, "zfs", "create", "-p", JOB)
+    volumes = []
+    for number in range(arguments.volumes):
+        lv_name = "lv" + str(number)
+        shim(env, "lvcreate", "-L1G", "-n", lv_name, VG_NAME)
+        if arguments.transfer_mode == "block":
+            generate_image(root + "/dev/" + VG_NAME + "/" + lv_name, arguments.image_size, arguments.seed + number, not arguments.random)
+        else:
+            generate_tree(root + "/.shim/lvm/" + VG_NAME + "/" + lv_name, arguments.profile, arguments.seed + number, not arguments.random, arguments.scale)
+        volumes.append("/dev/" + VG_NAME + "/" + lv_name)
+    return volumes
+
+def churn(root, volumes, run_number):
+    written = 0
+    for (number, volume) in enumerate(volumes):
+        seed = arguments.seed * 1000 + run_number * 100 + number
+        if arguments.transfer_mode == "block":
+            written += churn_image(root + volume, arguments.churn, seed, not arguments.random)
+        else:
+            written += churn_tree(root + "/.shim/lvm" + volume[len("/dev"):], arguments.churn, seed, not arguments.random)["bytes"]
+    return written
+
+def read_calls(calls_log, offset):
+    calls = []
+    try:
+        with open(calls_log, "r", encoding="utf-8") as log:
+            log.seek(offset)
+            for line in log:
+                calls.append(json.loads(line))
+    except FileNotFoundError:
+        pass
+    return calls
+
+def phase_name(call):
+    """
+    Returns the phase a call to a stand-in or a counted command belongs to. Calls of the
+    client script are named after their action, like 'client initiate-backup'; their time
+    includes the lvcreate, mount and other calls they make.
+
+    """
+    command = call["command"]
+    if command == "python3.6":
+        return "client " + " ".join(call["arguments"][1:2])
+    if command == "zfs":
+        return "zfs " + call["arguments"][0]
+    if command == "rsync":
+        return "rsync (client side)" if "--server" in call["arguments"] else "rsync"
+    if command == "ssh":
+        if "-M" in call["arguments"]:
+            return "ssh master"
+        if "-O" in call["arguments"]:
+            return "ssh control"
+        return "ssh"
+    return command
+
+def summarize_calls(calls):
+    phases = {}
+    for call in calls:
+        phase = phases.setdefault(phase_name(call), {"count": 0, "seconds": 0.0, "max_rss_kb": 0})
+        phase["count"] += 1
+        phase["seconds"] += call["duration"]
+        phase["max_rss_kb"] = max(phase["max_rss_kb"], call["max_rss_kb"])
+    for phase in phases.values():
+        phase["seconds"] = round(phase["seconds"], 4)
+    return phases
+
+def run_backup(root, env, volumes, backup_type):
+    """
+    Runs one backup with the executor, and returns its results: exit code, wall time, peak memory
+    of the executor, the phases from the calls to the stand-ins, the timing spans the executor
+    recorded, and the stats records it wrote
+
+    """
+    calls_log = root + "/.shim/calls.log"
+    offset = os.path.getsize(calls_log) if os.path.exists(calls_log) else 0
+    command = [sys.executable, REPOSITORY_DIRECTORY + "/server_backupExecutor.py", "-c", CLIENT, "-p", JOB, "-t", backup_type,
+               "--transfer-mode", arguments.transfer_mode] + arguments.executor_options + volumes
+    started = time.time()
+    with open(root + "/benchmark-output.log", "a", encoding="utf-8") as output:
+        output.write("### " + " ".join(command) + "\n")
+        output.flush()
+        process = subprocess.Popen(command, env=env, stdout=output, stderr=subprocess.STDOUT)
+        (pid, status, usage) = os.wait4(process.pid, 0)
+    wall = time.time() - started
+    calls = read_calls(calls_log, offset)
+    phases = summarize_calls(calls)
+    stats = []
+    for path in glob.glob(root + "/" + JOB + "/*.stats.json"):
+        if os.path.getmtime(path) >= started:
+            with open(path, "r", encoding="utf-8") as stats_file:
+                stats.append(json.load(stats_file))
+    spans = {}
+    for path in glob.glob(root + "/" + JOB + "/*.metrics.json"):
+        if os.path.getmtime(path) >= started:
+            with open(path, "r", encoding="utf-8") as metrics_file:
+                for span in json.load(metrics_file)["spans"]:
+                    totals = spans.setdefault(span["phase"], {"count": 0, "seconds": 0.0})
+                    totals["count"] += 1
+                    totals["seconds"] = round(totals["seconds"] + span["duration"], 4)
+    transfer_phase = "client block-send" if arguments.transfer_mode == "block" else "rsync"
+    transfer = phases.get(transfer_phase, {}).get("seconds", 0.0)
+    return {"type": backup_type, "exit_code": os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else status >> 8,
+            "wall_seconds": round(wall, 4), "executor_max_rss_kb": usage.ru_maxrss, "executor_cpu_seconds": round(usage.ru_utime + usage.ru_stime, 4),
+            "subprocesses": len(calls), "transfer_seconds": transfer, "overhead_seconds": round(max(0.0, wall - transfer), 4),
+            "phases": phases, "spans": spans, "stats": stats}
+
+def compare(results, baseline):
+    """
+    Prints how each run compares with the run of the same number and type in the baseline.
+    Returns True if any run is slower than the tolerance allows.
+
+    """
+    regression = False
+    for (run, old) in zip(results["runs"], baseline["runs"]):
+        if run["type"] != old["type"]:
+            continue
+        change = (run["wall_seconds"] - old["wall_seconds"]) / old["wall_seconds"] if old["wall_seconds"] else 0.0
+        marker = ""
+        if change > arguments.tolerance:
+            marker = "  REGRESSION"
+            regression = True
+        print("%-5s wall %8.3fs -> %8.3fs (%+.1f%%), subprocesses %4d -> %4d, executor memory %7d -> %7d kB%s"
+              % (run["type"], old["wall_seconds"], run["wall_seconds"], change * 100, old["subprocesses"], run["subprocesses"],
+                 old["executor_max_rss_kb"], run["executor_max_rss_kb"], marker))
+    return regression
+
+def print_run(run):
+    print("%-5s exit %d, wall %.3fs, overhead %.3fs, executor memory %d kB, %d subprocesses"
+          % (run["type"], run["exit_code"], run["wall_seconds"], run["overhead_seconds"], run["executor_max_rss_kb"], run["subprocesses"]))
+    for (phase, totals) in sorted(run["phases"].items(), key=lambda item: -item[1]["seconds"]):
+        print("      %-28s %4d calls %9.3fs" % (phase, totals["count"], totals["seconds"]))
+    for (phase, totals) in sorted(run["spans"].items(), key=lambda item: -item[1]["seconds"]):
+        print("      span %-23s %4d spans %9.3fs" % (phase, totals["count"], totals["seconds"]))
+
+def main():
+    root = os.path.abspath(arguments.root) if arguments.root else tempfile.mkdtemp(prefix="zfsync-bench-")
+    env = environment(root)
+    results = {"settings": {key: value for (key, value) in vars(arguments).items() if key not in ("root", "output", "baseline", "keep")}, "runs": []}
+    try:
+        volumes = setup_root(root, env)
+        for (run_number, backup_type) in enumerate(arguments.runs.split(",")):
+            churn_bytes = 0
+            if run_number:
+                churn_bytes = churn(root, volumes, run_number)
+                #Dataset names of the executor have a resolution of one second
+                time.sleep(1.1)
+            run = run_backup(root, env, volumes, backup_type)
+            run["churn_bytes"] = churn_bytes
+            results["runs"].append(run)
+            print_run(run)
+    finally:
+        if arguments.keep or arguments.root:
+            print("Scratch directory: " + root)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=1, sort_keys=True)
+    if arguments.baseline:
+        with open(arguments.baseline, "r", encoding="utf-8") as baseline:
+            if compare(results, json.load(baseline)):
+                return 1
+    return 0 if all(run["exit_code"] == 0 for run in results["runs"]) else 2
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,535 @@
+#! /usr/bin/env python3
+"""
+Stand-ins for zfs, LVM, mount, ssh and python3.6, used by the benchmarks. Every command in
+benchmarks/shims is a symlink to this file, and the name it is called by picks the command.
+Everything lives under $ZFSYNC_ROOT:
+    datasets        directories at $ZFSYNC_ROOT/<pool>/<dataset>, like ZFS mount points
+    zfs snapshots   copies in $ZFSYNC_ROOT/.shim/zfs/<dataset>@<snapshot>
+    logical volumes an image file at $ZFSYNC_ROOT/dev/<vg>/<lv>, and the files of its file
+                    system in $ZFSYNC_ROOT/.shim/lvm/<vg>/<lv>
+    mounts          the mount point directory is replaced by a symlink to the files
+    ssh             runs the command locally with 'sh -c'
+Commands without a stand-in (rsync, mkdir, rm, ...) are run from the rest of PATH.
+Every call is appended to $ZFSYNC_ROOT/.shim/calls.log as a JSON line with its duration and
+the peak memory of what it ran, so the benchmark can count and time the subprocesses.
+
+"""
+
+import base64, fcntl, io, json, os, resource, shutil, signal, stat, subprocess, sys, tarfile, time
+
+ROOT = os.environ.get("ZFSYNC_ROOT", "").rstrip("/")
+STATE_DIRECTORY = ROOT + "/.shim"
+CALLS_LOG = STATE_DIRECTORY + "/calls.log"
+SHIM_DIRECTORY = os.path.dirname(os.path.realpath(__file__)) + "/shims"
+DEFAULT_VG_SIZE = 1024 * 1024 #Megabytes of space in every volume group
+
+def lv_device_path(vg_name, lv_name):
+    return ROOT + "/dev/" + vg_name + "/" + lv_name
+
+def lv_tree_path(vg_name, lv_name):
+    return STATE_DIRECTORY + "/lvm/" + vg_name + "/" + lv_name
+
+def dataset_directory(dataset_name):
+    return ROOT + "/" + dataset_name
+
+def snapshot_directory(snapshot_name):
+    return STATE_DIRECTORY + "/zfs/" + snapshot_name.replace("/", "%")
+
+
+class State:
+    """
+    JSON state of the stand-ins, locked for the length of a command, since commands of
+    parallel volumes run at the same time
+
+    """
+
+    def __init__(self, name, default):
+        os.makedirs(STATE_DIRECTORY, exist_ok=True)
+        self.path = STATE_DIRECTORY + "/" + name + ".json"
+        self.default = default
+
+    def __enter__(self):
+        self.lock = open(self.path + ".lock", "w")
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        try:
+            with open(self.path, "r", encoding="utf-8") as state:
+                self.data = json.load(state)
+        except (OSError, ValueError):
+            self.data = self.default
+        return self.data
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            with open(self.path + ".tmp", "w", encoding="utf-8") as state:
+                json.dump(self.data, state)
+            os.replace(self.path + ".tmp", self.path)
+        self.lock.close()
+
+
+def fail(message, code=1):
+    print(message, file=sys.stderr)
+    return code
+
+def copy_tree(source, destination):
+    #Reflinks where the file system supports them, so copies of large trees stay cheap
+    return subprocess.run(['cp', '-a', '--reflink=auto', source, destination]).returncode
+
+def directory_size(path):
+    size = 0
+    for (directory, directories, files) in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(directory, name)).st_size
+            except OSError:
+                pass
+    return size
+
+def written_since(path, snapshot_path, record_size=1048576):
+    #Bytes of the records of files that are new or changed since the snapshot, like 'written@' counts rewritten records (recordsize=1M)
+    written = 0
+    for (directory, directories, files) in os.walk(path):
+        for name in files:
+            current_path = os.path.join(directory, name)
+            current = os.lstat(current_path)
+            earlier_path = os.path.join(snapshot_path, os.path.relpath(current_path, path))
+            try:
+                earlier = os.lstat(earlier_path)
+            except OSError:
+                written += current.st_size
+                continue
+            if (earlier.st_size, earlier.st_mtime_ns) == (current.st_size, current.st_mtime_ns) or not stat.S_ISREG(current.st_mode):
+                continue
+            with open(current_path, "rb") as current_file, open(earlier_path, "rb") as earlier_file:
+                while True:
+                    record = current_file.read(record_size)
+                    if not record:
+                        break
+                    if record != earlier_file.read(record_size):
+                        written += len(record)
+    return written
+
+
+##### zfs #####
+
+def zfs(arguments):
+    if arguments[0] == "send":
+        return zfs_send(arguments[1:])
+    if arguments[0] in ("receive", "recv"):
+        return zfs_receive(arguments[1:])
+    with State("zfs", {"datasets": {}, "snapshots": {}, "txg": 0}) as state:
+        command = arguments[0]
+        names = [argument for argument in arguments[1:] if not argument.startswith("-")]
+        state["txg"] += 1
+        if command == "create":
+            os.makedirs(dataset_directory(names[0]), exist_ok=True)
+            parts = names[0].split("/")
+            for depth in range(1, len(parts) + 1):
+                state["datasets"].setdefault("/".join(parts[:depth]), {"origin": None, "txg": state["txg"]})
+            return 0
+        if command == "snapshot":
+            (dataset, snapshot) = names[0].split("@")
+            if dataset not in state["datasets"]:
+                return fail("cannot open '"+dataset+"': dataset does not exist")
+            if names[0] in state["snapshots"]:
+                return fail("cannot create snapshot '"+names[0]+"': dataset already exists")
+            os.makedirs(os.path.dirname(snapshot_directory(names[0])), exist_ok=True)
+            if copy_tree(dataset_directory(dataset), snapshot_directory(names[0])):
+                return fail("cannot create snapshot '"+names[0]+"'")
+            state["snapshots"][names[0]] = {"txg": state["txg"], "guid": names[0] + ":" + str(state["txg"])}
+            return 0
+        if command == "clone":
+            if names[0] not in state["snapshots"]:
+                return fail("cannot open '"+names[0]+"': dataset does not exist")
+            if copy_tree(snapshot_directory(names[0]), dataset_directory(names[1])):
+                return fail("cannot create '"+names[1]+"'")
+            state["datasets"][names[1]] = {"origin": names[0], "txg": state["txg"]}
+            return 0
+        if command == "promote":
+            dataset = state["datasets"][names[0]]
+            (origin_dataset, snapshot) = dataset["origin"].split("@")
+            state["datasets"][origin_dataset]["origin"] = names[0] + "@" + snapshot
+            state["snapshots"][names[0] + "@" + snapshot] = state["snapshots"].pop(dataset["origin"])
+            os.rename(snapshot_directory(dataset["origin"]), snapshot_directory(names[0] + "@" + snapshot))
+            for other in state["datasets"].values():
+                if other["origin"] == dataset["origin"]:
+                    other["origin"] = names[0] + "@" + snapshot
+            dataset["origin"] = None
+            return 0
+        if command == "destroy":
+            if "@" in names[0]:
+                (dataset, snapshots) = names[0].split("@")
+                for snapshot in snapshots.split(","):
+                    state["snapshots"].pop(dataset + "@" + snapshot, None)
+                    shutil.rmtree(snapshot_directory(dataset + "@" + snapshot), ignore_errors=True)
+                return 0
+            for name in [name for name in state["datasets"] if name == names[0] or name.startswith(names[0] + "/")]:
+                del state["datasets"][name]
+                shutil.rmtree(dataset_directory(name), ignore_errors=True)
+            for name in [name for name in state["snapshots"] if name.split("@")[0] == names[0] or name.startswith(names[0] + "/")]:
+                del state["snapshots"][name]
+                shutil.rmtree(snapshot_directory(name), ignore_errors=True)
+            return 0
+        if command == "get":
+            fields = arguments[arguments.index("-o") + 1].split(",") if "-o" in arguments else ["name", "property", "value"]
+            (properties, dataset) = (names[-2].split(","), names[-1])
+            if dataset not in state["datasets"]:
+                return fail("cannot open '"+dataset+"': dataset does not exist")
+            for name in properties:
+                if name == "receive_resume_token":
+                    value = resume_token(state["datasets"][dataset].get("resume"))
+                elif name.startswith("written@"):
+                    snapshot = name[len("written@"):]
+                    snapshot = dataset + snapshot if snapshot.startswith("@") else snapshot
+                    if snapshot not in state["snapshots"]:
+                        return fail("cannot get property '"+name+"': snapshot does not exist")
+                    value = written_since(dataset_directory(dataset), snapshot_directory(snapshot))
+                else:
+                    value = directory_size(dataset_directory(dataset))
+                print("\t".join({"name": dataset, "property": name, "value": str(value)}[field] for field in fields))
+            return 0
+        if command == "list":
+            fields = arguments[arguments.index("-o") + 1].split(",")
+            types = arguments[arguments.index("-t") + 1].split(",") if "-t" in arguments else ["filesystem"]
+            root = names[-1]
+            rows = []
+            if "filesystem" in types:
+                rows += [(entry["txg"], name, entry["origin"]) for name, entry in state["datasets"].items() if name == root or name.startswith(root + "/")]
+            if "snapshot" in types:
+                rows += [(entry["txg"], name, None) for name, entry in state["snapshots"].items() if name.split("@")[0] == root or name.startswith(root + "/")]
+            if not rows and root not in state["datasets"]:
+                return fail("cannot open '"+root+"': dataset does not exist")
+            for (txg, name, origin) in sorted(rows, key=lambda row: (row[0] if "createtxg" in arguments else row[1], row[1])):
+                values = {"name": name, "origin": origin or "-",
+                          "used": str(directory_size(dataset_directory(name)) if "@" not in name else 0)}
+                print("\t".join(values[field] for field in fields))
+            return 0
+    return fail("zfs shim: unsupported command: "+" ".join(arguments))
+
+def snapshot_guid(state, snapshot_name):
+    return state["snapshots"][snapshot_name].get("guid", snapshot_name)
+
+def resume_token(resume):
+    if not resume:
+        return "-"
+    return base64.b64encode(json.dumps(resume, sort_keys=True).encode("utf-8")).decode("ascii")
+
+def snapshot_payload(snapshot_name):
+    #A tar of the snapshot, built the same way every time, so a resumed stream continues the first one
+    payload = io.BytesIO()
+    directory = snapshot_directory(snapshot_name)
+    with tarfile.open(fileobj=payload, mode="w") as archive:
+        for (path, directories, files) in os.walk(directory):
+            directories.sort()
+            for name in sorted(directories + files):
+                archive.add(os.path.join(path, name), os.path.relpath(os.path.join(path, name), directory), recursive=False)
+    return payload.getvalue()
+
+def zfs_send(arguments):
+    """
+    A send stream is a JSON header line for each snapshot, with its guid, the guid of the
+    snapshot it is incremental from and the size of the payload, followed by the payload:
+    the whole snapshot as a tar, also for incremental streams. 'zfs send -t' sends the rest
+    of the payload from the offset in the token.
+
+    """
+    (base, intermediate, snapshot, offset) = (None, False, None, 0)
+    position = 0
+    while position < len(arguments):
+        if arguments[position] in ("-i", "-I", "-t"):
+            if arguments[position] == "-t":
+                resume = json.loads(base64.b64decode(arguments[position + 1]).decode("utf-8"))
+                (snapshot, base, offset) = (resume["snapshot"], resume["from"], resume["offset"])
+            else:
+                (base, intermediate) = (arguments[position + 1], arguments[position] == "-I")
+            position += 2
+            continue
+        if not arguments[position].startswith("-"):
+            snapshot = arguments[position]
+        position += 1
+    with State("zfs", {"datasets": {}, "snapshots": {}, "txg": 0}) as state:
+        dataset = snapshot.split("@")[0]
+        if base is not None and base.startswith("@"):
+            base = dataset + base
+        for name in (snapshot, base):
+            if name is not None and name not in state["snapshots"]:
+                return fail("cannot open '"+name+"': dataset does not exist")
+        names = [snapshot]
+        if intermediate:
+            names = sorted((name for name in state["snapshots"] if name.split("@")[0] == dataset and
+                            state["snapshots"][base]["txg"] < state["snapshots"][name]["txg"] <= state["snapshots"][snapshot]["txg"]),
+                           key=lambda name: state["snapshots"][name]["txg"])
+        records = []
+        for name in names:
+            records.append(({"snapshot": name, "guid": snapshot_guid(state, name), "from": base,
+                             "from_guid": snapshot_guid(state, base) if base else None}, snapshot_payload(name)))
+            base = name
+    try:
+        for (header, payload) in records:
+            header.update(size=len(payload), offset=offset)
+            sys.stdout.buffer.write((json.dumps(header) + "\n").encode("utf-8") + payload[offset:])
+            offset = 0
+        sys.stdout.buffer.flush()
+    except BrokenPipeError:
+        return fail("warning: cannot send '"+snapshot+"': signal received")
+    return 0
+
+def zfs_receive(arguments):
+    """
+    Receives the snapshots of a send stream into the target dataset. A full stream needs a
+    target that does not exist, an incremental stream the most recent snapshot of the target,
+    or for a clone stream, a snapshot with the same guid in the pool of the target. With -s,
+    a stream that ends early is kept, and the target gets a receive_resume_token.
+
+    """
+    flags = "".join(argument[1:] for argument in arguments if argument.startswith("-"))
+    target = [argument for argument in arguments if not argument.startswith("-")][-1]
+    records = []
+    while True:
+        line = sys.stdin.buffer.readline()
+        if not line:
+            break
+        header = json.loads(line.decode("utf-8"))
+        payload = sys.stdin.buffer.read(header["size"] - header["offset"])
+        records.append((header, payload))
+        if len(payload) < header["size"] - header["offset"]:
+            break
+    if not records:
+        return fail("cannot receive: failed to read from stream")
+    partial_path = STATE_DIRECTORY + "/zfs-receive/" + target.replace("/", "%")
+    with State("zfs", {"datasets": {}, "snapshots": {}, "txg": 0}) as state:
+        for (header, payload) in records:
+            dataset = state["datasets"].get(target)
+            resume = (dataset or {}).get("resume")
+            origin = None
+            if resume is not None:
+                if resume["snapshot"] != header["snapshot"] or resume["offset"] != header["offset"]:
+                    return fail("cannot receive: destination '"+target+"' contains partially-complete state from \"zfs receive -s\"")
+                with open(partial_path, "rb") as partial:
+                    payload = partial.read(header["offset"]) + payload
+            elif dataset is None:
+                if "/".join(target.split("/")[:-1]) not in state["datasets"]:
+                    return fail("cannot receive new filesystem stream: parent of '"+target+"' does not exist")
+                if header["from_guid"] is not None:
+                    origins = [name for name in state["snapshots"] if snapshot_guid(state, name) == header["from_guid"] and name.split("/")[0] == target.split("/")[0]]
+                    if not origins:
+                        return fail("cannot receive incremental stream: local origin for clone "+target+"@"+header["snapshot"].split("@")[1]+" does not exist")
+                    origin = origins[0]
+            elif header["from_guid"] is None:
+                return fail("cannot receive new filesystem stream: destination '"+target+"' exists")
+            else:
+                snapshots = sorted((name for name in state["snapshots"] if name.split("@")[0] == target), key=lambda name: state["snapshots"][name]["txg"])
+                if not snapshots or snapshot_guid(state, snapshots[-1]) != header["from_guid"]:
+                    return fail("cannot receive incremental stream: most recent snapshot of "+target+" does not match incremental source")
+            state["txg"] += 1
+            if len(payload) < header["size"]:
+                if "s" not in flags:
+                    return fail("cannot receive: incomplete stream")
+                os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+                with open(partial_path, "wb") as partial:
+                    partial.write(payload)
+                state["datasets"].setdefault(target, {"origin": origin, "txg": state["txg"]})["resume"] = dict(header, offset=len(payload))
+                return fail("cannot receive: checksum mismatch or incomplete stream.\nPartially received snapshot is saved.\n"
+                            "A resuming stream can be generated on the sending system by running:\n    zfs send -t "+resume_token(dict(header, offset=len(payload))))
+            snapshot_name = target + "@" + header["snapshot"].split("@")[1]
+            shutil.rmtree(snapshot_directory(snapshot_name), ignore_errors=True)
+            os.makedirs(snapshot_directory(snapshot_name))
+            with tarfile.open(fileobj=io.BytesIO(payload), mode="r") as archive:
+                archive.extractall(snapshot_directory(snapshot_name))
+            shutil.rmtree(dataset_directory(target), ignore_errors=True)
+            if copy_tree(snapshot_directory(snapshot_name), dataset_directory(target)):
+                return fail("cannot receive '"+snapshot_name+"'")
+            state["datasets"].setdefault(target, {"origin": origin, "txg": state["txg"]}).pop("resume", None)
+            state["snapshots"][snapshot_name] = {"txg": state["txg"], "guid": header["guid"]}
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+    return 0
+
+
+##### LVM #####
+
+def lvm_state():
+    return State("lvm", {"vgs": {}, "lvs": {}})
+
+def option_value(arguments, name):
+    for (position, argument) in enumerate(arguments):
+        if argument == name:
+            return arguments[position + 1]
+        if argument.startswith(name) and len(argument) > len(name):
+            return argument[len(name):]
+    return None
+
+def parse_size(text):
+    text = text.lstrip("+").upper()
+    units = {"M": 1, "G": 1024, "T": 1024 * 1024}
+    if text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+def lvcreate(arguments):
+    size_mb = parse_size(option_value(arguments, "-L"))
+    name = option_value(arguments, "-n")
+    with lvm_state() as state:
+        if "-s" in arguments:
+            origin = arguments[-1][len("/dev/"):]
+            vg_name = origin.split("/")[0]
+            if origin not in state["lvs"]:
+                return fail("Volume group \""+vg_name+"\" has no logical volume "+origin)
+            snapshot = vg_name + "/" + name
+            if os.path.exists(lv_device_path(vg_name, name)):
+                return fail("Logical volume \""+name+"\" already exists in volume group \""+vg_name+"\"")
+            #Hard links: the snapshot is only read, and removed before the benchmark changes the origin
+            shutil.copytree(lv_tree_path(*origin.split("/")), lv_tree_path(vg_name, name), symlinks=True, copy_function=os.link)
+            os.link(lv_device_path(*origin.split("/")), lv_device_path(vg_name, name))
+            state["lvs"][snapshot] = {"size_mb": size_mb, "origin": origin}
+        else:
+            vg_name = arguments[-1]
+            os.makedirs(lv_tree_path(vg_name, name), exist_ok=True)
+            os.makedirs(os.path.dirname(lv_device_path(vg_name, name)), exist_ok=True)
+            with open(lv_device_path(vg_name, name), "ab"):
+                pass
+            state["lvs"][vg_name + "/" + name] = {"size_mb": size_mb, "origin": None}
+        state["vgs"].setdefault(vg_name, DEFAULT_VG_SIZE)
+        state["vgs"][vg_name] -= size_mb
+    print("  Logical volume \""+name+"\" created.")
+    return 0
+
+def lvremove(arguments):
+    path = arguments[-1]
+    (vg_name, lv_name) = path[len("/dev/"):].split("/")
+    with lvm_state() as state:
+        lv = state["lvs"].pop(vg_name + "/" + lv_name, None)
+        if lv is None:
+            return fail("Failed to find logical volume \""+vg_name+"/"+lv_name+"\"")
+        state["vgs"][vg_name] += lv["size_mb"]
+    shutil.rmtree(lv_tree_path(vg_name, lv_name), ignore_errors=True)
+    os.remove(lv_device_path(vg_name, lv_name))
+    print("  Logical volume \""+lv_name+"\" successfully removed")
+    return 0
+
+def lvextend(arguments):
+    path = arguments[-1]
+    (vg_name, lv_name) = path[len("/dev/"):].split("/")
+    with lvm_state() as state:
+        lv = state["lvs"].get(vg_name + "/" + lv_name)
+        if lv is None:
+            return fail("Failed to find logical volume \""+vg_name+"/"+lv_name+"\"")
+        extension = parse_size(option_value(arguments, "-L"))
+        lv["size_mb"] += extension
+        state["vgs"][vg_name] -= extension
+    return 0
+
+def vgs(arguments):
+    with lvm_state() as state:
+        for vg_name in [argument for argument in arguments if not argument.startswith("-") and "," not in argument and argument != "m"]:
+            print("  "+vg_name+" "+"%.2f" % state["vgs"].get(vg_name, DEFAULT_VG_SIZE))
+    return 0
+
+def lvs(arguments):
+    #Snapshots never fill up here: nothing writes to the origin while a backup runs
+    separator = option_value(arguments, "--separator") or " "
+    with lvm_state() as state:
+        for name in [argument for argument in arguments if "/" in argument]:
+            lv = state["lvs"].get(name)
+            if lv is not None:
+                (vg_name, lv_name) = name.split("/")
+                print("  "+separator.join([vg_name, lv_name, "%.2f" % lv["size_mb"], "0.00" if lv["origin"] else "", "swi-a-s---" if lv["origin"] else "-wi-a-----"]))
+    return 0
+
+
+##### mount #####
+
+def mount(arguments):
+    (device, mount_point) = arguments[-2:]
+    (vg_name, lv_name) = device[len("/dev/"):].split("/")
+    if not os.path.isdir(lv_tree_path(vg_name, lv_name)):
+        return fail("mount: special device "+device+" does not exist", 32)
+    if os.path.islink(mount_point):
+        return fail("mount: "+mount_point+" is already mounted", 32)
+    os.rmdir(mount_point)
+    os.symlink(lv_tree_path(vg_name, lv_name), mount_point)
+    return 0
+
+def umount(arguments):
+    mount_point = arguments[-1]
+    if not os.path.islink(mount_point):
+        return fail("umount: "+mount_point+": not mounted", 32)
+    os.remove(mount_point)
+    os.mkdir(mount_point)
+    return 0
+
+
+##### ssh #####
+
+SSH_OPTIONS_WITH_VALUE = set("bcDEeFIiJLlmOopQRSWw")
+
+def ssh(arguments):
+    options = {}
+    flags = set()
+    position = 0
+    while position < len(arguments) and arguments[position].startswith("-"):
+        option = arguments[position][1]
+        if option in SSH_OPTIONS_WITH_VALUE:
+            value = arguments[position][2:] or arguments[position + 1]
+            position += 1 if arguments[position][2:] else 2
+            if option == "o":
+                (key, setting) = value.split("=", 1)
+                options[key] = setting
+            else:
+                options[option] = value
+        else:
+            flags.update(arguments[position][1:])
+            position += 1
+    command = " ".join(arguments[position + 1:])
+    control_path = options.get("ControlPath")
+
+    if "O" in options:
+        if options["O"] == "check":
+            return 0 if control_path and os.path.exists(control_path) else 255
+        if options["O"] == "exit" and control_path and os.path.exists(control_path):
+            os.remove(control_path)
+        return 0
+    if "M" in flags:
+        #A ControlMaster: runs until it is told to exit, or terminated
+        open(control_path, "w").close()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        while os.path.exists(control_path):
+            time.sleep(0.1)
+        return 0
+    return subprocess.call(['sh', '-c', command])
+
+
+##### Everything else #####
+
+def passthrough(name, arguments):
+    path = os.environ.get("PATH", "").split(os.pathsep)
+    path = [directory for directory in path if os.path.abspath(directory) != SHIM_DIRECTORY]
+    executable = shutil.which(name, path=os.pathsep.join(path))
+    if executable is None:
+        return fail(name+": command not found", 127)
+    return subprocess.call([executable] + arguments)
+
+COMMANDS = {"zfs": zfs, "lvcreate": lvcreate, "lvremove": lvremove, "lvextend": lvextend, "vgs": vgs, "lvs": lvs,
+            "mount": mount, "umount": umount, "ssh": ssh, "fsfreeze": lambda arguments: 0,
+            "python3.6": lambda arguments: subprocess.call([sys.executable] + arguments)}
+
+def main():
+    name = os.path.basename(sys.argv[0])
+    arguments = sys.argv[1:]
+    start_time = time.time()
+    try:
+        if name in COMMANDS:
+            returncode = COMMANDS[name](arguments)
+        else:
+            returncode = passthrough(name, arguments)
+    finally:
+        duration = time.time() - start_time
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        os.makedirs(STATE_DIRECTORY, exist_ok=True)
+        with open(CALLS_LOG, "a", encoding="utf-8") as calls:
+            calls.write(json.dumps({"command": name, "arguments": arguments, "start": start_time, "duration": duration,
+                                    "max_rss_kb": max(children.ru_maxrss, own.ru_maxrss), "pid": os.getpid()}) + "\n")
+    return returncode
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+#! /usr/bin/env python3.6
+
+import hashlib, os, struct, sys, argparse, time
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024 #In bytes
+DIGEST_SIZE = 16
+STREAM_MAGIC = b"ZFSYNCB1"
+MANIFEST_MAGIC = b"ZFSYNCM1"
+HEADER = struct.Struct(">8sI") #Magic, block size
+RECORD = struct.Struct(">QI16s") #Offset, length, digest of a changed block
+TRAILER = struct.Struct(">Q") #Size of the device
+END_OF_BLOCKS = 2**64 - 1 #Offset that marks the end of the changed blocks
+SYNC_EVERY = 64 #Blocks received between syncs to disk, when the receiver reports its progress
+
+def block_digest(data):
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+def parse_manifest(data, block_size):
+    """
+    Returns the block digests in a manifest as one bytes object, with DIGEST_SIZE bytes
+    per block. Returns an empty bytes object if the manifest is empty, or was made with
+    another block size, so that every block is treated as changed.
+
+    Parameters
+    ----------
+    data :          The content of the manifest file
+    block_size :    The block size the manifest must have been made with
+
+    """
+    if len(data) < HEADER.size:
+        return b""
+    (magic, manifest_block_size) = HEADER.unpack_from(data)
+    if magic != MANIFEST_MAGIC or manifest_block_size != block_size:
+        return b""
+    return data[HEADER.size:]
+
+def send_changed_blocks(device_path, manifest_data, output, block_size=DEFAULT_BLOCK_SIZE, rate_limit=None, start=0, end=None):
+    """
+    Reads a device, or an image file, in blocks of block_size bytes, and writes every
+    block whose digest differs from the manifest to output. Returns a dictionary with
+    the number of blocks read and sent, and the size of the device.
+    Stream format: HEADER, then RECORD followed by the data for each changed block,
+    then a RECORD with offset END_OF_BLOCKS, then TRAILER.
+    With start and end, only that range of the device is read, so that several streams
+    can send one device at the same time.
+
+    Parameters
+    ----------
+    device_path :   Path to the device or image file to read. Normally an LVM snapshot
+    manifest_data : Content of the manifest from the last backup, or b"" to send every block
+    output :        Binary file object to write the stream to
+    block_size :    Size of each block in bytes
+    rate_limit :    Highest average rate to send the changed blocks at, in bytes per second. None for no limit
+    start :         Offset to start reading at. Must be a multiple of block_size
+    end :           Offset to stop reading at, or None to read to the end of the device
+
+    """
+    old_digests = parse_manifest(manifest_data, block_size)
+    output.write(HEADER.pack(STREAM_MAGIC, block_size))
+    blocks_total = 0
+    blocks_sent = 0
+    bytes_sent = 0
+    start_time = time.monotonic()
+    with open(device_path, "rb", buffering=0) as device:
+        device_size = device.seek(0, os.SEEK_END)
+        offset = device.seek(start)
+        end = device_size if end is None else min(end, device_size)
+        while offset < end:
+            data = device.read(min(block_size, end - offset))
+            if not data:
+                break
+            digest = block_digest(data)
+            position = (offset // block_size) * DIGEST_SIZE
+            if old_digests[position:position+DIGEST_SIZE] != digest:
+                output.write(RECORD.pack(offset, len(data), digest))
+                output.write(data)
+                blocks_sent += 1
+                bytes_sent += len(data)
+                if rate_limit:
+                    ahead = bytes_sent / rate_limit - (time.monotonic() - start_time)
+                    if ahead > 0:
+                        time.sleep(ahead)
+            blocks_total += 1
+            offset += len(data)
+    output.write(RECORD.pack(END_OF_BLOCKS, 0, b"\0" * DIGEST_SIZE))
+    output.write(TRAILER.pack(device_size))
+    output.flush()
+    return {"blocks_total": blocks_total, "blocks_sent": blocks_sent, "bytes_sent": bytes_sent, "device_size": device_size}
+
+def read_exactly(stream, size):
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise EOFError("Block stream ended unexpectedly")
+        data += chunk
+    return data
+
+def receive_changed_blocks(stream, image_path, manifest_path, on_synced=None):
+    """
+    Reads a stream from send_changed_blocks and writes the changed blocks into an image
+    file. The manifest next to the image is updated with the digests of the new blocks,
+    and is replaced only after the whole stream has been applied. Returns a dictionary
+    with the number of blocks and bytes received, and the size of the image.
+
+    Parameters
+    ----------
+    stream :        Binary file object to read the stream from
+    image_path :    Path to the image file (or device) to write to. Created if missing
+    manifest_path : Path to the manifest of the image, or None to keep no manifest, like for a restore
+    on_synced :     Called with the offset up to which the stream is on disk, every SYNC_EVERY
+                    blocks, so an interrupted stream can be sent again from there
+
+    """
+    (magic, block_size) = HEADER.unpack(read_exactly(stream, HEADER.size))
+    if magic != STREAM_MAGIC:
+        raise ValueError("Not a block stream")
+    manifest_data = b""
+    if manifest_path is not None and os.path.isfile(manifest_path):
+        with open(manifest_path, "rb") as manifest:
+            manifest_data = manifest.read()
+    digests = bytearray(parse_manifest(manifest_data, block_size))
+
+    blocks_received = 0
+    bytes_received = 0
+    mode = "r+b" if os.path.exists(image_path) else "w+b"
+    with open(image_path, mode) as image:
+        while True:
+            (offset, length, digest) = RECORD.unpack(read_exactly(stream, RECORD.size))
+            if offset == END_OF_BLOCKS:
+                break
+            image.seek(offset)
+            image.write(read_exactly(stream, length))
+            position = (offset // block_size) * DIGEST_SIZE
+            if len(digests) < position + DIGEST_SIZE:
+                digests.extend(b"\0" * (position + DIGEST_SIZE - len(digests)))
+            digests[position:position+DIGEST_SIZE] = digest
+            blocks_received += 1
+            bytes_received += length
+            if on_synced is not None and blocks_received % SYNC_EVERY == 0:
+                image.flush()
+                os.fsync(image.fileno())
+                on_synced(offset + length)
+        (device_size,) = TRAILER.unpack(read_exactly(stream, TRAILER.size))
+        if os.path.isfile(image_path):
+            image.truncate(device_size)
+        image.flush()
+        os.fsync(image.fileno())
+    if manifest_path is None:
+        return {"blocks_received": blocks_received, "bytes_received": bytes_received, "device_size": device_size, "block_size": block_size}
+    del digests[((device_size + block_size - 1) // block_size) * DIGEST_SIZE:]
+
+    temporary_path = manifest_path + ".tmp"
+    with open(temporary_path, "wb") as manifest:
+        manifest.write(HEADER.pack(MANIFEST_MAGIC, block_size))
+        manifest.write(bytes(digests))
+    os.replace(temporary_path, manifest_path)
+    return {"blocks_received": blocks_received, "bytes_received": bytes_received, "device_size": device_size, "block_size": block_size}
+
+
+if __name__ == "__main__":
+    #Stand-alone use, for testing on image files: 'send DEVICE MANIFEST > stream', 'receive IMAGE MANIFEST < stream'
+    arg_parser = argparse.ArgumentParser(description='Send or receive the changed blocks of a device or image file.')
+    arg_parser.add_argument("action", choices=['send', 'receive'])
+    arg_parser.add_argument("path", help="Device or image file to read (send), or image file to write (receive)")
+    arg_parser.add_argument("manifest", help="Manifest of the last transfer")
+    arg_parser.add_argument('-b','--block-size', type=int, default=DEFAULT_BLOCK_SIZE, help='Block size in bytes (send only)')
+    arguments = arg_parser.parse_args()
+    if arguments.action == "send":
+        manifest_data = b""
+        if os.path.isfile(arguments.manifest):
+            with open(arguments.manifest, "rb") as manifest:
+                manifest_data = manifest.read()
+        result = send_changed_blocks(arguments.path, manifest_data, sys.stdout.buffer, arguments.block_size)
+    else:
+        result = receive_changed_blocks(sys.stdin.buffer, arguments.path, arguments.manifest)
+    print(result, file=sys.stderr)
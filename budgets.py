@@ -0,0 +1,299 @@
+import configparser, fcntl, os, json, time, itertools, threading
+from datetime import datetime
+from shared_functions import zfsync_path
+
+BUDGET_DIRECTORY = zfsync_path("/run/zfsync/budget") #Lease files of the running transfers, one directory per budget
+RATE_UNITS = {"": 1024, "K": 1024, "M": 1024**2, "G": 1024**3} #Rates without a unit are in KiB/s, like rsync's --bwlimit
+DAY_NAMES = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+BUDGET_SETTINGS = ("bwlimit", "ionice", "nice", "io_read_max")
+LEASE_LOCK_NAME = "lock" #flock'ed in BUDGET_DIRECTORY while the leases are read and written
+LEASE_POLL_INTERVAL = 5 #Seconds between checks for a free share of a budget that is fully leased
+MIN_SHARE = 0.25 #A transfer waits until at least this part of its share of a budget is free, instead of crawling along on what is left for its whole life
+
+def parse_rate(text):
+    """
+    Returns a rate like '500', '20M' or '1.5G' in bytes per second. Returns None for
+    '0', 'none' or 'unlimited'. Raises ValueError for anything else.
+
+    """
+    text = text.strip().upper()
+    if text in ("", "0", "NONE", "UNLIMITED"):
+        return None
+    unit = text[-1] if text[-1] in RATE_UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * RATE_UNITS[unit])
+
+def parse_days(text):
+    days = set()
+    for part in text.lower().split(","):
+        if "-" in part:
+            (first, last) = (DAY_NAMES.index(day.strip()) for day in part.split("-"))
+            days.update(range(first, last + 1) if first <= last else itertools.chain(range(first, 7), range(0, last + 1)))
+        else:
+            days.add(DAY_NAMES.index(part.strip()))
+    return days
+
+
+class Profile:
+    """
+    A time-of-day profile, from a [profile NAME] section of the config file:
+        days = mon-fri          (optional, every day if left out)
+        hours = 08-18           (start and end hour. 22-06 wraps around midnight)
+
+    """
+
+    def __init__(self, name, section):
+        self.name = name
+        self.days = parse_days(section.get("days", "mon-sun"))
+        (self.start_hour, self.end_hour) = (int(hour) for hour in section.get("hours", "00-24").split("-"))
+
+    def active(self, now):
+        if self.start_hour <= self.end_hour:
+            return now.weekday() in self.days and self.start_hour <= now.hour < self.end_hour
+        #Wraps around midnight: the early hours belong to the window that started the day before
+        if now.hour >= self.start_hour:
+            return now.weekday() in self.days
+        return now.hour < self.end_hour and (now.weekday() - 1) % 7 in self.days
+
+
+def read_budget_config(config_file_path):
+    """
+    Reads the budgets and profiles from the central config file. Returns a tuple with a list of
+    Profiles, and a dictionary from budget name ('global', 'client NAME' or 'pool NAME') to the
+    settings of the budget. A setting can be given for a profile by adding '.PROFILE' to its name:
+        [budget global]
+        bwlimit = 1G
+        bwlimit.business-hours = 200M
+        [budget client db1.example.com]
+        bwlimit = 50M
+        ionice.business-hours = idle
+    The settings are: bwlimit (rate, shared by all the transfers in the budget),
+    ionice ('idle' or 'be:N'), nice (0-19) and io_read_max (rate the client may read the snapshot at).
+
+    Parameters
+    ----------
+    config_file_path :  Path to the central config file
+
+    """
+    config = configparser.ConfigParser(delimiters=("=",))
+    config.read(config_file_path)
+    profiles = []
+    budgets = {}
+    for section_name in config.sections():
+        if section_name.startswith("profile "):
+            profiles.append(Profile(section_name[len("profile "):].strip(), config[section_name]))
+        elif section_name.startswith("budget "):
+            budgets[" ".join(section_name[len("budget "):].split())] = dict(config[section_name])
+    return (profiles, budgets)
+
+def read_job_budget(job_file_path):
+    """
+    Returns the budget settings of a job file, from its 'key = value' lines, like 'bwlimit = 20M'
+    or 'bwlimit.business-hours = 5M'
+
+    """
+    settings = {}
+    with open(job_file_path, "r", encoding="utf-8") as job_file:
+        for line in job_file:
+            line = line.split("#")[0].strip()
+            if "=" not in line:
+                continue
+            (key, value) = (part.strip() for part in line.split("=", 1))
+            if key.split(".")[0] in BUDGET_SETTINGS:
+                settings[key] = value
+    return settings
+
+def resolve_setting(settings, name, profiles, now):
+    """
+    Returns the value of a setting at the given time: the value for the first active profile
+    that the setting has a value for, or else the plain value, or None
+
+    """
+    for profile in profiles:
+        if name+"."+profile.name in settings and profile.active(now):
+            return settings[name+"."+profile.name]
+    return settings.get(name)
+
+
+class BudgetLease:
+    """
+    The share of one transfer in every budget it falls under. A lease file is written in the
+    directory of each budget, so that transfers of all the running backup jobs can see each other.
+    The rate of a new transfer is its share of each budget, the limit split over the streams the
+    job runs at the same time, but never more than what is left after the other transfers, and
+    the lowest of those over all the budgets. Since the rate of rsync is fixed once it runs, the
+    leases never add up to more than a limit: when less than MIN_SHARE of its share is left, a new
+    transfer waits for other transfers to end. The leases are read and written under a flock of
+    the directory, so that transfers of all the processes take their shares one at a time.
+    Leases of processes that have died are ignored and removed.
+
+    Parameters
+    ----------
+    limits :        Dictionary from budget name to its rate limit in bytes per second
+    directory :     Directory for the lease files
+    streams :       Number of transfers the job runs at the same time
+
+    """
+
+    _ids = itertools.count()
+    _lock = threading.Lock()
+
+    def __init__(self, limits, directory=BUDGET_DIRECTORY, streams=1):
+        self.paths = []
+        self.rate = None
+        self.waited = 0 #Seconds the transfer waited for its share
+        if not limits:
+            return
+        with BudgetLease._lock:
+            lease_name = str(os.getpid())+"-"+str(next(BudgetLease._ids))+".lease"
+        os.makedirs(directory, exist_ok=True)
+        start_time = time.time()
+        while True:
+            #Every thread opens the lock file itself, so the flock also keeps the threads of a process apart
+            with open(os.path.join(directory, LEASE_LOCK_NAME), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                rate = free_share(limits, directory, streams)
+                if rate is not None:
+                    self.rate = rate
+                    for budget in sorted(limits):
+                        self.paths.append(os.path.join(lease_directory(directory, budget), lease_name))
+                        with open(self.paths[-1], "w", encoding="utf-8") as lease:
+                            json.dump({"pid": os.getpid(), "rate": self.rate, "time": time.time()}, lease)
+                    break
+            time.sleep(LEASE_POLL_INTERVAL)
+        self.waited = time.time() - start_time
+
+    def release(self):
+        for path in self.paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.paths = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def lease_directory(directory, budget):
+    path = os.path.join(directory, budget.replace("/", "_").replace(" ", "_"))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def free_share(limits, directory, streams):
+    """
+    Returns the rate a new transfer gets in all the budgets, or None if one of the budgets has
+    less than MIN_SHARE of the share of the transfer left. Called with the leases locked.
+
+    """
+    rate = None
+    for (budget, limit) in sorted(limits.items()):
+        used = sum(lease["rate"] for lease in read_leases(lease_directory(directory, budget)) if lease["rate"])
+        share = max(1, limit // streams)
+        if limit - used < max(1, int(share * MIN_SHARE)):
+            return None
+        rate = min(share, limit - used) if rate is None else min(rate, share, limit - used)
+    return rate
+
+
+def read_leases(budget_directory):
+    """
+    Returns the leases in a budget directory, and removes the leases of processes that are gone
+
+    """
+    leases = []
+    for name in os.listdir(budget_directory):
+        path = os.path.join(budget_directory, name)
+        try:
+            with open(path, "r", encoding="utf-8") as lease_file:
+                lease = json.load(lease_file)
+            os.kill(lease["pid"], 0)
+        except ProcessLookupError:
+            os.remove(path)
+            continue
+        except (OSError, ValueError, KeyError):
+            continue
+        leases.append(lease)
+    return leases
+
+
+class TransferBudget:
+    """
+    The budgets that apply to the transfers of one backup job: the global budget, the budget of
+    the client, of the ZFS pool and of the job itself, with their time-of-day profiles.
+    The settings are looked up again every time a transfer is started, so a job that runs into
+    or out of a profile's time window changes its limits from the next volume or shard on.
+
+    Parameters
+    ----------
+    config_file_path :  Path to the central config file with the budgets and profiles
+    job_file_path :     Path to the job file, or None. Its settings are the budget of the job
+    client :            Hostname of the client
+    pool :              Name of the ZFS pool the job is stored in
+    job_name :          Name of the job, like the name of its root dataset
+    streams :           Number of transfers the job runs at the same time. A bandwidth limit is split over them
+
+    """
+
+    def __init__(self, config_file_path, job_file_path, client, pool, job_name, streams=1):
+        self.streams = max(1, streams)
+        (self.profiles, budgets) = read_budget_config(config_file_path)
+        self.budgets = {}
+        for budget in ("global", "client "+client, "pool "+pool):
+            if budget in budgets:
+                self.budgets[budget] = budgets[budget]
+        if job_file_path:
+            self.budgets["job "+job_name] = read_job_budget(job_file_path)
+
+    def setting(self, name, now=None):
+        """
+        Returns the value of a setting from the most specific budget that has it: the job,
+        the pool, the client, and then the global budget
+
+        """
+        now = now or datetime.now()
+        for budget in reversed(list(self.budgets)):
+            value = resolve_setting(self.budgets[budget], name, self.profiles, now)
+            if value is not None:
+                return value
+        return None
+
+    def lease(self, now=None):
+        """
+        Returns a BudgetLease for a new transfer, in every budget that has a bandwidth limit right now.
+        Waits until the budgets have room for the transfer, see BudgetLease.
+
+        """
+        now = now or datetime.now()
+        limits = {}
+        for (budget, settings) in self.budgets.items():
+            value = resolve_setting(settings, "bwlimit", self.profiles, now)
+            rate = parse_rate(value) if value is not None else None
+            if rate:
+                limits[budget] = rate
+        return BudgetLease(limits, streams=self.streams)
+
+    def remote_command_prefix(self, device_path=None, now=None):
+        """
+        Returns the words to put in front of a command on the client, so it runs with the
+        I/O and CPU priority of the budget, like ['ionice', '-c3', 'nice', '-n', '19'].
+        With io_read_max and a device, the command is run in its own cgroup with a read
+        bandwidth limit on the device, through systemd-run.
+
+        """
+        prefix = []
+        io_read_max = self.setting("io_read_max", now)
+        if io_read_max and device_path and parse_rate(io_read_max):
+            prefix += ['systemd-run', '--scope', '--quiet', '-p', "'IOReadBandwidthMax="+device_path+" "+str(parse_rate(io_read_max))+"'"]
+        ionice = self.setting("ionice", now)
+        if ionice == "idle":
+            prefix += ['ionice', '-c3']
+        elif ionice and ionice.startswith("be:"):
+            prefix += ['ionice', '-c2', '-n'+ionice[3:]]
+        nice = self.setting("nice", now)
+        if nice:
+            prefix += ['nice', '-n', nice]
+        return prefix
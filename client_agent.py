@@ -0,0 +1,127 @@
+import collections, json, threading
+from shared_functions import *
+
+class AgentError(Exception):
+    """
+    Raised when the agent on a client can not be started, or stops answering
+
+    """
+
+
+class ClientAgent:
+    """
+    A 'client_backup.py agent' on a client, that runs the control commands of a backup job,
+    like snapshot, cleanup and commit-index, as requests over one channel of the SSH connection
+    to the client. The script is started once for the job, instead of once for each command,
+    and the results come back as JSON. See run_agent in client_backup.py for the protocol.
+    Requests are sent one at a time; threads of the job wait for each other, so long running
+    commands are better started on their own.
+
+    Parameters
+    ----------
+    ssh_connections :   SSHConnectionManager with the connection to the client
+    client :            Hostname or IP address of the client
+    username :          The username that will be used to connect to the client
+    command :           The command line that starts the agent on the client
+    metrics :           Metrics of the job, for the time to connect
+
+    """
+
+    def __init__(self, ssh_connections, client, username, command, metrics=None):
+        self.ssh_connections = ssh_connections
+        self.client = client
+        self.username = username
+        self.command = command
+        self.metrics = metrics
+        self.stdin = None
+        self.stdout = None
+        self.stderr_lines = collections.deque(maxlen=100)
+        self.next_id = 1
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the agent and waits for its greeting. Raises AgentError if the agent does not
+        start, like on a client with an older client_backup.py that has no agent action.
+
+        """
+        (self.stdin, self.stdout, stderr) = self.ssh_connections.open_command(self.client, self.username, self.command, self.metrics)
+        #Drain stderr in the background, so tracebacks of the agent can not stall it
+        threading.Thread(target=self._drain_stderr, args=(stderr,), daemon=True).start()
+        (greeting, output) = self._read_response()
+        if greeting is None or greeting.get("id") != 0:
+            self.close()
+            raise AgentError("The agent on "+self.client+" did not start: "+"".join(self.stderr_lines or output).strip())
+        return greeting["result"]
+
+    def call(self, method, **params):
+        """
+        Sends a request to the agent and returns a tuple with the result, the log output of the
+        request and the exit code. Raises AgentError if the agent does not answer.
+
+        Parameters
+        ----------
+        method :    Name of a method in AGENT_METHODS of client_backup.py
+        params :    Parameters of the method
+
+        """
+        with self._lock:
+            if self.stdin is None:
+                raise AgentError("The agent on "+self.client+" is not running")
+            request_id = self.next_id
+            self.next_id += 1
+            try:
+                self.stdin.write((json.dumps({"id": request_id, "method": method, "params": params}) + "\n").encode("utf-8"))
+                self.stdin.flush()
+            except (OSError, EOFError) as e:
+                self.close()
+                raise AgentError("Unable to send a request to the agent on "+self.client+": "+str(e))
+            (response, output) = self._read_response()
+        if response is None:
+            self.close()
+            raise AgentError("The agent on "+self.client+" stopped: "+"".join(self.stderr_lines).strip())
+        if response.get("id") != request_id:
+            #The responses no longer match the requests, so the agent can not be used by anyone any more
+            self.close()
+            raise AgentError("Unexpected response from the agent on "+self.client+": "+str(response))
+        if "error" in response:
+            output.append(response["error"])
+        return (response.get("result"), output, response["exit_code"])
+
+    def _drain_stderr(self, stderr):
+        while True:
+            line = stderr.readline()
+            if not line:
+                return
+            self.stderr_lines.append(line if isinstance(line, str) else line.decode("utf-8", "replace"))
+
+    def _read_response(self):
+        """
+        Reads the output of the agent up to the next response. Returns a tuple with the
+        response, or None if the agent exited, and the lines of output before it.
+
+        """
+        output = []
+        while True:
+            line = self.stdout.readline()
+            if not line:
+                return (None, output)
+            if isinstance(line, bytes):
+                line = line.decode("utf-8", "replace")
+            if line.startswith(RESULT_PREFIX):
+                return (parse_result([line]), output)
+            output.append(line)
+
+    def close(self):
+        """
+        Stops the agent by closing its stdin, and waits for it to exit
+
+        """
+        if self.stdin is None:
+            return
+        try:
+            self.stdin.channel.shutdown_write()
+            self.stdout.channel.recv_exit_status()
+        except (OSError, EOFError):
+            pass
+        self.stdin = None
@@ -1,127 +1,437 @@
 #! /usr/bin/env python3.6
 
 import subprocess, sys, argparse, os, stat
-from datetime import datetime
 from shared_functions import *
-
-SNAPSHOT_SIZE = 512 #In megabytes
+from block_transfer import send_changed_blocks, receive_changed_blocks, DEFAULT_BLOCK_SIZE
+from file_index import walk_tree, write_index, read_index, diff_index
+from content_manifest import build_manifest, write_manifest
+from snapshot_telemetry import *
+from wire_compression import sample_compressibility, local_rsync_version
+from metrics import Metrics
+from locks import FileLock, LockHeld, describe_owner, lock_status, logical_volume_lock_path, volume_group_lock_path
+import collections, json, shutil, signal, time, threading
+
+SNAPSHOT_SIZE = 512 #In megabytes. Smallest snapshot size; snapshots are sized from the history of each logical volume
+MONITOR_INTERVAL = 10 #Seconds between samples of the fill level of a snapshot
+EXTEND_THRESHOLD = 70 #Fill level in percent at which a snapshot is extended
 #This name must be provided by the backupserver, so that it is the same
 #both when initializing and ending the backup.
-SNAPSHOT_MOUNT_PATH = "/mnt/rsyncbackup"#DONT use a trailing slash
-LOCK_FILE_PATH = "/etc/zfsync/lock" #Full path to lock file
+SNAPSHOT_MOUNT_PATH = zfsync_path("/mnt/rsyncbackup")#DONT use a trailing slash
+VG_LOCK_TIMEOUT = 120 #Seconds to wait for another job to finish creating snapshots in the same volume group
 (EXIT_OK, EXIT_WARNING, EXIT_CRITICAL, EXIT_UNKNOWN) = (0,1,2,3)
-LOG_FILE_PATH = "/etc/zfsync/client_backup.log"
+LOG_FILE_PATH = zfsync_path("/etc/zfsync/client_backup.log")
+ALLOW_FILE_DEVICES = bool(os.environ.get("ZFSYNC_ALLOW_FILE_DEVICES"))
+INDEX_DIRECTORY = zfsync_path("/etc/zfsync/index") #File metadata index of each logical volume, per backup job, used by scan-changes
+AGENT_PROTOCOL_VERSION = 1 #Version of the request and response format of the agent action
+
+monitor_processes = {} #Snapshot monitors started by this process, by snapshot path
 
 arg_parser = argparse.ArgumentParser(description='Client side script for initializing and ending backups.')
-arg_parser.add_argument("action", choices=['initiate-backup', 'end-backup'], help="Specify weather to initiate or end backup")
-arg_parser.add_argument('-l','--lv-path', help='Path to the logical volume', required=True)
-arg_parser.add_argument('-s','--snap-suffix', help='The name suffix of snaphot to be created (if initiating), or deleted (if ending)', required=True)
+arg_parser.add_argument("action", choices=['initiate-backup', 'end-backup', 'block-send', 'scan-changes', 'commit-index', 'monitor-snapshot', 'snapshot-status', 'sample-compression', 'content-manifest', 'block-receive', 'agent'], help="Specify weather to initiate or end backup. 'block-receive' writes a block stream from stdin onto the logical volume, for a restore with server_restore.py. 'content-manifest' writes the digests of a sample of the files in the mounted snapshot, for the verification of a backup. 'agent' serves requests for all the other actions, as JSON lines on stdin and stdout, until stdin is closed, see run_agent. 'sample-compression' estimates how well the files in the mounted snapshot compress. 'monitor-snapshot' samples the fill level of a snapshot and extends it before it is full; it is started in the background by initiate-backup. 'snapshot-status' prints the fill level of running snapshots. 'block-send' streams the changed blocks of a snapshot to stdout, given the block manifest of the last backup on stdin. 'scan-changes' compares the mounted snapshot with the file index of the last backup and writes a list of changed files. 'commit-index' makes the index from scan-changes the index of the last backup")
+arg_parser.add_argument('-l','--lv-path', nargs='+', help='Path to the logical volume. Several logical volumes can be given to snapshot or clean them up in one run. Required for every action but agent')
+arg_parser.add_argument('-s','--snap-suffix', help='The name suffix of snaphot to be created (if initiating), or deleted (if ending). Required for every action but agent and commit-index')
+arg_parser.add_argument('-f','--freeze', action='store_true', help='Freeze the mounted file systems of all the logical volumes while the snapshots are created, so that they are taken at one consistent point in time')
+arg_parser.add_argument('-m','--no-mount', action='store_true', help='Create the snapshots without mounting them, like for block level backups of volumes without a file system')
+arg_parser.add_argument('-b','--block-size', type=int, default=DEFAULT_BLOCK_SIZE, help='Block size in bytes for block-send')
+arg_parser.add_argument('--bwlimit', type=int, help='Highest rate in bytes per second for block-send')
+arg_parser.add_argument('--size', type=int, help='In block-receive: size of the image that is restored. The logical volume must be at least this big')
+arg_parser.add_argument('--base', choices=['last','full'], default='last', help="Index to compare with in scan-changes: the last backup (for inc), or the last full backup (for diff)")
+arg_parser.add_argument('-p','--dataset-name', help='Root dataset of the backup job, in scan-changes and commit-index. Every job has its own file indexes, also of the same logical volume')
+arg_parser.add_argument('-t','--backup-type', choices=['full','diff','inc'], help='Type of the backup that the index is committed for, in commit-index')
+arg_parser.add_argument('--backup-dataset', help='Dataset of the backup that the index is committed for, in commit-index. The next scan-changes reports it as the base of its comparison')
+arg_parser.add_argument('--verified', action='store_true', help='In commit-index: the backup was made with a full walk, so the count of runs since the last full walk is reset')
+arg_parser.add_argument('--verify-percent', type=int, default=100, help='Share of the files that content-manifest hashes, see in_sample in content_manifest.py')
+arg_parser.add_argument('--rotation', type=int, default=0, help='Number of the verification run, that picks the files content-manifest hashes')
+arg_parser.add_argument('--workers', type=int, default=1, help='Number of processes that hash the files in content-manifest')
+arg_parser.add_argument('-o','--output-format', choices=['text','json'], default='text', help='With json, a machine readable result for each logical volume is printed as the last line of output')
 arg_parser.add_argument('-v','--verbosity-level',nargs='?', const=3, default=3, type=int, help='Level of verbosity for logging and printing. 0 = no logging/printing, 1 = errors, 2 = warning + error, 3 = warning+error+info')
 arguments = arg_parser.parse_args()
+if arguments.action != "agent" and not arguments.lv_path:
+    arg_parser.error("the following arguments are required: -l/--lv-path")
+if arguments.action not in ("agent", "commit-index", "block-receive") and not arguments.snap_suffix:
+    arg_parser.error("the following arguments are required: -s/--snap-suffix")
+if arguments.action in ("scan-changes", "commit-index") and not arguments.dataset_name:
+    arg_parser.error("the following arguments are required: -p/--dataset-name")
+metrics = Metrics() #Spans of the phases of this run, reported to the server in the result
 
 def main():
-    if check_lockfile(LOCK_FILE_PATH):
-        log_and_print(arguments.verbosity_level,"critical","Client lock file is already present. Exiting!",LOG_FILE_PATH)
-        sys.exit(EXIT_WARNING)
+    if arguments.action == "agent":
+        sys.exit(run_agent())
+    elif arguments.action == "block-send":
+        #Only reads a snapshot that is already there, so the lock is not needed
+        sys.exit(block_send(arguments.lv_path[0], arguments.snap_suffix, arguments.block_size, arguments.bwlimit))
+    elif arguments.action == "scan-changes":
+        #Only reads the mounted snapshot, and the index files are per job and logical volume, so the lock is not needed
+        (exit_code, result) = scan_changes(arguments.lv_path[0], arguments.dataset_name, arguments.snap_suffix, arguments.base)
+    elif arguments.action == "commit-index":
+        sys.exit(commit_index(arguments.lv_path[0], arguments.dataset_name, arguments.backup_dataset, arguments.backup_type, arguments.verified))
+    elif arguments.action == "monitor-snapshot":
+        sys.exit(monitor_snapshot(arguments.lv_path[0], arguments.snap_suffix))
+    elif arguments.action == "sample-compression":
+        (exit_code, result) = sample_compression(arguments.lv_path[0], arguments.snap_suffix)
+    elif arguments.action == "block-receive":
+        sys.exit(block_receive(arguments.lv_path[0], arguments.size))
+    elif arguments.action == "content-manifest":
+        #Only reads the mounted snapshot, so the lock is not needed
+        sys.exit(content_manifest(arguments.lv_path[0], arguments.snap_suffix, arguments.verify_percent, arguments.rotation, arguments.workers))
+    elif arguments.action == "snapshot-status":
+        (exit_code, result) = (EXIT_OK, {"action": arguments.action, "snap_suffix": arguments.snap_suffix, "volumes": snapshot_status(arguments.lv_path, arguments.snap_suffix)})
     else:
-        create_lockfile(LOCK_FILE_PATH)
-        if arguments.action == "initiate-backup":
-            create_lv_snapshot(arguments.lv_path, arguments.snap_suffix)
-            delete_lockfile(LOCK_FILE_PATH)
-            sys.exit(EXIT_OK)
-        elif arguments.action == "end-backup":
-            if delete_lv_snapshot(arguments.lv_path, arguments.snap_suffix):
-                delete_lockfile(LOCK_FILE_PATH)
-                sys.exit(EXIT_WARNING)
-            else:
-                delete_lockfile(LOCK_FILE_PATH)
-                sys.exit(EXIT_OK)
-        else:
-            log_and_print(arguments.verbosity_level,"critical","This should not be possible!",LOG_FILE_PATH)
-            delete_lockfile(LOCK_FILE_PATH)
-            sys.exit(EXIT_CRITICAL)
+        (exit_code, result) = control_action(arguments.action, arguments.lv_path, arguments.snap_suffix, arguments.freeze, not arguments.no_mount)
+        if arguments.output_format != "json":
+            result = None
+    if result is not None:
+        print_result(result)
+    sys.exit(exit_code)
 
 
-# Need to add a check of the path to see that it is valid
-# Need to add a check to see if there is enough available space in volume group for snapshot
-def create_lv_snapshot(lv_path,snap_suffix):
+def control_action(action, lv_paths, snap_suffix, freeze=False, mount=True):
     """
-    This function creates a logical volume snapshot and mounts it. The snapshot
-    is mounted in a subfolder of SNAPSHOT_MOUNT_PATH. Before a snapshot is created
-    the path is checked to see that it points to an existing block device.
-    The function takes two parameters: lv_path and snap_suffix
+    Runs 'initiate-backup' or 'end-backup' for the given logical volumes, with each of them locked.
+    Returns a tuple with the exit code and the result: a dictionary with the action, the snapshot
+    suffix, a result for each logical volume and the timing spans of the run.
+
+    Parameters
+    ----------
+    action :        'initiate-backup' or 'end-backup'
+    lv_paths :      List of paths of the logical volumes
+    snap_suffix :   The suffix of the snapshots
+    freeze :        For initiate-backup: freeze the file systems while snapshotting
+    mount :         For initiate-backup: mount the snapshots
+
+    """
+
+    #Each logical volume has its own lock, so jobs for other logical volumes on the client are not held up
+    locks = {}
+    try:
+        for lv_path in sorted(set(lv_paths)):
+            locks[lv_path] = FileLock(logical_volume_lock_path(lv_path), action+" "+snap_suffix).acquire()
+    except LockHeld as e:
+        log_and_print(arguments.verbosity_level,"critical","Logical volume is locked: "+str(e)+". Exiting!",LOG_FILE_PATH)
+        for lock in locks.values():
+            lock.release()
+        return (EXIT_WARNING, {"action": action, "snap_suffix": snap_suffix, "volumes": {}, "message": str(e), "spans": metrics.spans})
+    for lv_path, lock in locks.items():
+        if lock.stale_owner:
+            log_and_print(arguments.verbosity_level,"warning","Took over the lock of "+lv_path+", left by "+describe_owner(lock.stale_owner),LOG_FILE_PATH)
+
+    if action == "initiate-backup":
+        results = create_lv_snapshots(lv_paths, snap_suffix, freeze, mount)
+    elif action == "end-backup":
+        results = {}
+        for lv_path in lv_paths:
+            with metrics.span("monitor_stop", volume=lv_path):
+                telemetry = stop_snapshot_monitor(lv_path, snap_suffix)
+            status = delete_lv_snapshot(lv_path, snap_suffix)
+            results[lv_path] = {"exit_code": status, "cleanup_failed": status == EXIT_CRITICAL, "telemetry": telemetry}
+    else:
+        log_and_print(arguments.verbosity_level,"critical","This should not be possible!",LOG_FILE_PATH)
+        for lock in locks.values():
+            lock.release()
+        return (EXIT_CRITICAL, None)
+
+    exit_code = max(result["exit_code"] for result in results.values())
+    #Keep a logical volume locked if its snapshot could not be cleaned up, so that it gets looked at
+    for lv_path, lock in locks.items():
+        lock.release(cleanup_needed=results.get(lv_path, {}).get("cleanup_failed", False))
+    return (exit_code, {"action": action, "snap_suffix": snap_suffix, "volumes": results, "spans": metrics.spans})
+
+
+def run_agent():
+    """
+    Serves requests from the server until stdin is closed, so a backup job can run all its
+    control commands on the client over one SSH channel, without starting this script for each.
+    A request is one line of JSON: {"id": 1, "method": "snapshot", "params": {...}}. The methods
+    are in AGENT_METHODS, and take the same parameters as the functions they call. Requests are
+    handled one at a time. The response is printed with print_result, as
+    {"id": 1, "exit_code": 0, "result": {...}}, or with "error" if the request failed; any other
+    output line before it is log output of the request. The agent first prints a response with
+    id 0 and the protocol version. Returns an exit code.
+
+    """
+
+    print_result({"id": 0, "exit_code": EXIT_OK, "result": {"agent": AGENT_PROTOCOL_VERSION, "pid": os.getpid()}})
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            return EXIT_OK
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            method = AGENT_METHODS[request["method"]]
+        except (ValueError, KeyError, TypeError) as e:
+            print_result({"id": None, "exit_code": EXIT_CRITICAL, "error": "Invalid request: "+repr(e)})
+            continue
+        #The spans in a result are those of the request
+        del metrics.spans[:]
+        try:
+            (exit_code, result) = method(**request.get("params", {}))
+            response = {"id": request.get("id"), "exit_code": exit_code, "result": result}
+        except Exception as e:
+            log_and_print(arguments.verbosity_level,"critical","Agent request "+request["method"]+" failed: "+repr(e),LOG_FILE_PATH)
+            response = {"id": request.get("id"), "exit_code": EXIT_CRITICAL, "error": repr(e)}
+        print_result(response)
+
+
+def agent_status(lv_paths, snap_suffix):
+    """
+    Returns the fill level of the snapshots of the logical volumes, like snapshot-status,
+    and the state of their locks
+
+    """
+    volumes = snapshot_status(lv_paths, snap_suffix)
+    locks = {lv_path: lock_status(logical_volume_lock_path(lv_path))[0] for lv_path in lv_paths}
+    return (EXIT_OK, {"snap_suffix": snap_suffix, "volumes": volumes, "locks": locks, "pid": os.getpid()})
+
+
+def agent_mount(lv_path, snap_suffix):
+    """
+    Mounts a snapshot that was created without mounting it, with the logical volume locked
+
+    """
+    with FileLock(logical_volume_lock_path(lv_path), "mount "+snap_suffix):
+        (exit_code, message) = mount_snapshot(lv_path, snap_suffix)
+    return (exit_code, {"message": message, "mount_path": SNAPSHOT_MOUNT_PATH+"/"+lv_path.split("/")[3]+snap_suffix if not exit_code else None})
+
+
+def create_lv_snapshots(lv_paths,snap_suffix,freeze=False,mount=True):
+    """
+    This function creates logical volume snapshots of one or more logical volumes,
+    and mounts them. The snapshots are mounted in subfolders of SNAPSHOT_MOUNT_PATH.
+    Free space in all the volume groups is checked with a single call to 'vgs', and
+    snapshot space is planned across the volume groups before any snapshot is made.
+    All the snapshots are then created right after each other, so that they are as
+    close together in time as possible. If freeze is True, the mounted file systems
+    of the logical volumes are frozen while the snapshots are created, which makes
+    the snapshots one consistent point in time across the volumes.
+    Each snapshot is sized from what the snapshots of the logical volume used in the last
+    backups, and a monitor is started in the background that extends it if it fills up.
+    Returns a dictionary with a result for each logical volume. A result has the
+    keys 'exit_code', 'message', 'snapshot', 'mount_path' and 'size_mb', and 'cleanup_failed'
+    if a failed snapshot could not be removed again.
+    The function takes four parameters: lv_paths, snap_suffix, freeze and mount
 
     Parameters
     ----------
-    lv_path :       The path of the logical volume to make snapshot of.
-    snap_suffix :   A suffix that will be appended to the name of the snapshot.
+    lv_paths :      List of paths of the logical volumes to make snapshots of.
+    snap_suffix :   A suffix that will be appended to the name of the snapshots.
                     This will need to be generated on the backup server, and
                     provided as a parameter when the script is called
+    freeze :        Freeze the file systems of the logical volumes while snapshotting
+    mount :         Mount the snapshots. Without mounting, only the snapshot devices are created
 
     """
 
-    log_and_print(arguments.verbosity_level,"info","create_lv_snapshot invoked with parameters:",LOG_FILE_PATH)
-    log_and_print(arguments.verbosity_level,"info","lv_path = "+lv_path,LOG_FILE_PATH)
+    log_and_print(arguments.verbosity_level,"info","create_lv_snapshots invoked with parameters:",LOG_FILE_PATH)
+    log_and_print(arguments.verbosity_level,"info","lv_paths = "+str(lv_paths),LOG_FILE_PATH)
     log_and_print(arguments.verbosity_level,"info","snap_suffix = "+snap_suffix,LOG_FILE_PATH)
+    log_and_print(arguments.verbosity_level,"info","freeze = "+str(freeze),LOG_FILE_PATH)
+
+    results = {}
+    def fail(lv_path, message):
+        log_and_print(arguments.verbosity_level,"critical",message,LOG_FILE_PATH)
+        results[lv_path] = {"exit_code": EXIT_CRITICAL, "message": message, "snapshot": None, "mount_path": None}
+
+    #Check that provided paths are valid and pointing to block devices
+    valid_lv_paths = []
+    for lv_path in lv_paths:
+        if verify_lv_path(lv_path):
+            valid_lv_paths.append(lv_path)
+        else:
+            fail(lv_path, "Logical volume path is not valid: "+lv_path)
+
+    #Snapshot space is planned from the free space in the volume groups, so only one job at a time
+    #may plan and create snapshots in a volume group. The locks are released once the snapshots exist
+    vg_names = sorted(set(lv_path.split("/")[2] for lv_path in valid_lv_paths))
+    vg_locks = []
+    try:
+        for vg_name in vg_names:
+            vg_locks.append(FileLock(volume_group_lock_path(vg_name), "initiate-backup "+snap_suffix).acquire(VG_LOCK_TIMEOUT))
+    except LockHeld as e:
+        for lock in vg_locks:
+            lock.release()
+        for lv_path in valid_lv_paths:
+            fail(lv_path, "Volume group is locked: "+str(e))
+        return results
+
+    #Plan snapshot space in each volume group
+    with metrics.span("vgs"):
+        vg_free_space = get_vg_free_space(vg_names)
+    planned_lv_paths = []
+    snapshot_sizes = {}
+    for lv_path in valid_lv_paths:
+        vg_name = lv_path.split("/")[2]
+        snapshot_sizes[lv_path] = planned_snapshot_size(lv_path, SNAPSHOT_SIZE)
+        if vg_name not in vg_free_space:
+            fail(lv_path, "Error while checking free space in volume group: "+vg_name)
+        elif snapshot_sizes[lv_path] >= vg_free_space[vg_name]:
+            fail(lv_path, "Not enough free space in volume group "+vg_name+" for a snapshot of "+str(snapshot_sizes[lv_path])+"M. A snapshot will not be created of "+lv_path)
+        else:
+            vg_free_space[vg_name] -= snapshot_sizes[lv_path]
+            planned_lv_paths.append(lv_path)
+
+    #Create all the snapshots back to back. Nothing is logged while file systems are frozen,
+    #since the log file might be on one of them
+    frozen_mount_points = []
+    lvcreate_results = []
+    try:
+        if freeze:
+            freeze_start = time.time()
+            frozen_mount_points = freeze_filesystems(planned_lv_paths)
+        for lv_path in planned_lv_paths:
+            lv_name = lv_path.split("/")[3]
+            with metrics.span("lvcreate", volume=lv_path) as span:
+                create_snap = subprocess.run(['lvcreate','-pr', '-L'+str(snapshot_sizes[lv_path])+'M', '-s', '-n', lv_name+snap_suffix, lv_path], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                if create_snap.returncode:
+                    span["status"] = "error"
+            lvcreate_results.append((lv_path, create_snap))
+    finally:
+        thaw_filesystems(frozen_mount_points)
+        if freeze:
+            #How long the file systems were frozen, with the snapshots created in between
+            metrics.add_spans([{"phase": "fsfreeze", "start": freeze_start, "duration": time.time() - freeze_start, "status": "ok"}])
+        for lock in vg_locks:
+            lock.release()
+
+    for lv_path, create_snap in lvcreate_results:
+        vg_name = lv_path.split("/")[2]
+        lv_name = lv_path.split("/")[3]
+        snap_mount_path = SNAPSHOT_MOUNT_PATH+"/"+lv_name+snap_suffix
+        if create_snap.returncode:
+            fail(lv_path, "Error while creating snapshot of "+lv_path+": "+create_snap.stderr)
+            continue
+        log_and_print(arguments.verbosity_level,"info",create_snap.stdout,LOG_FILE_PATH)
+        start_snapshot_monitor(lv_path, snap_suffix)
+        if not mount:
+            results[lv_path] = {"exit_code": EXIT_OK, "message": "Snapshot created", "snapshot": lv_path+snap_suffix, "mount_path": None, "size_mb": snapshot_sizes[lv_path]}
+            continue
+
+        (mount_status, message) = mount_snapshot(lv_path, snap_suffix)
+        if mount_status:
+            fail(lv_path, message)
+        else:
+            results[lv_path] = {"exit_code": EXIT_OK, "message": message, "snapshot": lv_path+snap_suffix, "mount_path": snap_mount_path, "size_mb": snapshot_sizes[lv_path]}
+            continue
 
-    #Check that provided path is valid and pointing to a block device
-    if not verify_lv_path(lv_path):
-        delete_lockfile(LOCK_FILE_PATH)
-        log_and_print(arguments.verbosity_level,"critical","Logical volume path is not valid. Exiting!",LOG_FILE_PATH)
-        sys.exit(EXIT_CRITICAL)
+        stop_snapshot_monitor(lv_path, snap_suffix)
+        if delete_lv_snapshot(lv_path,snap_suffix) == EXIT_CRITICAL:
+            log_and_print(arguments.verbosity_level,"critical","Unable to clean up snapshot",LOG_FILE_PATH)
+            results[lv_path]["cleanup_failed"] = True
+        else:
+            log_and_print(arguments.verbosity_level,"info","Clean up of snapshot was successful",LOG_FILE_PATH)
+
+    return results
+
+
+def mount_snapshot(lv_path, snap_suffix):
+    """
+    Mounts the snapshot of a logical volume in a subfolder of SNAPSHOT_MOUNT_PATH.
+    Returns a tuple with an exit code and a message.
+
+    Parameters
+    ----------
+    lv_path :       The path to the logical volume the snapshot was made of
+    snap_suffix :   The suffix of the snapshot
+
+    """
 
-    #Extract VG and LV portion of lv_path
     vg_name = lv_path.split("/")[2]
     lv_name = lv_path.split("/")[3]
+    snap_mount_path = SNAPSHOT_MOUNT_PATH+"/"+lv_name+snap_suffix
+    try:
+        os.makedirs(snap_mount_path, exist_ok=True)
+    except OSError as e:
+        return (EXIT_CRITICAL, "Unable to create directory to mount snapshot: "+snap_mount_path+": "+str(e))
+    with metrics.span("mount", volume=lv_path) as span:
+        mount_snap = subprocess.run(['mount','/dev/'+vg_name+'/'+lv_name+snap_suffix,snap_mount_path], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if mount_snap.returncode:
+            span["status"] = "error"
+    if mount_snap.returncode:
+        return (EXIT_CRITICAL, "Error while trying to mount snapshot: "+mount_snap.stderr)
+    log_and_print(arguments.verbosity_level,"info","Snapshot mounted successfully!",LOG_FILE_PATH)
+    return (EXIT_OK, "Snapshot mounted successfully")
+
+
+def get_vg_free_space(vg_names):
+    """
+    Returns a dictionary with the free space in megabytes of each of the given
+    volume groups. All the volume groups are queried with one call to 'vgs'.
+    Volume groups that could not be queried are left out of the dictionary.
 
-    #Run the command 'vgs %volume group name%'. Check for errors. Extract free space portion of returned output
-    space_in_vg = subprocess.run(['vgs', vg_name, '--noheadings', '--units', 'm', '--nosuffix'], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if space_in_vg.stderr:
+    Parameters
+    ----------
+    vg_names :      List of volume group names
+
+    """
+
+    if not vg_names:
+        return {}
+    space_in_vgs = subprocess.run(['vgs', '--noheadings', '--units', 'm', '--nosuffix', '-o', 'vg_name,vg_free'] + list(vg_names), encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if space_in_vgs.stderr:
         log_and_print(arguments.verbosity_level,"critical","Error while checking free space in volume group!",LOG_FILE_PATH)
-        log_and_print(arguments.verbosity_level,"critical",space_in_vg.stderr,LOG_FILE_PATH)
-        delete_lockfile(LOCK_FILE_PATH)
-        sys.exit(EXIT_CRITICAL)
-    space_in_vg = space_in_vg.stdout.split()[6]
-    space_in_vg = float(space_in_vg)
-
-    if SNAPSHOT_SIZE >= space_in_vg:
-        log_and_print(arguments.verbosity_level,"critical","Not enough free space in volume group. A snapshot will not be created",LOG_FILE_PATH)
-        delete_lockfile(LOCK_FILE_PATH)
-        sys.exit(EXIT_CRITICAL)
-
-    create_snap = subprocess.run(['lvcreate','-pr', '-L'+str(SNAPSHOT_SIZE)+'M', '-s', '-n', lv_name+snap_suffix, lv_path], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if create_snap.returncode:
-        log_and_print(arguments.verbosity_level,"critical","Error while creating snapshot",LOG_FILE_PATH)
-        log_and_print(arguments.verbosity_level,"critical",create_snap.stderr,LOG_FILE_PATH)
-        delete_lockfile(LOCK_FILE_PATH)
-        sys.exit(EXIT_CRITICAL)
-    else:
-        log_and_print(arguments.verbosity_level,"info",create_snap.stdout,LOG_FILE_PATH)
+        log_and_print(arguments.verbosity_level,"critical",space_in_vgs.stderr,LOG_FILE_PATH)
+    vg_free_space = {}
+    for line in space_in_vgs.stdout.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            vg_free_space[fields[0]] = float(fields[1])
+    return vg_free_space
 
-    make_mnt_dir = subprocess.run(['mkdir','-p',SNAPSHOT_MOUNT_PATH+"/"+lv_name+snap_suffix],encoding='utf-8', stderr=subprocess.PIPE)
-    if make_mnt_dir.stderr:
-        log_and_print(arguments.verbosity_level,"critical","Unable to create directory to mount snapshot",LOG_FILE_PATH)
-        if delete_lv_snapshot(lv_path,snap_suffix):
-            log_and_print(arguments.verbosity_level,"critical","Unable to clean up snapshot",LOG_FILE_PATH)
-            #Leave lock file since cleanup was not successfull
-        else:
-            log_and_print(arguments.verbosity_level,"info","Clean up of snapshot was successful",LOG_FILE_PATH)
-            delete_lockfile(LOCK_FILE_PATH)
-        sys.exit(EXIT_CRITICAL)
 
-    mount_snap = subprocess.run(['mount','/dev/'+vg_name+'/'+lv_name+snap_suffix,SNAPSHOT_MOUNT_PATH+"/"+lv_name+snap_suffix], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if mount_snap.returncode:
-        log_and_print(arguments.verbosity_level,"critical","Error while trying to mount snapshot",LOG_FILE_PATH)
-        log_and_print(arguments.verbosity_level,"critical",mount_snap.stderr,LOG_FILE_PATH)
-        if delete_lv_snapshot(lv_path,snap_suffix):
-            log_and_print(arguments.verbosity_level,"critical","Unable to clean up snapshot",LOG_FILE_PATH)
-            #Leave lock file since cleanup was not successfull
-        else:
-            log_and_print(arguments.verbosity_level,"info","Clean up of snapshot was successful",LOG_FILE_PATH)
-            delete_lockfile(LOCK_FILE_PATH)
-        sys.exit(EXIT_CRITICAL)
-    else:
-        log_and_print(arguments.verbosity_level,"info","Snapshot mounted successfully!",LOG_FILE_PATH)
+def mount_points_of(lv_paths):
+    """
+    Returns the mount points of the file systems on the given logical volumes, from /proc/mounts
+
+    """
+    devices = set(os.path.realpath(lv_path) for lv_path in lv_paths)
+    mount_points = []
+    with open("/proc/mounts", "r", encoding="utf-8") as mounts:
+        for line in mounts:
+            fields = line.split()
+            if fields[0].startswith("/dev/") and os.path.realpath(fields[0]) in devices and fields[1] not in mount_points:
+                mount_points.append(fields[1])
+    return mount_points
+
+
+def freeze_filesystems(lv_paths):
+    """
+    Freezes the file systems that the given logical volumes are mounted on, and
+    returns the list of mount points that were frozen. File systems that are not
+    mounted, or that can not be frozen, are skipped. Nothing is logged, since the
+    log file can be on one of the frozen file systems.
+
+    Parameters
+    ----------
+    lv_paths :      List of paths of the logical volumes
+
+    """
+
+    frozen_mount_points = []
+    for mount_point in mount_points_of(lv_paths):
+        proc = subprocess.run(['fsfreeze', '-f', mount_point], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if not proc.returncode:
+            frozen_mount_points.append(mount_point)
+    return frozen_mount_points
+
+
+def thaw_filesystems(mount_points):
+    """
+    Thaws file systems that were frozen by freeze_filesystems
+
+    Parameters
+    ----------
+    mount_points :  List of mount points to thaw
+
+    """
+
+    for mount_point in mount_points:
+        proc = subprocess.run(['fsfreeze', '-u', mount_point], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode:
+            log_and_print(arguments.verbosity_level,"critical","Unable to thaw file system: "+mount_point,LOG_FILE_PATH)
+            log_and_print(arguments.verbosity_level,"critical",proc.stderr,LOG_FILE_PATH)
+    if mount_points:
+        log_and_print(arguments.verbosity_level,"info","File systems frozen while creating snapshots: "+str(mount_points),LOG_FILE_PATH)
 
 # Need to add a check of the path to see that it is valid
 def delete_lv_snapshot(lv_path,snap_suffix):
@@ -132,7 +442,8 @@ def delete_lv_snapshot(lv_path,snap_suffix):
     points to an existing block device.
     The function takes two parameters: lv_path and snap_suffix
     Returns 0 if any one of the three tasks(unmount, delete mount folder, remove snapshot)
-    was completed successfully. Returns 1 if all three failed.
+    was completed successfully. Returns 1 if there was nothing to clean up.
+    Returns 2 if one of the tasks failed, and the snapshot may still be present.
 
     Parameters
     ----------
@@ -150,19 +461,20 @@ def delete_lv_snapshot(lv_path,snap_suffix):
 
     #Extract VG and LV portion of lv_path
     snapshot_path = lv_path+snap_suffix
-    vg_name = lv_path.split("/")[2]
     lv_name = lv_path.split("/")[3]
     snap_mount_path = SNAPSHOT_MOUNT_PATH+"/"+lv_name+snap_suffix
     status = 0
 
     ##### Unmount snapshot #####
-    check_if_mounted = subprocess.run(['grep','-qs',lv_name+snap_suffix,'/proc/mounts'], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if not check_if_mounted.returncode:
-        proc = subprocess.run(['umount', snap_mount_path], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if is_mount_point(snap_mount_path):
+        with metrics.span("umount", volume=lv_path) as span:
+            proc = subprocess.run(['umount', snap_mount_path], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if proc.returncode:
+                span["status"] = "error"
         if proc.returncode:
             log_and_print(arguments.verbosity_level,"critical","Error during unmounting of snapshot: "+snap_mount_path,LOG_FILE_PATH)
             log_and_print(arguments.verbosity_level,"critical",proc.stderr,LOG_FILE_PATH)
-            sys.exit(EXIT_CRITICAL)
+            return EXIT_CRITICAL
         else:
             log_and_print(arguments.verbosity_level,"info","Snapshot unmounted successfully",LOG_FILE_PATH)
     else:
@@ -171,25 +483,28 @@ def delete_lv_snapshot(lv_path,snap_suffix):
 
     ##### Delete mount folder #####
     if os.path.isdir(snap_mount_path):
-        # Should probably add a check here to verify that we are not deleting something we shouldn't
-        proc = subprocess.run(['rm','-rf',snap_mount_path], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if proc.returncode:
-            log_and_print(arguments.verbosity_level,"critical","Error while trying to remove snapshot mount folder: "+snap_mount_path,LOG_FILE_PATH)
-            log_and_print(arguments.verbosity_level,"critical",proc.stderr,LOG_FILE_PATH)
-            sys.exit(EXIT_CRITICAL)
-        else:
+        #rmdir, so that only an empty mount folder is removed, never the files of a snapshot that is still mounted
+        try:
+            os.rmdir(snap_mount_path)
             log_and_print(arguments.verbosity_level,"info","Snapshot mount folder '"+snap_mount_path+"' deleted successfully!",LOG_FILE_PATH)
+        except OSError as e:
+            log_and_print(arguments.verbosity_level,"critical","Error while trying to remove snapshot mount folder: "+snap_mount_path,LOG_FILE_PATH)
+            log_and_print(arguments.verbosity_level,"critical",str(e),LOG_FILE_PATH)
+            return EXIT_CRITICAL
     else:
         log_and_print(arguments.verbosity_level,"warning","Snapshot mount path was not found: "+snap_mount_path,LOG_FILE_PATH)
         status += 1
 
     ##### Remove snapshot #####
     if verify_lv_path(snapshot_path):
-        proc = subprocess.run(['lvremove', '-y', snapshot_path], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        with metrics.span("lvremove", volume=lv_path) as span:
+            proc = subprocess.run(['lvremove', '-y', snapshot_path], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if proc.returncode:
+                span["status"] = "error"
         if proc.returncode:
             log_and_print(arguments.verbosity_level,"critical","Error while trying to remove logical volume snapshot: "+snapshot_path,LOG_FILE_PATH)
             log_and_print(arguments.verbosity_level,"critical",proc.stderr,LOG_FILE_PATH)
-            sys.exit(EXIT_CRITICAL)
+            return EXIT_CRITICAL
         else:
             log_and_print(arguments.verbosity_level,"info","Logical volume snapshot removed successfully!",LOG_FILE_PATH)
             log_and_print(arguments.verbosity_level,"info",proc.stdout,LOG_FILE_PATH)
@@ -199,17 +514,408 @@ def delete_lv_snapshot(lv_path,snap_suffix):
 
     #Check how many of the tasks failed
     if status < 3:
-        return 0 #0 = OK
+        return EXIT_OK
     else:
-        return 1 #1 = Not OK
+        return EXIT_WARNING
+
+
+
+
+def start_snapshot_monitor(lv_path, snap_suffix):
+    """
+    Starts 'monitor-snapshot' for a snapshot as a background process, that keeps running
+    after this script has exited, until the snapshot is removed.
+
+    """
+    os.makedirs(TELEMETRY_DIRECTORY, exist_ok=True)
+    #stdout and stderr must not be inherited, or the SSH command that started this script would wait for the monitor
+    monitor_processes[lv_path+snap_suffix] = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'monitor-snapshot', '-l', lv_path, '-s', snap_suffix, '-v', str(arguments.verbosity_level)],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def monitor_snapshot(lv_path, snap_suffix):
+    """
+    Samples the fill level of a snapshot every MONITOR_INTERVAL seconds, and extends the
+    snapshot with lvextend before it fills up, see extension_needed. The samples are written
+    to the telemetry file of the snapshot, where end-backup and snapshot-status read them.
+    Runs until the snapshot is gone, or the process gets SIGTERM. Returns an exit code.
+
+    Parameters
+    ----------
+    lv_path :       The path to the logical volume the snapshot was made of
+    snap_suffix :   The suffix of the snapshot
+
+    """
+
+    snapshot_path = lv_path+snap_suffix
+    state_path = telemetry_path(lv_path, snap_suffix)
+    state = {"pid": os.getpid(), "snapshot": snapshot_path, "samples": [], "extensions": 0, "size_mb": None}
+    #An Event, so that SIGTERM also cuts the sleep between samples short
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    log_and_print(arguments.verbosity_level,"info","Monitoring snapshot "+snapshot_path,LOG_FILE_PATH)
+
+    while not stopping.is_set():
+        usage = read_snapshot_usage([snapshot_path]).get(snapshot_path)
+        if usage is None:
+            break
+        state["size_mb"] = usage["size_mb"]
+        #Keep the first sample, for the duration of the run
+        state["samples"] = state["samples"][:1] + state["samples"][1:][-359:] + [(time.time(), usage["used_mb"], usage["data_percent"], usage["invalid"])]
+        if usage["invalid"]:
+            log_and_print(arguments.verbosity_level,"critical","Snapshot "+snapshot_path+" is full and has been invalidated",LOG_FILE_PATH)
+            write_json(state_path, state)
+            break
+        extension = extension_needed(state["samples"], usage["size_mb"], EXTEND_THRESHOLD, MONITOR_INTERVAL * 2)
+        if extension:
+            #Extending takes free space in the volume group, that a job creating snapshots may be planning with
+            try:
+                vg_lock = FileLock(volume_group_lock_path(lv_path.split("/")[2]), "monitor-snapshot "+snap_suffix).acquire(MONITOR_INTERVAL)
+            except LockHeld as e:
+                log_and_print(arguments.verbosity_level,"warning","Unable to extend snapshot "+snapshot_path+" at "+str(usage["data_percent"])+"% yet: "+str(e),LOG_FILE_PATH)
+                vg_lock = None
+            if vg_lock is not None:
+                with vg_lock:
+                    extend = subprocess.run(['lvextend', '-L+'+str(extension)+'M', snapshot_path], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    if extend.returncode and extension > SNAPSHOT_SIZE:
+                        #Most likely not enough free space in the volume group for a large step. Try a small one
+                        extension = SNAPSHOT_SIZE
+                        extend = subprocess.run(['lvextend', '-L+'+str(extension)+'M', snapshot_path], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                if extend.returncode:
+                    log_and_print(arguments.verbosity_level,"critical","Unable to extend snapshot "+snapshot_path+" at "+str(usage["data_percent"])+"%: "+extend.stderr,LOG_FILE_PATH)
+                else:
+                    state["extensions"] += 1
+                    log_and_print(arguments.verbosity_level,"warning","Snapshot "+snapshot_path+" was "+str(usage["data_percent"])+"% full, extended by "+str(extension)+"M",LOG_FILE_PATH)
+        write_json(state_path, state)
+        stopping.wait(MONITOR_INTERVAL)
+    return EXIT_OK
+
+
+def stop_snapshot_monitor(lv_path, snap_suffix):
+    """
+    Stops the monitor of a snapshot, takes a last sample, and adds the run to the history
+    of the logical volume, that the next snapshot is sized from.
+    Returns the telemetry of the run (see summarize_run), or None if the snapshot was not monitored.
+
+    Parameters
+    ----------
+    lv_path :       The path to the logical volume the snapshot was made of
+    snap_suffix :   The suffix of the snapshot
 
+    """
+
+    snapshot_path = lv_path+snap_suffix
+    state_path = telemetry_path(lv_path, snap_suffix)
+    state = read_json(state_path, None)
+    if state is None:
+        return None
+    try:
+        os.kill(state["pid"], signal.SIGTERM)
+        #A monitor started by the agent is its child, and stays a zombie until it is waited for
+        process = monitor_processes.pop(snapshot_path, None)
+        if process is not None and process.pid == state["pid"]:
+            process.wait(5)
+        for attempt in range(50):
+            os.kill(state["pid"], 0)
+            time.sleep(0.1)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        pass
+    state = read_json(state_path, state)
+
+    usage = read_snapshot_usage([snapshot_path]).get(snapshot_path)
+    if usage is not None:
+        state["size_mb"] = usage["size_mb"]
+        state["samples"].append((time.time(), usage["used_mb"], usage["data_percent"], usage["invalid"]))
+    run = summarize_run(state["samples"], state["size_mb"], state["extensions"])
+    if run is not None:
+        append_history(lv_path, run)
+        log_and_print(arguments.verbosity_level,"info","Snapshot "+snapshot_path+" used "+str(round(run["peak_used_mb"]))+"M of "+str(run["size_mb"])+"M, "+str(round(run["write_rate_mb_s"], 3))+" MB/s",LOG_FILE_PATH)
+    os.remove(state_path)
+    return run
+
+
+def snapshot_status(lv_paths, snap_suffix):
+    """
+    Returns the fill level and monitor state of the snapshots of the given logical volumes,
+    as a dictionary from logical volume path to the current sample, or None if there is no snapshot
+
+    """
+    usage = read_snapshot_usage([lv_path+snap_suffix for lv_path in lv_paths])
+    status = {}
+    for lv_path in lv_paths:
+        status[lv_path] = usage.get(lv_path+snap_suffix)
+        if status[lv_path] is not None:
+            state = read_json(telemetry_path(lv_path, snap_suffix), {})
+            status[lv_path]["monitored"] = bool(state)
+            status[lv_path]["extensions"] = state.get("extensions", 0)
+    return status
+
+
+def sample_compression(lv_path, snap_suffix):
+    """
+    Estimates how well the files in the mounted snapshot of a logical volume compress, see
+    sample_compressibility, with the version of rsync on the client. Returns a tuple with
+    the exit code and the result, or None if the snapshot is not mounted.
+
+    Parameters
+    ----------
+    lv_path :       The path to the logical volume the snapshot was made of
+    snap_suffix :   The suffix of the snapshot
+
+    """
 
+    snap_mount_path = SNAPSHOT_MOUNT_PATH+"/"+lv_path.split("/")[3]+snap_suffix
+    if not is_mount_point(snap_mount_path):
+        log_and_print(arguments.verbosity_level,"critical","Snapshot is not mounted: "+snap_mount_path,LOG_FILE_PATH)
+        return (EXIT_CRITICAL, None)
+    with metrics.span("compression_sample", volume=lv_path):
+        result = sample_compressibility(snap_mount_path)
+    result["rsync_version"] = local_rsync_version()
+    result["spans"] = metrics.spans
+    log_and_print(arguments.verbosity_level,"info","Compression sample of "+snap_mount_path+": ratio "+str(round(result["ratio"], 3))+" from "+str(result["files"])+" files",LOG_FILE_PATH)
+    return (EXIT_OK, result)
+
+
+def content_manifest(lv_path, snap_suffix, percent, rotation, workers):
+    """
+    Writes the manifest of a sample of the files in the mounted snapshot of a logical volume
+    to stdout, see build_manifest, for the server to compare with the backup. Returns an exit code.
+
+    Parameters
+    ----------
+    lv_path :       The path to the logical volume the snapshot was made of
+    snap_suffix :   The suffix of the snapshot
+    percent :       Share of the files to hash
+    rotation :      Number of the verification run, that picks the files
+    workers :       Number of processes that hash the files
+
+    """
+
+    snap_mount_path = SNAPSHOT_MOUNT_PATH+"/"+lv_path.split("/")[3]+snap_suffix
+    if not is_mount_point(snap_mount_path):
+        log_and_print(arguments.verbosity_level,"critical","Snapshot is not mounted: "+snap_mount_path,LOG_FILE_PATH)
+        return EXIT_CRITICAL
+    write_manifest(build_manifest(snap_mount_path, percent, rotation, workers), sys.stdout)
+    return EXIT_OK
+
+
+def block_send(lv_path, snap_suffix, block_size, rate_limit=None):
+    """
+    Streams the blocks of a logical volume snapshot that have changed since the last
+    backup to stdout. The block manifest of the last backup is read from stdin; an
+    empty manifest sends every block. See block_transfer.py for the stream format.
+    Returns an exit code.
+
+    Parameters
+    ----------
+    lv_path :       The path to the logical volume the snapshot was made of
+    snap_suffix :   The suffix of the snapshot
+    block_size :    Size of each block in bytes
+    rate_limit :    Highest rate to send at in bytes per second, or None
+
+    """
+
+    #The stream owns stdout, so everything that is printed goes to stderr instead
+    stream = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    sys.stdout = sys.stderr
+
+    log_and_print(arguments.verbosity_level,"info","block_send invoked with parameters:",LOG_FILE_PATH)
+    log_and_print(arguments.verbosity_level,"info","lv_path = "+lv_path,LOG_FILE_PATH)
+    log_and_print(arguments.verbosity_level,"info","snap_suffix = "+snap_suffix,LOG_FILE_PATH)
+
+    snapshot_path = lv_path+snap_suffix
+    if not verify_lv_path(snapshot_path):
+        log_and_print(arguments.verbosity_level,"critical","Snapshot not found: "+snapshot_path,LOG_FILE_PATH)
+        return EXIT_CRITICAL
+    manifest_data = sys.stdin.buffer.read()
+    try:
+        result = send_changed_blocks(zfsync_path(snapshot_path), manifest_data, stream, block_size, rate_limit)
+        stream.close()
+    except OSError as e:
+        log_and_print(arguments.verbosity_level,"critical","Error while sending blocks of "+snapshot_path+": "+str(e),LOG_FILE_PATH)
+        return EXIT_CRITICAL
+    log_and_print(arguments.verbosity_level,"info","Sent "+str(result["blocks_sent"])+" of "+str(result["blocks_total"])+" blocks of "+snapshot_path,LOG_FILE_PATH)
+    return EXIT_OK
+
+
+def block_receive(lv_path, size=None):
+    """
+    Writes a block stream from stdin onto a logical volume, to restore an image backup with
+    server_restore.py. See block_transfer.py for the stream format. Every few blocks, the
+    offset up to which the stream is on disk is printed as a result line, so that the server
+    can resume an interrupted restore from there. Returns an exit code.
+
+    Parameters
+    ----------
+    lv_path :   The path to the logical volume to restore onto
+    size :      Size of the image that is restored, to check that it fits, or None
+
+    """
+
+    log_and_print(arguments.verbosity_level,"info","block_receive invoked with parameters:",LOG_FILE_PATH)
+    log_and_print(arguments.verbosity_level,"info","lv_path = "+lv_path,LOG_FILE_PATH)
+
+    if not verify_lv_path(lv_path):
+        log_and_print(arguments.verbosity_level,"critical","Logical volume not found: "+lv_path,LOG_FILE_PATH)
+        return EXIT_CRITICAL
+    device_path = zfsync_path(lv_path)
+    mount_points = mount_points_of([device_path])
+    if mount_points:
+        log_and_print(arguments.verbosity_level,"critical","Refusing to restore onto "+lv_path+", it is mounted on "+", ".join(mount_points),LOG_FILE_PATH)
+        return EXIT_CRITICAL
+    #The streams of a restore run side by side, so they can not take the lock of the logical volume; a backup that holds it must not be running
+    (status, owner) = lock_status(logical_volume_lock_path(lv_path))
+    if status == "running":
+        log_and_print(arguments.verbosity_level,"critical","Refusing to restore onto "+lv_path+", it is locked by "+describe_owner(owner),LOG_FILE_PATH)
+        return EXIT_CRITICAL
+    if size is not None:
+        with open(device_path, "rb") as device:
+            device_size = device.seek(0, os.SEEK_END)
+        if device_size < size:
+            log_and_print(arguments.verbosity_level,"critical","Logical volume "+lv_path+" has "+str(device_size)+" bytes, the image needs "+str(size),LOG_FILE_PATH)
+            return EXIT_CRITICAL
+
+    try:
+        result = receive_changed_blocks(sys.stdin.buffer, device_path, None, lambda offset: print_result({"synced": offset}))
+    except (OSError, EOFError, ValueError) as e:
+        log_and_print(arguments.verbosity_level,"critical","Error while restoring onto "+lv_path+": "+str(e),LOG_FILE_PATH)
+        return EXIT_CRITICAL
+    log_and_print(arguments.verbosity_level,"info","Restored "+str(result["blocks_received"])+" blocks, "+str(result["bytes_received"])+" bytes onto "+lv_path,LOG_FILE_PATH)
+    return EXIT_OK
+
+
+def index_path(lv_path, dataset_name, name):
+    """
+    Returns the path of one of the index files of a logical volume in INDEX_DIRECTORY.
+    Every backup job has a directory of its own, as jobs that back up the same logical
+    volume each compare with their own last backup.
+    name is 'last', 'full', 'pending', 'changes' or 'state'
+
+    """
+    extension = {"changes": ".changes", "state": ".json"}.get(name, ".gz")
+    return INDEX_DIRECTORY+"/"+dataset_name.replace("/", "_")+"/"+lv_path.split("/")[2]+"_"+lv_path.split("/")[3]+"."+name+extension
+
+
+def read_index_state(lv_path, dataset_name):
+    try:
+        with open(index_path(lv_path, dataset_name, "state"), "r", encoding="utf-8") as state:
+            return json.load(state)
+    except (OSError, ValueError):
+        return {"runs_since_verify": 0}
+
+
+def scan_changes(lv_path, dataset_name, snap_suffix, base):
+    """
+    Walks the mounted snapshot of a logical volume, and writes a new file index of it.
+    At the same time the walk is compared with the index of the last backup (or the last
+    full backup), and every path that was added, changed or deleted since is written
+    to a changes file, that the server can give rsync with --files-from.
+    The new index is kept as 'pending' until commit-index is called after a successful
+    backup. The result also has the dataset of the backup the base index was committed for,
+    so that the server can check it is the backup it compares with.
+    Returns a tuple with the exit code and the result, or None if the scan failed.
+
+    Parameters
+    ----------
+    lv_path :       The path to the logical volume the snapshot was made of
+    dataset_name :  Root dataset of the backup job
+    snap_suffix :   The suffix of the snapshot
+    base :          'last' or 'full': which index to compare with
+
+    """
+
+    log_and_print(arguments.verbosity_level,"info","scan_changes invoked with parameters:",LOG_FILE_PATH)
+    log_and_print(arguments.verbosity_level,"info","lv_path = "+lv_path,LOG_FILE_PATH)
+    log_and_print(arguments.verbosity_level,"info","dataset_name = "+dataset_name,LOG_FILE_PATH)
+    log_and_print(arguments.verbosity_level,"info","snap_suffix = "+snap_suffix,LOG_FILE_PATH)
+    log_and_print(arguments.verbosity_level,"info","base = "+base,LOG_FILE_PATH)
+
+    snap_mount_path = SNAPSHOT_MOUNT_PATH+"/"+lv_path.split("/")[3]+snap_suffix
+    if not is_mount_point(snap_mount_path):
+        log_and_print(arguments.verbosity_level,"critical","Snapshot is not mounted: "+snap_mount_path,LOG_FILE_PATH)
+        return (EXIT_CRITICAL, None)
+    os.makedirs(os.path.dirname(index_path(lv_path, dataset_name, "state")), exist_ok=True)
+
+    base_index_path = index_path(lv_path, dataset_name, base)
+    base_found = os.path.isfile(base_index_path)
+    changed = 0
+    deleted = 0
+    with metrics.span("scan_changes", volume=lv_path) as span:
+        try:
+            new_entries = write_index(walk_tree(snap_mount_path), index_path(lv_path, dataset_name, "pending"))
+            with open(index_path(lv_path, dataset_name, "changes"), "w", encoding="utf-8", errors="surrogateescape") as changes:
+                if base_found:
+                    for (change, path) in diff_index(read_index(base_index_path), new_entries):
+                        changes.write(path+"\n")
+                        if change == "deleted":
+                            deleted += 1
+                        else:
+                            changed += 1
+                else:
+                    #write_index writes the index as its entries are read, so without a base to compare with they are read here, and dropped
+                    collections.deque(new_entries, maxlen=0)
+        except (OSError, ValueError) as e:
+            span["status"] = "error"
+            log_and_print(arguments.verbosity_level,"critical","Error while scanning "+snap_mount_path+": "+str(e),LOG_FILE_PATH)
+            return (EXIT_CRITICAL, None)
+
+    log_and_print(arguments.verbosity_level,"info","Scan of "+snap_mount_path+" found "+str(changed)+" changed and "+str(deleted)+" deleted paths",LOG_FILE_PATH)
+    state = read_index_state(lv_path, dataset_name)
+    return (EXIT_OK, {"base_found": base_found, "base_dataset": state.get(base), "changed": changed, "deleted": deleted,
+                      "changes_path": index_path(lv_path, dataset_name, "changes"), "runs_since_verify": state["runs_since_verify"], "spans": metrics.spans})
+
+
+def commit_index(lv_path, dataset_name, backup_dataset, backup_type, verified):
+    """
+    Makes the pending index from scan-changes the index of the last backup, and also of
+    the last full backup if backup_type is 'full'. The dataset of the backup is kept in the
+    state of the index, as the base the next scan-changes compares with. Counts the runs since
+    the last backup made with a full walk, unless verified is True. Returns an exit code.
+
+    Parameters
+    ----------
+    lv_path :       The path to the logical volume
+    dataset_name :  Root dataset of the backup job
+    backup_dataset : The dataset of the backup that was made
+    backup_type :   The type of the backup that was made
+    verified :      True if the backup was made with a full walk of the snapshot
+
+    """
+
+    log_and_print(arguments.verbosity_level,"info","commit_index invoked with parameters:",LOG_FILE_PATH)
+    log_and_print(arguments.verbosity_level,"info","lv_path = "+lv_path,LOG_FILE_PATH)
+    log_and_print(arguments.verbosity_level,"info","dataset_name = "+dataset_name,LOG_FILE_PATH)
+    log_and_print(arguments.verbosity_level,"info","backup_dataset = "+str(backup_dataset),LOG_FILE_PATH)
+    log_and_print(arguments.verbosity_level,"info","backup_type = "+str(backup_type),LOG_FILE_PATH)
+
+    pending_path = index_path(lv_path, dataset_name, "pending")
+    if not os.path.isfile(pending_path):
+        log_and_print(arguments.verbosity_level,"warning","There is no pending index for "+lv_path,LOG_FILE_PATH)
+        return EXIT_WARNING
+    os.replace(pending_path, index_path(lv_path, dataset_name, "last"))
+    if backup_type == "full":
+        shutil.copyfile(index_path(lv_path, dataset_name, "last"), index_path(lv_path, dataset_name, "full")+".tmp")
+        os.replace(index_path(lv_path, dataset_name, "full")+".tmp", index_path(lv_path, dataset_name, "full"))
+
+    state = read_index_state(lv_path, dataset_name)
+    state["runs_since_verify"] = 0 if verified else state["runs_since_verify"] + 1
+    #The backups the 'last' and 'full' indexes were made for, that scan-changes reports as its base
+    state["last"] = backup_dataset
+    if backup_type == "full":
+        state["full"] = backup_dataset
+    state_path = index_path(lv_path, dataset_name, "state")
+    with open(state_path+".tmp", "w", encoding="utf-8") as state_file:
+        json.dump(state, state_file)
+    os.replace(state_path+".tmp", state_path)
+    log_and_print(arguments.verbosity_level,"info","Index committed for "+lv_path,LOG_FILE_PATH)
+    return EXIT_OK
 
 
 def verify_lv_path(lv_path):
     """
     Returns true if path exists and is pointing to a block device. Or else returns
-    false.
+    false. Regular files are accepted too when ZFSYNC_ALLOW_FILE_DEVICES is set, for the
+    benchmarks, where logical volumes are image files.
     The function takes one parameter: lv_path
 
     Parameters
@@ -221,9 +927,10 @@ def verify_lv_path(lv_path):
     log_and_print(arguments.verbosity_level,"info","verify_lv_path invoked with parameters:",LOG_FILE_PATH)
     log_and_print(arguments.verbosity_level,"info","lv_path = "+lv_path,LOG_FILE_PATH)
 
-    if os.path.exists(lv_path):
-        mode = os.stat(lv_path).st_mode
-        if stat.S_ISBLK(mode):
+    device_path = zfsync_path(lv_path)
+    if os.path.exists(device_path):
+        mode = os.stat(device_path).st_mode
+        if stat.S_ISBLK(mode) or (ALLOW_FILE_DEVICES and stat.S_ISREG(mode)):
             log_and_print(arguments.verbosity_level,"info","The path exists and is a block device: "+lv_path,LOG_FILE_PATH)
             return True
         else:
@@ -234,5 +941,17 @@ def verify_lv_path(lv_path):
         return False
 
 
+#Methods of the agent: each takes the params of a request, and returns a tuple with the exit code and the result
+AGENT_METHODS = {
+    "snapshot": lambda lv_paths, snap_suffix, freeze=False, mount=True: control_action("initiate-backup", lv_paths, snap_suffix, freeze, mount),
+    "cleanup": lambda lv_paths, snap_suffix: control_action("end-backup", lv_paths, snap_suffix),
+    "mount": agent_mount,
+    "status": agent_status,
+    "stat-scan": lambda lv_path, dataset_name, snap_suffix, base="last": scan_changes(lv_path, dataset_name, snap_suffix, base),
+    "commit-index": lambda lv_path, dataset_name, backup_dataset, backup_type, verified=False: (commit_index(lv_path, dataset_name, backup_dataset, backup_type, verified), None),
+    "sample-compression": sample_compression,
+}
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,153 @@
+#! /usr/bin/env python3.6
+
+import argparse, hashlib, json, multiprocessing, os, sys, zlib
+from file_index import walk_tree, compare_key
+
+DIGEST_SIZE = 16
+READ_SIZE = 1024 * 1024 #In bytes
+MAX_EXAMPLES = 10 #Paths of differences kept in the result of compare_manifests
+
+root_path = None #Root of the tree being hashed, in the worker processes
+
+def in_sample(path, percent, rotation):
+    """
+    Returns True if a path is in the sample of a verification run. Paths are put in one of
+    100 buckets by the crc32 of the path, and each run takes the next 'percent' buckets,
+    so every path is verified once every ceil(100 / percent) runs.
+
+    Parameters
+    ----------
+    path :      Path relative to the root of the tree
+    percent :   Share of the buckets to take, 100 to take every path
+    rotation :  Number of the verification run, that picks the buckets
+
+    """
+    if percent >= 100:
+        return True
+    bucket = zlib.crc32(path.encode("utf-8", "surrogateescape")) % 100
+    return (bucket - rotation * percent) % 100 < percent
+
+def hash_entry(entry):
+    """
+    Returns a manifest entry (path, kind, size, digest) for an entry of walk_tree: the
+    blake2b digest of the content of a file, or of the target of a symbolic link.
+    The digest is None if the file can not be read.
+
+    """
+    (path, kind, size) = entry[:3]
+    absolute_path = os.path.join(root_path, path)
+    try:
+        if kind == "l":
+            return (path, kind, size, hashlib.blake2b(os.fsencode(os.readlink(absolute_path)), digest_size=DIGEST_SIZE).hexdigest())
+        digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+        size = 0
+        with open(absolute_path, "rb") as content:
+            for data in iter(lambda: content.read(READ_SIZE), b""):
+                digest.update(data)
+                size += len(data)
+        return (path, kind, size, digest.hexdigest())
+    except OSError:
+        return (path, kind, size, None)
+
+def set_root(path):
+    global root_path
+    root_path = path
+
+def build_manifest(path, percent=100, rotation=0, workers=1):
+    """
+    Walks a tree and yields a manifest entry (path, kind, size, digest) for every file and
+    symbolic link in the sample, in the order of walk_tree. The files are hashed by 'workers'
+    processes while the walk goes on, so hashing starts before the walk is done.
+
+    Parameters
+    ----------
+    path :      Root of the tree, like the mount path of a snapshot
+    percent :   Share of the files to hash, see in_sample
+    rotation :  Number of the verification run, see in_sample
+    workers :   Number of processes that hash the files
+
+    """
+    entries = (entry for entry in walk_tree(path) if entry[1] in ("f", "l") and in_sample(entry[0], percent, rotation))
+    if workers <= 1:
+        set_root(path)
+        yield from map(hash_entry, entries)
+        return
+    with multiprocessing.Pool(workers, initializer=set_root, initargs=(path,)) as pool:
+        yield from pool.imap(hash_entry, entries, chunksize=16)
+
+def write_manifest(entries, output):
+    """
+    Writes manifest entries to a text stream, one JSON array per line, so that any
+    path survives the trip, and flushes at the end
+
+    """
+    for entry in entries:
+        output.write(json.dumps(entry) + "\n")
+    output.flush()
+
+def read_manifest(stream):
+    """
+    Yields the manifest entries from a stream written by write_manifest, like the stdout of
+    a command on the client. Lines can be str or bytes; lines that are not entries, like
+    log messages of the client, are skipped.
+
+    """
+    while True:
+        line = stream.readline()
+        if not line:
+            return
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "surrogateescape")
+        if line.startswith("["):
+            yield tuple(json.loads(line))
+
+def compare_manifests(source_entries, copy_entries):
+    """
+    Compares two manifests of the same sample, as yielded by build_manifest, in one merge pass.
+    Returns a dictionary with the number of files and bytes checked, and the number of files
+    that differ, are missing in the copy, are extra in the copy or could not be read, with
+    the paths of the first MAX_EXAMPLES of them.
+
+    Parameters
+    ----------
+    source_entries :    Manifest of the snapshot
+    copy_entries :      Manifest of the backup
+
+    """
+    result = {"files": 0, "bytes": 0, "mismatched": 0, "missing": 0, "extra": 0, "unreadable": 0, "examples": []}
+    def difference(kind, path):
+        result[kind] += 1
+        if len(result["examples"]) < MAX_EXAMPLES:
+            result["examples"].append(kind + " " + path)
+
+    source_entries = iter(source_entries)
+    copy_entries = iter(copy_entries)
+    source = next(source_entries, None)
+    copy = next(copy_entries, None)
+    while source is not None or copy is not None:
+        if copy is None or (source is not None and compare_key(source[0]) < compare_key(copy[0])):
+            difference("missing", source[0])
+            source = next(source_entries, None)
+        elif source is None or compare_key(copy[0]) < compare_key(source[0]):
+            difference("extra", copy[0])
+            copy = next(copy_entries, None)
+        else:
+            result["files"] += 1
+            result["bytes"] += source[2]
+            if source[3] is None or copy[3] is None:
+                difference("unreadable", source[0])
+            elif source[1:] != copy[1:]:
+                difference("mismatched", source[0])
+            source = next(source_entries, None)
+            copy = next(copy_entries, None)
+    return result
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='Write the content manifest of a sample of the files in a tree to stdout, one JSON array per line.')
+    arg_parser.add_argument("path", help="Root of the tree")
+    arg_parser.add_argument('--verify-percent', type=int, default=100, help='Share of the files to hash')
+    arg_parser.add_argument('--rotation', type=int, default=0, help='Number of the verification run, that picks the files of the sample')
+    arg_parser.add_argument('--workers', type=int, default=1, help='Number of processes that hash the files')
+    arguments = arg_parser.parse_args()
+    write_manifest(build_manifest(arguments.path, arguments.verify_percent, arguments.rotation, arguments.workers), sys.stdout)
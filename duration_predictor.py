@@ -0,0 +1,181 @@
+#! /usr/bin/env python3.6
+
+import argparse, glob, json, os, sys
+from shared_functions import *
+from rsync_stats import read_stats_record
+from backup_catalog import open_catalog
+from backup_planner import plan_backup_type
+
+HISTORY_RUNS = 30 #The last runs of a job that its predictions are based on
+SMOOTHING = 0.3 #Weight of the newest run in the moving averages. Higher follows changes faster, lower smooths out odd runs
+BACKUP_TYPES = ("full", "diff", "inc")
+
+def merged_seconds(spans):
+    """
+    Returns the wall time covered by a list of spans, counting time where several spans ran
+    at the same time once, like the transfers of volumes that were backed up in parallel
+
+    """
+    seconds = 0.0
+    end = None
+    for span in sorted(spans, key=lambda span: span["start"]):
+        span_end = span["start"] + span["duration"]
+        if end is None or span["start"] >= end:
+            seconds += span["duration"]
+            end = span_end
+        elif span_end > end:
+            seconds += span_end - end
+            end = span_end
+    return seconds
+
+
+def read_run_history(root_dataset_name, limit=HISTORY_RUNS):
+    """
+    Returns the last successful runs of a backup job, oldest first, from the metrics JSON the
+    executor writes next to each job log, and the stats records of the volumes of the run.
+    Each run is a dictionary with the backup type, the duration of the whole job, the wall time
+    of the transfers, the overhead (the rest of the job: snapshots, mounts, zfs, verification),
+    and the bytes transferred and the files scanned by rsync or the block transfer.
+
+    Parameters
+    ----------
+    root_dataset_name :     ZFS name of the root dataset of the backup job
+    limit :                 Number of runs to read
+
+    """
+    runs = []
+    for metrics_path in sorted(glob.glob(glob.escape(dataset_path(root_dataset_name))+"/*.metrics.json"))[-limit:]:
+        run_name = os.path.basename(metrics_path)[:-len(".metrics.json")]
+        (timestamp, backup_type) = run_name.rsplit("_", 1) if "_" in run_name else (run_name, None)
+        if backup_type not in BACKUP_TYPES:
+            continue #Like a run with '-t auto' that stopped before its type was picked
+        try:
+            with open(metrics_path, "r", encoding="utf-8") as metrics_file:
+                spans = json.load(metrics_file)["spans"]
+        except (OSError, ValueError, KeyError):
+            continue
+        job_spans = [span for span in spans if span["phase"] == "job"]
+        if not job_spans or job_spans[-1]["status"] != "ok":
+            continue #A failed run says little about how long the next one takes
+        records = [record for record in (read_stats_record(path) for path in glob.glob(glob.escape(dataset_path(root_dataset_name)+"/"+run_name)+"_*.stats.json")) if record is not None]
+        duration = job_spans[-1]["duration"]
+        transfer_seconds = min(duration, merged_seconds([span for span in spans if span["phase"] == "transfer"]))
+        runs.append({"timestamp": timestamp, "backup_type": backup_type, "duration": duration, "transfer_seconds": transfer_seconds,
+                     "overhead_seconds": duration - transfer_seconds,
+                     "bytes": sum(record.get("literal_bytes") or 0 for record in records),
+                     "files": sum(record.get("files_total") or 0 for record in records)})
+    return runs
+
+
+def moving_average(values):
+    """
+    Returns the exponentially weighted moving average of a list of values, oldest first, or None for an empty list
+
+    """
+    average = None
+    for value in values:
+        average = value if average is None else SMOOTHING * value + (1 - SMOOTHING) * average
+    return average
+
+
+def predict_run(history, backup_type, estimated_bytes=None):
+    """
+    Predicts the duration and the bytes to transfer of the next run of a backup job.
+    Returns a dictionary with the backup type, the duration, transfer and overhead seconds, the
+    bytes and files, the number of runs of the type it is based on, and the basis: 'history' when
+    there are runs of the same type, 'rate' when it is worked out from the runs of other types,
+    or 'none' when there is no history at all, and the duration is None.
+
+    Each part is a moving average over the runs of the type, so one odd run does not throw the
+    prediction off, and a job that grows is followed within a few runs. When the bytes are
+    estimated otherwise, like by backup_planner.py from what changed since the last backup, the
+    transfer time is scaled by how much the estimate differs from the average. Without runs of
+    the type, the transfer time is the bytes over the transfer rate of all the runs of the job.
+
+    Parameters
+    ----------
+    history :           Runs of the job, from read_run_history
+    backup_type :       'full', 'diff' or 'inc'
+    estimated_bytes :   Estimate of the bytes the run will transfer, or None to use the history
+
+    """
+    runs = [run for run in history if run["backup_type"] == backup_type]
+    prediction = {"backup_type": backup_type, "duration": None, "transfer_seconds": None, "overhead_seconds": None,
+                  "bytes": estimated_bytes, "files": moving_average([run["files"] for run in runs]), "runs": len(runs), "basis": "none"}
+    if not history:
+        return prediction
+
+    if runs:
+        average_bytes = moving_average([run["bytes"] for run in runs])
+        transfer_seconds = moving_average([run["transfer_seconds"] for run in runs])
+        if estimated_bytes is not None and average_bytes:
+            transfer_seconds *= estimated_bytes / average_bytes
+        prediction.update(bytes=average_bytes if estimated_bytes is None else estimated_bytes, transfer_seconds=transfer_seconds,
+                          overhead_seconds=moving_average([run["overhead_seconds"] for run in runs]), basis="history")
+    else:
+        transfer_seconds = sum(run["transfer_seconds"] for run in history)
+        rate = sum(run["bytes"] for run in history) / transfer_seconds if transfer_seconds > 0 else 0
+        if estimated_bytes is None or not rate:
+            return prediction
+        prediction.update(transfer_seconds=estimated_bytes / rate, overhead_seconds=moving_average([run["overhead_seconds"] for run in history]), basis="rate")
+    prediction["duration"] = prediction["transfer_seconds"] + prediction["overhead_seconds"]
+    return prediction
+
+
+def predict_next_run(root_dataset_name, backup_type, diff_every=0, full_every=0):
+    """
+    Predicts the next run of a backup job with predict_run, from its history and the estimates of
+    plan_backup_type, which also picks the type for 'auto'. The estimate is used for a diff, as
+    only 'written@' knows what changed since the full backup, and for types without runs. Otherwise
+    the history is better: the inc estimate is one run of it, and the full estimate is the size on
+    disk, after compression.
+
+    Parameters
+    ----------
+    root_dataset_name :     ZFS name of the root dataset of the backup job
+    backup_type :           'full', 'diff', 'inc' or 'auto'
+    diff_every :            diff_every of the schedule, for 'auto'
+    full_every :            full_every of the schedule, for 'auto'
+
+    """
+    history = read_run_history(root_dataset_name)
+    catalog = open_catalog(root_dataset_name)
+    try:
+        plan = plan_backup_type(catalog, root_dataset_name, diff_every, full_every)
+        if backup_type == "auto":
+            backup_type = plan["backup_type"]
+        elif catalog.last_backup("full" if backup_type == "diff" else None) is None:
+            backup_type = "full" #Like create_dataset, a backup without a base is a full backup
+    finally:
+        catalog.close()
+    estimated_bytes = plan["estimates"][backup_type]
+    if backup_type != "diff" and any(run["backup_type"] == backup_type for run in history):
+        estimated_bytes = None
+    return predict_run(history, backup_type, estimated_bytes)
+
+
+def format_seconds(seconds):
+    """
+    Returns a duration as 'H:MM:SS', or 'unknown' for None
+
+    """
+    if seconds is None:
+        return "unknown"
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Show the predicted duration and transfer of the next full, diff, inc and auto backup of a backup job, from its past runs.")
+    arg_parser.add_argument("root_dataset_name", help="Name of the root dataset of the backup job. Example: backup/job1")
+    arg_parser.add_argument('--diff-every', type=int, default=0, help='diff_every of the schedule in the job file, for auto')
+    arg_parser.add_argument('--full-every', type=int, default=0, help='full_every of the schedule in the job file, for auto')
+    arguments = arg_parser.parse_args()
+    if not os.path.isdir(dataset_path(arguments.root_dataset_name)):
+        print("Backup job "+arguments.root_dataset_name+" does not exist")
+        sys.exit(EXIT_CRITICAL)
+    for backup_type in BACKUP_TYPES + ("auto",):
+        prediction = predict_next_run(arguments.root_dataset_name, backup_type, arguments.diff_every, arguments.full_every)
+        print(backup_type+("" if prediction["backup_type"] == backup_type else " ("+prediction["backup_type"]+")")+": "+format_seconds(prediction["duration"])+
+              " (transfer "+format_seconds(prediction["transfer_seconds"])+", overhead "+format_seconds(prediction["overhead_seconds"])+"), "+
+              ("unknown" if prediction["bytes"] is None else str(int(prediction["bytes"])))+" bytes, based on "+str(prediction["runs"])+" runs ("+prediction["basis"]+")")
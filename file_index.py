@@ -0,0 +1,99 @@
+import os, stat, gzip
+
+INDEX_VERSION = "zfsync-index 1"
+
+def walk_tree(root_path):
+    """
+    Walks a directory tree and yields (relative path, kind, size, mtime_ns, ctime_ns, inode)
+    for every entry. Entries are yielded depth first with the names of each directory sorted,
+    so two walks can be compared with a single merge pass, see compare_key. Mount points
+    below root_path are not crossed.
+
+    Parameters
+    ----------
+    root_path :     The directory to walk, like the mount path of a snapshot
+
+    """
+    return walk_subtree("", root_path, os.lstat(root_path).st_dev)
+
+def walk_subtree(relative_dir, absolute_dir, root_device):
+    try:
+        entries = sorted(os.scandir(absolute_dir), key=lambda entry: entry.name)
+    except OSError:
+        return
+    for entry in entries:
+        relative_path = relative_dir + entry.name
+        try:
+            entry_stat = entry.stat(follow_symlinks=False)
+        except OSError:
+            continue
+        mode = entry_stat.st_mode
+        kind = "d" if stat.S_ISDIR(mode) else "l" if stat.S_ISLNK(mode) else "f" if stat.S_ISREG(mode) else "o"
+        yield (relative_path, kind, entry_stat.st_size, entry_stat.st_mtime_ns, entry_stat.st_ctime_ns, entry_stat.st_ino)
+        if kind == "d" and entry_stat.st_dev == root_device:
+            yield from walk_subtree(relative_path + "/", entry.path, root_device)
+
+def compare_key(path):
+    """
+    Sort key matching the order of walk_tree: paths are compared one component at a time
+
+    """
+    return path.split("/")
+
+def write_index(entries, index_path):
+    """
+    Writes entries from walk_tree to a gzip compressed index file, one tab separated
+    line per entry, and yields the entries on, so that the index can be written while
+    the walk is compared against the previous index.
+
+    """
+    with gzip.open(index_path, "wt", encoding="utf-8", errors="surrogateescape", compresslevel=1) as index:
+        index.write(INDEX_VERSION + "\n")
+        for entry in entries:
+            index.write("%s\t%s\t%d\t%d\t%d\t%d\n" % entry)
+            yield entry
+
+def read_index(index_path):
+    """
+    Yields the entries of an index file written by write_index
+
+    """
+    with gzip.open(index_path, "rt", encoding="utf-8", errors="surrogateescape") as index:
+        if index.readline().rstrip("\n") != INDEX_VERSION:
+            raise ValueError("Unknown index format: "+index_path)
+        for line in index:
+            fields = line.rstrip("\n").split("\t")
+            yield (fields[0], fields[1], int(fields[2]), int(fields[3]), int(fields[4]), int(fields[5]))
+
+def diff_index(old_entries, new_entries):
+    """
+    Compares two sorted streams of index entries, and yields ('changed', path) for every
+    entry that is new or whose type, size, mtime, ctime or inode differs, and
+    ('deleted', path) for every entry that is gone. Only the top most deleted directory
+    of a deleted tree is reported.
+
+    Parameters
+    ----------
+    old_entries :   Entries of the previous index
+    new_entries :   Entries of the new walk
+
+    """
+    old_entries = iter(old_entries)
+    new_entries = iter(new_entries)
+    old = next(old_entries, None)
+    new = next(new_entries, None)
+    deleted_dir = None
+    while old is not None or new is not None:
+        if new is None or (old is not None and compare_key(old[0]) < compare_key(new[0])):
+            if deleted_dir is None or not old[0].startswith(deleted_dir):
+                yield ("deleted", old[0])
+                deleted_dir = old[0] + "/" if old[1] == "d" else None
+            old = next(old_entries, None)
+        elif old is None or compare_key(new[0]) < compare_key(old[0]):
+            yield ("changed", new[0])
+            new = next(new_entries, None)
+        else:
+            if old[1:] != new[1:]:
+                yield ("changed", new[0])
+            old = next(old_entries, None)
+            new = next(new_entries, None)
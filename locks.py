@@ -0,0 +1,172 @@
+import fcntl, json, os, socket, time
+from shared_functions import zfsync_path
+
+CLIENT_LOCK_DIRECTORY = zfsync_path("/etc/zfsync/locks") #Lock files of the volume groups and logical volumes of a client
+LOCK_POLL_INTERVAL = 0.2 #Seconds between attempts to take a lock that is held
+
+class LockHeld(Exception):
+    """
+    Raised when a lock is held by another process, or was left marked for cleanup
+
+    Parameters
+    ----------
+    path :      Path of the lock file
+    owner :     The record of the process that holds the lock, or left it, if it could be read
+
+    """
+
+    def __init__(self, path, owner):
+        self.path = path
+        self.owner = owner or {}
+        if self.owner.get("cleanup_needed"):
+            message = path+" was left for cleanup by "+describe_owner(self.owner)+". Remove the lock file once it has been looked at"
+        else:
+            message = path+" is held by "+describe_owner(self.owner)
+        Exception.__init__(self, message)
+
+
+class FileLock:
+    """
+    A lock that is held with flock on a lock file, so the kernel releases it when the process
+    holding it exits, however it exits. The process, host and time are written into the lock
+    file while it is held, for the status of the lock and for error messages.
+    A lock file that is not locked, but still has such a record, was left by a process that
+    died: the lock is free, and the record is kept in stale_owner when it is taken over.
+    Lock files are never removed, since a process waiting for a removed file would lock a file
+    that nobody else can see.
+
+    Parameters
+    ----------
+    path :          Path of the lock file. Its directory is created if it is missing
+    description :   What the lock is taken for, like 'initiate-backup _rsyncbackup_2019-01-01T00-00-00'
+
+    """
+
+    def __init__(self, path, description=""):
+        self.path = path
+        self.description = description
+        self.stale_owner = None
+        self._fd = None
+
+    def acquire(self, timeout=0):
+        """
+        Takes the lock and returns the FileLock. Waits up to timeout seconds for a process
+        that holds it, and then raises LockHeld. A lock that was released with
+        cleanup_needed=True is not taken, until its lock file is removed.
+
+        Parameters
+        ----------
+        timeout :   Seconds to wait for the lock
+
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.time() >= deadline:
+                    os.close(fd)
+                    raise LockHeld(self.path, read_lock_owner(self.path))
+                time.sleep(LOCK_POLL_INTERVAL)
+
+        owner = read_lock_owner(self.path)
+        if owner is not None and owner.get("cleanup_needed"):
+            os.close(fd)
+            raise LockHeld(self.path, owner)
+        self.stale_owner = owner
+        self._write_owner(fd, {"pid": os.getpid(), "host": socket.gethostname(), "since": time.time(), "description": self.description})
+        self._fd = fd
+        return self
+
+    def release(self, cleanup_needed=False):
+        """
+        Releases the lock. With cleanup_needed, the record is kept in the lock file and marked,
+        so that the lock is not taken again until someone has looked at what was left behind.
+
+        """
+        if self._fd is None:
+            return
+        if cleanup_needed:
+            owner = read_lock_owner(self.path) or {}
+            owner["cleanup_needed"] = True
+            self._write_owner(self._fd, owner)
+        else:
+            os.ftruncate(self._fd, 0)
+        #Closing the file releases the flock
+        os.close(self._fd)
+        self._fd = None
+
+    def _write_owner(self, fd, owner):
+        data = (json.dumps(owner, sort_keys=True) + "\n").encode("utf-8")
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, data, 0)
+
+    def __enter__(self):
+        #A lock taken with acquire(timeout) can be used in a with statement as well
+        if self._fd is None:
+            self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def read_lock_owner(path):
+    """
+    Returns the record in a lock file as a dictionary, or None if the lock file is missing or empty
+
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as lock_file:
+            return json.loads(lock_file.read() or "null")
+    except (OSError, ValueError):
+        return None
+
+def lock_status(path):
+    """
+    Returns the status of a lock file and the record in it, as a tuple:
+        ('free', None)              Nobody holds the lock
+        ('running', owner)          A running process holds the lock
+        ('stale', owner)            The process that held the lock died without releasing it
+        ('cleanup-needed', owner)   The lock was left for cleanup, see FileLock.release
+
+    Parameters
+    ----------
+    path :  Path of the lock file
+
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return ("free", None)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return ("running", read_lock_owner(path))
+        owner = read_lock_owner(path)
+    finally:
+        os.close(fd)
+    if owner is None:
+        return ("free", None)
+    return ("cleanup-needed" if owner.get("cleanup_needed") else "stale", owner)
+
+def describe_owner(owner):
+    if not owner:
+        return "an unknown process"
+    return ("process "+str(owner.get("pid"))+" on "+str(owner.get("host"))+" ("+str(owner.get("description", ""))+")"
+            +" since "+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(owner.get("since", 0))))
+
+def volume_group_lock_path(vg_name):
+    return os.path.join(CLIENT_LOCK_DIRECTORY, vg_name + ".lock")
+
+def logical_volume_lock_path(lv_path):
+    """
+    Returns the path of the lock file of a logical volume, like /etc/zfsync/locks/vg1/lv1.lock for /dev/vg1/lv1
+
+    """
+    (vg_name, lv_name) = lv_path.split("/")[2:4]
+    return os.path.join(CLIENT_LOCK_DIRECTORY, vg_name, lv_name + ".lock")
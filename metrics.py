@@ -0,0 +1,167 @@
+import json, os, threading, time
+from contextlib import contextmanager
+from shared_functions import zfsync_path
+
+METRICS_DIRECTORY = zfsync_path("/var/lib/zfsync/metrics") #Prometheus textfiles and running counters, one of each per backup job
+LABEL_NAMES = ("job", "client", "volume", "phase")
+#Fields of a stats record that are added to the byte and file counters
+COUNTED_FIELDS = {"literal_bytes": "transferred_bytes", "matched_bytes": "matched_bytes", "bytes_received": "wire_bytes",
+                  "files_transferred": "transferred_files", "files_total": "files", "files_deleted": "deleted_files"}
+
+class Metrics:
+    """
+    Timing spans, counters and gauges of one run of a script. A span is one phase, like lvcreate
+    or rsync, with its start time, duration, status and labels; the labels given here are added
+    to every span, counter and gauge. They can be added from several threads.
+
+    Parameters
+    ----------
+    labels :    Labels of every span and counter, like job='backup/job1' and client='db1'
+
+    """
+
+    def __init__(self, **labels):
+        self.labels = labels
+        self.spans = []
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, phase, **labels):
+        """
+        Times the code in a with block as a span of the phase. The span is yielded as a dictionary,
+        so the block can set 'status' to 'error' for a failure that does not raise an exception.
+        An exception sets it to 'error' by itself.
+
+        """
+        span = {"phase": phase, "start": time.time(), "status": "ok", "labels": dict(self.labels, **labels)}
+        start = time.monotonic()
+        try:
+            yield span
+        except BaseException:
+            span["status"] = "error"
+            raise
+        finally:
+            span["duration"] = time.monotonic() - start
+            with self._lock:
+                self.spans.append(span)
+
+    def add_spans(self, spans, **labels):
+        """
+        Adds spans that were recorded somewhere else, like the spans a client reported in its result,
+        with the labels of this run and the given labels added
+
+        """
+        with self._lock:
+            for span in spans or []:
+                self.spans.append(dict(span, labels=dict(self.labels, **dict(span.get("labels", {}), **labels))))
+
+    def count(self, name, value, **labels):
+        key = (name, tuple(sorted(dict(self.labels, **labels).items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        """
+        Sets a gauge, a value of the last run like the lag of a replica, that is written as is
+
+        """
+        key = (name, tuple(sorted(dict(self.labels, **labels).items())))
+        with self._lock:
+            self.gauges[key] = value
+
+    def count_stats(self, stats, **labels):
+        """
+        Adds the bytes and files of a stats record from rsync or a block transfer to the counters
+
+        """
+        for (field, name) in COUNTED_FIELDS.items():
+            if stats.get(field) is not None:
+                self.count(name, stats[field], **labels)
+
+    def to_json(self):
+        with self._lock:
+            return {"labels": self.labels, "spans": list(self.spans),
+                    "counters": [{"name": name, "labels": dict(labels), "value": value} for ((name, labels), value) in sorted(self.counters.items())],
+                    "gauges": [{"name": name, "labels": dict(labels), "value": value} for ((name, labels), value) in sorted(self.gauges.items())]}
+
+    def write_json(self, path):
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as json_file:
+            json.dump(self.to_json(), json_file, indent=1, sort_keys=True)
+        os.replace(temporary_path, path)
+
+    def write_prometheus(self, name, directory=METRICS_DIRECTORY):
+        """
+        Writes the run as a Prometheus textfile, for the textfile collector of node_exporter, to
+        directory/name.prom. Each phase gets the total seconds and the number of spans of the last
+        run, by job, client, volume and phase. The counters are added to running totals kept in
+        directory/name.counters.json, so they only ever grow, like Prometheus counters should.
+        Gauges are written with the value they got in this run.
+
+        Parameters
+        ----------
+        name :          File name for the job, like the name of the job with '/' replaced by '_'
+        directory :     Directory the textfile collector reads
+
+        """
+        os.makedirs(directory, exist_ok=True)
+        totals_path = os.path.join(directory, name + ".counters.json")
+        try:
+            with open(totals_path, "r", encoding="utf-8") as totals_file:
+                totals = {(entry["name"], tuple(sorted(entry["labels"].items()))): entry["value"] for entry in json.load(totals_file)}
+        except (OSError, ValueError, KeyError):
+            totals = {}
+        with self._lock:
+            for (key, value) in self.counters.items():
+                totals[key] = totals.get(key, 0) + value
+            gauges = sorted(self.gauges.items())
+            phases = {}
+            for span in self.spans:
+                key = tuple(span["labels"].get(label, "") for label in LABEL_NAMES[:3]) + (span["phase"],)
+                (seconds, count, errors) = phases.get(key, (0.0, 0, 0))
+                phases[key] = (seconds + span["duration"], count + 1, errors + (span["status"] != "ok"))
+
+        lines = ["# HELP zfsync_phase_seconds Seconds spent in each phase of the last run of the backup job",
+                 "# TYPE zfsync_phase_seconds gauge"]
+        lines += ["zfsync_phase_seconds" + format_labels(zip(LABEL_NAMES, key)) + " " + repr(round(seconds, 6)) for (key, (seconds, count, errors)) in sorted(phases.items())]
+        lines += ["# HELP zfsync_phase_spans Number of times each phase ran in the last run of the backup job",
+                  "# TYPE zfsync_phase_spans gauge"]
+        lines += ["zfsync_phase_spans" + format_labels(zip(LABEL_NAMES, key)) + " " + str(count) for (key, (seconds, count, errors)) in sorted(phases.items())]
+        lines += ["# HELP zfsync_phase_errors Number of times each phase failed in the last run of the backup job",
+                  "# TYPE zfsync_phase_errors gauge"]
+        lines += ["zfsync_phase_errors" + format_labels(zip(LABEL_NAMES, key)) + " " + str(errors) for (key, (seconds, count, errors)) in sorted(phases.items())]
+        for counter_name in sorted(set(name for (name, labels) in totals)):
+            lines += ["# TYPE zfsync_" + counter_name + "_total counter"]
+            lines += ["zfsync_" + counter_name + "_total" + format_labels(labels) + " " + str(value) for ((name, labels), value) in sorted(totals.items()) if name == counter_name]
+        for gauge_name in sorted(set(name for ((name, labels), value) in gauges)):
+            lines += ["# TYPE zfsync_" + gauge_name + " gauge"]
+            lines += ["zfsync_" + gauge_name + format_labels(labels) + " " + repr(value) for ((name, labels), value) in gauges if name == gauge_name]
+        lines += ["# TYPE zfsync_last_run_timestamp_seconds gauge",
+                  "zfsync_last_run_timestamp_seconds" + format_labels(sorted(self.labels.items())) + " " + repr(round(time.time(), 3))]
+
+        temporary_path = totals_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as totals_file:
+            json.dump([{"name": name, "labels": dict(labels), "value": value} for ((name, labels), value) in sorted(totals.items())], totals_file)
+        os.replace(temporary_path, totals_path)
+        #The collector must never read a half written file
+        temporary_path = os.path.join(directory, "." + name + ".prom.tmp")
+        with open(temporary_path, "w", encoding="utf-8") as textfile:
+            textfile.write("\n".join(lines) + "\n")
+        os.replace(temporary_path, os.path.join(directory, name + ".prom"))
+
+
+def format_labels(labels):
+    """
+    Returns labels as a Prometheus label set, like {job="backup/job1",phase="rsync"}.
+    Empty labels are left out.
+
+    """
+    escaped = []
+    for (name, value) in labels:
+        if value == "" or value is None:
+            continue
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        escaped.append(name + "=\"" + value + "\"")
+    return "{" + ",".join(escaped) + "}" if escaped else ""
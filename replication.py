@@ -0,0 +1,468 @@
+import collections, queue, shlex, subprocess, threading, time
+from datetime import datetime
+from shared_functions import *
+from locks import FileLock, LockHeld, describe_owner
+from metrics import Metrics, METRICS_DIRECTORY
+from ssh_connections import ProcessChannel, ProcessFile
+
+REPLICATION_SNAPSHOT_SUFFIX = "_repl" #Snapshot of a backup dataset that is sent to the replica, named after the timestamp of the backup
+CHUNK_SIZE = 1024 * 1024 #Bytes read from zfs send at a time
+DEFAULT_BUFFER_SIZE = 256 #Megabytes of a stream buffered between zfs send and zfs receive
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H-%M-%S' #Format of the timestamp in the backup dataset names
+
+def parse_target(target):
+    """
+    Splits a replication target into the host and the dataset the backup jobs are replicated under.
+    'tank/zfsync' is a pool on this server, like a second pool or a pool on a file, and
+    'offsite.example.com:tank/zfsync' a pool on another host. The host is None for a local target.
+
+    """
+    (host, separator, dataset) = target.rpartition(":")
+    return (host or None, dataset.strip("/"))
+
+
+def latest_common_snapshot(source_snapshots, target_snapshots):
+    """
+    Returns the newest of the source snapshots that the target also has, or None.
+    Snapshots are compared by name, since the replica gets the names of the source.
+
+    Parameters
+    ----------
+    source_snapshots :  Names of the snapshots of a dataset (after the @), oldest first
+    target_snapshots :  Names of the snapshots of its replica
+
+    """
+    target_snapshots = set(target_snapshots)
+    for snapshot in reversed(source_snapshots):
+        if snapshot in target_snapshots:
+            return snapshot
+    return None
+
+
+def apply_step(step, source_snapshots, target_snapshots):
+    """
+    Updates the snapshot listings of a dry run as if a step of Replicator.plan_backup was done,
+    so that the plan of the next backup is made from them
+
+    """
+    if step[0] == "snapshot":
+        (dataset, snapshot) = step[1].split("@", 1)
+        source_snapshots.setdefault(dataset, []).append(snapshot)
+        return
+    (dataset, snapshot) = step[1][-1].split("@", 1)
+    sent = [snapshot]
+    if "-I" in step[1]:
+        snapshots = source_snapshots[dataset]
+        sent = snapshots[snapshots.index(step[1][-2].split("@", 1)[1]) + 1:snapshots.index(snapshot) + 1]
+    target_snapshots.setdefault(step[2], []).extend(sent)
+
+
+def buffered_copy(source, destination, buffer_size):
+    """
+    Copies a stream through a bounded buffer: one thread reads chunks from the source into the
+    buffer while this thread writes them to the destination, so a burst on one side does not stall
+    the other until the buffer is full or empty. Returns a dictionary with the bytes copied, the
+    seconds it took, the seconds the reader waited for room in a full buffer (the destination was
+    slower), the seconds the writer waited for an empty buffer (the source was slower), and the
+    error that stopped the copy, if the destination could not be written.
+
+    Parameters
+    ----------
+    source :        Binary file to read, like the stdout of zfs send
+    destination :   Binary file to write, like the stdin of zfs receive
+    buffer_size :   Bytes that may be buffered
+
+    """
+    chunks = queue.Queue(maxsize=max(1, buffer_size // CHUNK_SIZE))
+    stopped = threading.Event()
+    result = {"bytes": 0, "seconds": 0.0, "send_stalled_seconds": 0.0, "receive_stalled_seconds": 0.0, "error": None}
+
+    def read_chunks():
+        while not stopped.is_set():
+            chunk = source.read1(CHUNK_SIZE)
+            start = time.monotonic()
+            while not stopped.is_set():
+                try:
+                    chunks.put(chunk, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+            result["send_stalled_seconds"] += time.monotonic() - start
+            if not chunk:
+                return
+
+    start = time.monotonic()
+    threading.Thread(target=read_chunks, daemon=True).start()
+    try:
+        while True:
+            wait_start = time.monotonic()
+            chunk = chunks.get()
+            result["receive_stalled_seconds"] += time.monotonic() - wait_start
+            if not chunk:
+                break
+            destination.write(chunk)
+            result["bytes"] += len(chunk)
+        destination.flush()
+    except OSError as e:
+        result["error"] = str(e) or repr(e)
+    finally:
+        #The reader stops at its next chunk; the caller ends the source
+        stopped.set()
+    result["seconds"] = time.monotonic() - start
+    return result
+
+
+class ReplicationTarget:
+    """
+    The pool the backups are replicated to: zfs commands are run on this server for a local target,
+    or over the SSH connection to the host of the target
+
+    Parameters
+    ----------
+    target :            The target, see parse_target
+    ssh_connections :   SSHConnectionManager for a target on another host
+    username :          The username that will be used to connect to the host of the target
+    metrics :           Metrics of the replication, for the time to connect
+
+    """
+
+    def __init__(self, target, ssh_connections=None, username="root", metrics=None):
+        self.target = target
+        (self.host, self.dataset) = parse_target(target)
+        self.ssh_connections = ssh_connections
+        self.username = username
+        self.metrics = metrics
+
+    def run(self, arguments):
+        """
+        Runs a command on the target, and returns a tuple with its stdout, stderr and exit code
+
+        """
+        if self.host is None:
+            process = subprocess.run(arguments, encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            return (process.stdout, process.stderr, process.returncode)
+        (stdout, stderr, exit_code) = self.ssh_connections.exec_command(self.host, self.username, " ".join(shlex.quote(argument) for argument in arguments), self.metrics)
+        return ("".join(stdout), "".join(stderr), exit_code)
+
+    def open_command(self, arguments):
+        """
+        Starts a command on the target, and returns its stdin, stdout and stderr as file
+        objects, like SSHConnectionManager.open_command, also for a local target
+
+        """
+        if self.host is None:
+            process = subprocess.Popen(arguments, bufsize=CHUNK_SIZE, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            channel = ProcessChannel(process)
+            return (ProcessFile(process.stdin, channel), ProcessFile(process.stdout, channel), ProcessFile(process.stderr, channel))
+        return self.ssh_connections.open_command(self.host, self.username, " ".join(shlex.quote(argument) for argument in arguments), self.metrics)
+
+
+class Replicator:
+    """
+    Replicates the backups of a backup job to another pool, on this server or on another host, with
+    incremental zfs send and receive. Each backup dataset gets a snapshot named after its timestamp
+    with REPLICATION_SNAPSHOT_SUFFIX, that is sent to TARGET/JOB/BACKUP:
+    a dataset that is already on the target is sent incrementally from the newest snapshot the replica
+    has, with the snapshots in between (-I), so the snapshots that later backups are cloned from get
+    there too. A diff or inc backup that is not on the target yet is sent as a clone stream from the
+    snapshot it was cloned from, and only a full backup, or a backup whose base is not on the target,
+    is sent whole. Receives are resumable: a stream that was interrupted is resumed from the
+    receive_resume_token of its dataset on the target before anything else is sent to it.
+    The streams go through a bounded buffer in this process, see buffered_copy.
+
+    Parameters
+    ----------
+    root_dataset_name :     ZFS name of the root dataset of the backup job. Example: 'backup/job1'
+    target :                Where to replicate to, see parse_target. Example: 'offsite.example.com:tank/zfsync'
+    catalog :               BackupCatalog of the job, that says what has been replicated
+    verbosity :             Level of verbosity for logging and printing
+    log_file :              Path to, and name of the log file to write to
+    buffer_size :           Bytes of a stream that may be buffered between zfs send and zfs receive
+    ssh_connections :       SSHConnectionManager for a target on another host
+
+    """
+
+    def __init__(self, root_dataset_name, target, catalog, verbosity, log_file, buffer_size=DEFAULT_BUFFER_SIZE * 1024 * 1024, ssh_connections=None):
+        self.root_dataset_name = root_dataset_name
+        self.catalog = catalog
+        self.verbosity = verbosity
+        self.log_file = log_file
+        self.buffer_size = buffer_size
+        self.metrics = Metrics(job=root_dataset_name, target=target)
+        self.target = ReplicationTarget(target, ssh_connections, metrics=self.metrics)
+        self.lock = FileLock(dataset_path(root_dataset_name)+"/replication.lock", "replicate to "+target) #Held while the job is replicated
+        self.transfers = [] #Result of buffered_copy for every stream sent in this run
+        self.dry_run_listings = None #Snapshot listings of a dry run, with the steps planned so far applied
+
+    def target_name(self, name):
+        """
+        Returns the name of the replica of a dataset or snapshot of the job, like
+        tank/zfsync/job1/2019-01-01T01-00-00_full for backup/job1/2019-01-01T01-00-00_full
+
+        """
+        return self.target.dataset + "/" + name.split("/", 1)[1]
+
+    def list_snapshots(self, root_dataset_name, on_target=False):
+        """
+        Returns a dictionary with the names of the snapshots of every dataset under a root
+        dataset, oldest first, or None if they can not be listed. A root dataset that does
+        not exist on the target has no snapshots.
+
+        """
+        arguments = ['zfs', 'list', '-H', '-t', 'snapshot', '-o', 'name', '-s', 'createtxg', '-r', root_dataset_name]
+        if on_target:
+            (stdout, stderr, exit_code) = self.target.run(arguments)
+        else:
+            process = subprocess.run(arguments, encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            (stdout, stderr, exit_code) = (process.stdout, process.stderr, process.returncode)
+        if exit_code:
+            if on_target and "does not exist" in stderr:
+                return {}
+            log_and_print(self.verbosity,"critical","Unable to list the snapshots of "+root_dataset_name+(" on "+self.target.target if on_target else "")+": "+stderr.strip(),self.log_file)
+            return None
+        snapshots = {}
+        for line in stdout.splitlines():
+            (dataset, snapshot) = line.strip().split("@", 1)
+            snapshots.setdefault(dataset, []).append(snapshot)
+        return snapshots
+
+    def resume_token(self, target_dataset):
+        """
+        Returns the receive_resume_token of a dataset on the target, or None if it has none
+
+        """
+        (stdout, stderr, exit_code) = self.target.run(['zfs', 'get', '-H', '-o', 'value', 'receive_resume_token', target_dataset])
+        token = stdout.strip()
+        if exit_code or token in ("", "-"):
+            return None
+        return token
+
+    def plan_backup(self, backup, source_snapshots, target_snapshots):
+        """
+        Returns the steps that bring the replica of a backup up to its replication snapshot:
+        ('snapshot', name) to take the snapshot, and ('send', send arguments, target dataset,
+        receive options) for each stream. Returns None if the replica can not be updated,
+        because it has snapshots that the source does not have any more.
+
+        Parameters
+        ----------
+        backup :            Row of the backup in the catalog
+        source_snapshots :  Snapshots of the datasets of the job, see list_snapshots
+        target_snapshots :  Snapshots of the datasets of the job on the target
+
+        """
+        dataset = backup["dataset"]
+        replication_snapshot = backup["timestamp"] + REPLICATION_SNAPSHOT_SUFFIX
+        target_dataset = self.target_name(dataset)
+        steps = []
+        snapshots = source_snapshots.get(dataset, [])
+        if replication_snapshot not in snapshots:
+            steps.append(("snapshot", dataset+"@"+replication_snapshot))
+            snapshots = snapshots + [replication_snapshot]
+
+        replica = target_snapshots.get(target_dataset)
+        if replica:
+            common = latest_common_snapshot(snapshots, replica)
+            #zfs receive -F would roll the replica back past the snapshots the source lacks
+            if common is None or replica[-1] != common:
+                log_and_print(self.verbosity,"critical","The replica "+target_dataset+" has snapshots that "+dataset+" does not have. It must be renamed or destroyed on the target before "+dataset+" can be replicated",self.log_file)
+                return None
+            if common != replication_snapshot:
+                steps.append(("send", ['zfs', 'send', '-I', dataset+"@"+common, dataset+"@"+replication_snapshot], target_dataset, ['-s', '-u', '-F']))
+            return steps
+
+        clone_stream = False
+        if backup["parent_snapshot"]:
+            (base, base_snapshot) = backup["parent_snapshot"].split("@", 1)
+            base_snapshots = source_snapshots.get(base, [])
+            base_replica = target_snapshots.get(self.target_name(base), [])
+            if base_snapshot in base_replica:
+                clone_stream = True
+            elif base_snapshot in base_snapshots:
+                common = latest_common_snapshot(base_snapshots[:base_snapshots.index(base_snapshot) + 1], base_replica)
+                if common is not None and base_replica[-1] == common:
+                    steps.append(("send", ['zfs', 'send', '-I', base+"@"+common, backup["parent_snapshot"]], self.target_name(base), ['-s', '-u', '-F']))
+                    clone_stream = True
+            if not clone_stream:
+                log_and_print(self.verbosity,"warning","The base of "+dataset+", "+backup["parent_snapshot"]+", can not be replicated. "+dataset+" is sent whole",self.log_file)
+        if clone_stream:
+            steps.append(("send", ['zfs', 'send', '-i', backup["parent_snapshot"], dataset+"@"+snapshots[0]], target_dataset, ['-s', '-u']))
+        else:
+            steps.append(("send", ['zfs', 'send', dataset+"@"+snapshots[0]], target_dataset, ['-s', '-u']))
+        if snapshots[0] != replication_snapshot:
+            steps.append(("send", ['zfs', 'send', '-I', dataset+"@"+snapshots[0], dataset+"@"+replication_snapshot], target_dataset, ['-s', '-u', '-F']))
+        return steps
+
+    def send(self, send_arguments, target_dataset, receive_options):
+        """
+        Sends a stream with zfs send on this server into zfs receive on the target, through the
+        buffer of buffered_copy. Returns True if both ends succeeded.
+
+        Parameters
+        ----------
+        send_arguments :    The zfs send command
+        target_dataset :    The dataset on the target to receive into
+        receive_options :   Options of zfs receive, like -s for a resumable receive
+
+        """
+        receive_arguments = ['zfs', 'receive'] + receive_options + [target_dataset]
+        log_and_print(self.verbosity,"info","Replicating: "+" ".join(send_arguments)+" | "+" ".join(receive_arguments)+(" on "+self.target.host if self.target.host else ""),self.log_file)
+        output = collections.deque(maxlen=20)
+        def collect_output(stream):
+            while True:
+                line = stream.readline()
+                if not line:
+                    return
+                output.append(line.decode("utf-8", "replace") if isinstance(line, bytes) else line)
+
+        with self.metrics.span("replication_send") as span:
+            send_process = subprocess.Popen(send_arguments, bufsize=CHUNK_SIZE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            try:
+                (stdin, stdout, stderr) = self.target.open_command(receive_arguments)
+            except Exception as e:
+                send_process.kill()
+                send_process.wait()
+                span["status"] = "error"
+                log_and_print(self.verbosity,"critical","Unable to start zfs receive on "+self.target.target+": "+str(e),self.log_file)
+                return False
+            readers = [threading.Thread(target=collect_output, args=(stream,), daemon=True) for stream in (send_process.stderr, stdout, stderr)]
+            for reader in readers:
+                reader.start()
+            transfer = buffered_copy(send_process.stdout, stdin, self.buffer_size)
+            try:
+                stdin.channel.shutdown_write()
+            except OSError:
+                pass
+            if transfer["error"]:
+                send_process.kill()
+            send_exit_code = send_process.wait()
+            receive_exit_code = stdout.channel.recv_exit_status()
+            for reader in readers:
+                reader.join()
+            if send_exit_code or receive_exit_code or transfer["error"]:
+                span["status"] = "error"
+
+        self.transfers.append(transfer)
+        self.metrics.count("replicated_bytes", transfer["bytes"])
+        self.metrics.count("replication_streams", 1)
+        rate = transfer["bytes"] / transfer["seconds"] / 1024**2 if transfer["seconds"] else 0.0
+        log_and_print(self.verbosity,"info","Sent "+str(transfer["bytes"])+" bytes in "+"%.1f" % transfer["seconds"]+" s ("+"%.1f" % rate+" MiB/s). Waited "+
+                      "%.1f" % transfer["send_stalled_seconds"]+" s for zfs receive and "+"%.1f" % transfer["receive_stalled_seconds"]+" s for zfs send",self.log_file)
+        if send_exit_code or receive_exit_code or transfer["error"]:
+            log_and_print(self.verbosity,"critical","Replication stream to "+target_dataset+" failed (zfs send: "+str(send_exit_code)+", zfs receive: "+str(receive_exit_code)+
+                          ("" if not transfer["error"] else ", "+transfer["error"])+"): "+"".join(output).strip(),self.log_file)
+            return False
+        return True
+
+    def replicate_backup(self, backup, dry_run=False):
+        """
+        Replicates one backup, after resuming an interrupted stream to it or to its base.
+        Returns True if the replica is up to date.
+
+        """
+        target_datasets = [self.target_name(backup["dataset"])]
+        if backup["parent_snapshot"]:
+            target_datasets.insert(0, self.target_name(backup["parent_snapshot"].split("@", 1)[0]))
+        for target_dataset in target_datasets:
+            token = self.resume_token(target_dataset)
+            if token is None:
+                continue
+            if dry_run:
+                if self.dry_run_listings is None or target_dataset not in self.dry_run_listings[1]:
+                    print("zfs send -t "+token+" | zfs receive -s -u "+target_dataset)
+            elif not self.send(['zfs', 'send', '-t', token], target_dataset, ['-s', '-u']):
+                return False
+
+        if dry_run and self.dry_run_listings is not None:
+            (source_snapshots, target_snapshots) = self.dry_run_listings
+        else:
+            source_snapshots = self.list_snapshots(self.root_dataset_name)
+            target_snapshots = self.list_snapshots(self.target_name(self.root_dataset_name), on_target=True)
+            if source_snapshots is None or target_snapshots is None:
+                return False
+        steps = self.plan_backup(backup, source_snapshots, target_snapshots)
+        if steps is None:
+            return False
+        for step in steps:
+            if dry_run:
+                print("zfs snapshot "+step[1] if step[0] == "snapshot" else " ".join(step[1])+" | "+" ".join(['zfs', 'receive'] + step[3] + [step[2]]))
+                apply_step(step, source_snapshots, target_snapshots)
+                self.dry_run_listings = (source_snapshots, target_snapshots)
+                continue
+            if step[0] == "snapshot":
+                with self.metrics.span("replication_snapshot") as span:
+                    snapshot = subprocess.run(['zfs', 'snapshot', step[1]], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    if snapshot.returncode:
+                        span["status"] = "error"
+                if snapshot.returncode:
+                    log_and_print(self.verbosity,"critical","Unable to take the replication snapshot "+step[1]+": "+snapshot.stderr.strip(),self.log_file)
+                    return False
+            elif not self.send(*step[1:]):
+                return False
+        if not dry_run:
+            self.catalog.set_replicated(backup["dataset"], self.target.target)
+        return True
+
+    def run(self, dry_run=False):
+        """
+        Replicates every successful backup of the job that is not on the target yet, oldest first,
+        and returns EXIT_OK, EXIT_WARNING if another replication of the job is running, or
+        EXIT_CRITICAL. Stops at the first backup that fails, since the next ones are cloned from it.
+        With dry_run, prints the commands instead.
+
+        """
+        try:
+            self.lock.acquire()
+        except LockHeld as e:
+            log_and_print(self.verbosity,"warning","Replication of "+self.root_dataset_name+" is already running: "+str(e),self.log_file)
+            return EXIT_WARNING
+        if self.lock.stale_owner:
+            log_and_print(self.verbosity,"warning","Took over the replication lock, left by "+describe_owner(self.lock.stale_owner),self.log_file)
+        try:
+            if not dry_run:
+                (stdout, stderr, exit_code) = self.target.run(['zfs', 'create', '-p', self.target_name(self.root_dataset_name)])
+                if exit_code:
+                    log_and_print(self.verbosity,"critical","Unable to create "+self.target_name(self.root_dataset_name)+" on "+self.target.target+": "+stderr.strip(),self.log_file)
+                    return EXIT_CRITICAL
+            pending = self.catalog.unreplicated(self.target.target)
+            log_and_print(self.verbosity,"info",str(len(pending))+" backups of "+self.root_dataset_name+" to replicate to "+self.target.target,self.log_file)
+            for backup in pending:
+                with self.metrics.span("replication_backup"):
+                    replicated = self.replicate_backup(backup, dry_run)
+                if not replicated:
+                    log_and_print(self.verbosity,"critical","Replication of "+backup["dataset"]+" to "+self.target.target+" failed. It is resumed on the next run",self.log_file)
+                    return EXIT_CRITICAL
+                if not dry_run:
+                    log_and_print(self.verbosity,"info","Replicated "+backup["dataset"]+" to "+self.target_name(backup["dataset"]),self.log_file)
+            return EXIT_OK
+        finally:
+            self.lock.release()
+            self.measure_lag()
+
+    def measure_lag(self):
+        """
+        Sets the gauges of the replica: the age of the newest backup on the target, the number
+        of backups still to replicate, and the throughput and stalls of the streams of this run
+
+        """
+        last = self.catalog.last_replicated(self.target.target)
+        if last is not None:
+            age = time.time() - datetime.strptime(last["timestamp"], TIMESTAMP_FORMAT).timestamp()
+            self.metrics.gauge("replication_lag_seconds", round(age, 3))
+        self.metrics.gauge("replication_pending_backups", len(self.catalog.unreplicated(self.target.target)))
+        seconds = sum(transfer["seconds"] for transfer in self.transfers)
+        if seconds:
+            self.metrics.gauge("replication_throughput_bytes_per_second", round(sum(transfer["bytes"] for transfer in self.transfers) / seconds, 1))
+            self.metrics.gauge("replication_send_stalled_seconds", round(sum(transfer["send_stalled_seconds"] for transfer in self.transfers), 3))
+            self.metrics.gauge("replication_receive_stalled_seconds", round(sum(transfer["receive_stalled_seconds"] for transfer in self.transfers), 3))
+
+    def export_metrics(self, directory=METRICS_DIRECTORY):
+        """
+        Writes the metrics of the replication as a Prometheus textfile, next to the one of the
+        backup job. Failures are only logged.
+
+        """
+        try:
+            self.metrics.write_prometheus(self.root_dataset_name.replace("/", "_") + "_replication", directory)
+        except OSError as e:
+            log_and_print(self.verbosity,"warning","Unable to write the metrics of the replication: "+str(e),self.log_file)
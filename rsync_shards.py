@@ -0,0 +1,183 @@
+import os, stat, heapq
+
+PER_FILE_WEIGHT = 64 * 1024 #Cost of one file in bytes, for the per file overhead of rsync (stat, file list, checksums)
+MAX_SPLIT_DEPTH = 4 #How deep directories are split up to balance the shards
+WILDCARD_CHARACTERS = "*?["
+
+class TreeNode:
+    """
+    Size of a directory tree, as found by scan_tree. 'weight' is the bytes plus
+    PER_FILE_WEIGHT for every entry in the tree, and 'children' holds the nodes of
+    the entries of a directory.
+
+    """
+
+    def __init__(self, is_dir):
+        self.is_dir = is_dir
+        self.weight = PER_FILE_WEIGHT
+        self.children = {}
+
+def scan_tree(path, depth=0):
+    """
+    Returns the TreeNode of a local directory tree, like the copy of a volume in the previous
+    backup. Only the top MAX_SPLIT_DEPTH levels keep their children, the rest is only summed up.
+
+    Parameters
+    ----------
+    path :      The directory to scan
+
+    """
+    node = TreeNode(True)
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return node
+    for entry in entries:
+        try:
+            entry_stat = entry.stat(follow_symlinks=False)
+        except OSError:
+            continue
+        if stat.S_ISDIR(entry_stat.st_mode):
+            child = scan_tree(entry.path, depth + 1)
+        else:
+            child = TreeNode(False)
+            child.weight += entry_stat.st_size
+        node.weight += child.weight
+        if depth < MAX_SPLIT_DEPTH:
+            node.children[entry.name] = child
+    return node
+
+def list_only_tree(lines):
+    """
+    Returns a TreeNode of the top level of a directory, from the output of
+    'rsync --list-only' without recursion. Used when there is no previous copy to scan;
+    directories then only count as one entry each.
+
+    Parameters
+    ----------
+    lines :     Lines of output from 'rsync --list-only'
+
+    """
+    root = TreeNode(True)
+    for line in lines:
+        fields = line.rstrip("\n").split(None, 4)
+        if len(fields) < 5 or fields[4] == ".":
+            continue
+        child = TreeNode(fields[0].startswith("d"))
+        try:
+            child.weight += int(fields[1].replace(",", "").replace(".", ""))
+        except ValueError:
+            continue
+        root.children[fields[4]] = child
+        root.weight += child.weight
+    return root
+
+def split_units(root, shard_count):
+    """
+    Splits a tree into units of work: paths relative to the root, with their weight.
+    It starts with the entries of the root, and keeps replacing the heaviest directory
+    with its entries, as long as it weighs more than half a shard.
+
+    Parameters
+    ----------
+    root :          TreeNode of the volume
+    shard_count :   The number of shards the units will be spread over
+
+    """
+    limit = root.weight / (shard_count * 2)
+    units = [(-node.weight, name, node) for name, node in root.children.items()]
+    heapq.heapify(units)
+    done = []
+    while units:
+        (weight, path, node) = heapq.heappop(units)
+        if -weight > limit and node.children:
+            for name, child in node.children.items():
+                heapq.heappush(units, (-child.weight, path + "/" + name, child))
+        else:
+            done.append((path, -weight, node.is_dir))
+    return done
+
+def balance_units(units, shard_count):
+    """
+    Spreads units over shard_count shards, heaviest unit first onto the lightest shard.
+    Returns a list of shards, each a list of (path, is_dir) tuples.
+
+    """
+    shards = [(0, number, []) for number in range(shard_count)]
+    for (path, weight, is_dir) in sorted(units, key=lambda unit: -unit[1]):
+        (total, number, members) = heapq.heappop(shards)
+        members.append((path, is_dir))
+        heapq.heappush(shards, (total + weight, number, members))
+    return [members for (total, number, members) in sorted(shards, key=lambda shard: shard[1])]
+
+def escape_pattern(name, has_wildcards=False):
+    if has_wildcards or any(character in name for character in WILDCARD_CHARACTERS):
+        for character in "\\" + WILDCARD_CHARACTERS:
+            name = name.replace(character, "\\" + character)
+    return name
+
+def unit_patterns(path):
+    #Both forms, whatever the unit was at scan time: it may have turned from a file into a directory, or back
+    return ["/" + escape_pattern(path), "/" + escape_pattern(path, True) + "/***"]
+
+def shard_filter_rules(shards):
+    """
+    Returns the rsync filter rules for every shard, as lists of lines for a merge file.
+    Shard 0 copies everything that is not in another shard, so entries that are new since
+    the scan are still copied. The other shards only copy their own units, with the parent
+    directories needed to reach them. A unit stays in its shard if it is a file now and was a
+    directory at scan time, or the other way round, so that one rsync replaces it.
+    Since rsync never deletes excluded files, every shard only deletes inside its own units,
+    and the shards can run with --delete at the same time.
+
+    Parameters
+    ----------
+    shards :    List of shards from balance_units
+
+    """
+    #Shard 0 only needs the first form: without a trailing slash it matches a file, and a directory with its contents
+    rules = [["- " + unit_patterns(path)[0] for shard in shards[1:] for (path, is_dir) in shard]]
+    for shard in shards[1:]:
+        parents = set()
+        shard_rules = []
+        for (path, is_dir) in shard:
+            components = path.split("/")
+            for depth in range(1, len(components)):
+                parent = "/".join(components[:depth])
+                if parent not in parents:
+                    parents.add(parent)
+                    shard_rules.append("+ /" + escape_pattern(parent) + "/")
+        shard_rules.extend("+ " + pattern for (path, is_dir) in shard for pattern in unit_patterns(path))
+        shard_rules.append("- *")
+        rules.append(shard_rules)
+    return rules
+
+def plan_shards(tree, shard_count):
+    """
+    Returns the filter rules for up to shard_count shards of a volume, see shard_filter_rules.
+    Returns fewer shards if the tree does not have enough units, and an empty list if the
+    volume is not worth splitting at all.
+
+    Parameters
+    ----------
+    tree :          TreeNode of the volume, from scan_tree or list_only_tree
+    shard_count :   The number of rsync streams wanted
+
+    """
+    units = [unit for unit in split_units(tree, shard_count) if "\n" not in unit[0] and "\r" not in unit[0]]
+    shard_count = min(shard_count, len(units))
+    if shard_count < 2:
+        return []
+    return shard_filter_rules(balance_units(units, shard_count))
+
+def sum_stats(shard_stats):
+    """
+    Adds up the stats of the rsync streams of a sharded transfer into one stats record.
+    The transfer rates are added too, since the streams run at the same time.
+
+    """
+    total = {}
+    for stats in shard_stats:
+        for (name, value) in stats.items():
+            total[name] = total.get(name, 0) + value
+    return total
@@ -0,0 +1,107 @@
+import re, json, os
+
+#Lines of the '--stats' block and the names they are stored under in a stats record
+STATS_FIELDS = {
+    "Number of files": "files_total",
+    "Number of regular files transferred": "files_transferred",
+    "Number of files transferred": "files_transferred", #rsync older than 3.1
+    "Number of created files": "files_created",
+    "Number of deleted files": "files_deleted",
+    "Total file size": "total_file_size",
+    "Total transferred file size": "transferred_file_size",
+    "Literal data": "literal_bytes",
+    "Matched data": "matched_bytes",
+    "File list size": "file_list_size",
+    "Total bytes sent": "bytes_sent",
+    "Total bytes received": "bytes_received",
+}
+SUMMARY_PATTERN = re.compile(r"^sent ([\d,.]+) bytes\s+received ([\d,.]+) bytes\s+([\d,.]+) bytes/sec")
+PROGRESS2_PATTERN = re.compile(r"^\s*([\d,]+)\s+(\d+)%\s+(\S+/s)\s+(\S+)(?:\s+\(xfr#(\d+), (?:ir|to)-chk=(\d+)/(\d+)\))?")
+
+def parse_number(text):
+    """
+    Returns the leading number in a value from the rsync output, like '1,234,567' or '1,234 bytes'
+
+    """
+    return int(float(text.split()[0].replace(",", "")))
+
+def parse_rsync_stats(lines):
+    """
+    Parses the block printed by 'rsync --stats' and returns the values as a dictionary.
+    Values that are not present in the output are left out. The 'transfer_rate' is in
+    bytes per second, as reported by rsync.
+
+    Parameters
+    ----------
+    lines :     Lines of output from rsync. Only the lines of the stats block are needed
+
+    """
+    stats = {}
+    for line in lines:
+        line = line.strip()
+        summary = SUMMARY_PATTERN.match(line)
+        if summary:
+            stats["transfer_rate"] = float(summary.group(3).replace(",", ""))
+            continue
+        if ":" not in line:
+            continue
+        name, value = line.split(":", 1)
+        if name in STATS_FIELDS and value.strip():
+            try:
+                stats[STATS_FIELDS[name]] = parse_number(value)
+            except ValueError:
+                continue
+    return stats
+
+def parse_progress2_line(line):
+    """
+    Parses one progress line printed by 'rsync --info=progress2', and returns a dictionary
+    with 'bytes', 'percent', 'rate' and, if present, 'files_transferred' and 'files_to_check'.
+    Returns None if the line is not a progress line.
+
+    Parameters
+    ----------
+    line :      A line of output from rsync
+
+    """
+    progress = PROGRESS2_PATTERN.match(line)
+    if not progress:
+        return None
+    result = {"bytes": parse_number(progress.group(1)), "percent": int(progress.group(2)), "rate": progress.group(3)}
+    if progress.group(5):
+        result["files_transferred"] = int(progress.group(5))
+        result["files_to_check"] = int(progress.group(6))
+    return result
+
+def stats_record_path(log_file_path):
+    """
+    Returns the path of the stats record that belongs next to the given log file
+
+    """
+    return os.path.splitext(log_file_path)[0] + ".stats.json"
+
+def write_stats_record(path, record):
+    """
+    Writes a stats record as JSON. The file is replaced atomically, so readers never see a partial record.
+
+    Parameters
+    ----------
+    path :      Path of the stats record
+    record :    Dictionary to write
+
+    """
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as stats_file:
+        json.dump(record, stats_file, indent=1, sort_keys=True)
+    os.replace(temporary_path, path)
+
+def read_stats_record(path):
+    """
+    Returns the stats record in the given file, or None if it does not exist or can not be read
+
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as stats_file:
+            return json.load(stats_file)
+    except (OSError, ValueError):
+        return None
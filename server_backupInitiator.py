@@ -1,27 +1,675 @@
 #! /usr/bin/env python3.6
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import subprocess
 import os.path
+import argparse, configparser, glob, heapq, itertools, json, signal, sqlite3, sys, collections, threading, concurrent.futures
+from shared_functions import *
+from ssh_connections import SSHConnectionManager
+from backup_job import BackupJob, job_arg_parser, ssh_user
+from locks import lock_status, describe_owner
+from duration_predictor import predict_next_run, predict_run, format_seconds
 
-central_config_file_path = "/etc/zfsync/zfsync.cfg"
-machines_with_jobs = "/etc/zfsync/machines.cfg"
+central_config_file_path = zfsync_path("/etc/zfsync/zfsync.cfg")
+job_directory = zfsync_path("/etc/zfsync/jobs") #Every *.job file in this directory is a backup job
+state_file_path = zfsync_path("/etc/zfsync/scheduler.state") #Run counters of every schedule
+executor_path = zfsync_path("/opt/zfsync/server_backupExecutor.py")
+main_log_file = zfsync_path("/backup/backupinitiator.log")
+POLL_INTERVAL = 5 #Seconds between checks for finished backup jobs
+
+arg_parser = argparse.ArgumentParser(description='Server side scheduler that starts backup jobs at the times defined in the job files.')
+arg_parser.add_argument('-n','--dry-run', action='store_true', help='Parse the job files, print when each schedule fires next, and exit')
+arg_parser.add_argument('--runner', choices=['process','pool'], help="'process' starts server_backupExecutor.py for every backup job. 'pool' runs the jobs on threads of this process, sharing the SSH connections to the clients. Overrides 'runner' in the [scheduler] section of the central config file")
+arg_parser.add_argument('-v','--verbosity-level',nargs='?', const=3, type=int, default=3, help='Level of verbosity for logging and printing. 0 = no logging/printing, 1 = errors, 2 = warning + error, 3 = warning+error+info')
+arguments = arg_parser.parse_args()
 
 def main():
-    checkSchedule()
-
-def checkSchedule():
-    # Open machines.cfg and make a matrix of backup jobs
-    # Run through matrix and start backup on the machines where it is time for backup (after checking for a lock file)
-    print("Schedule")
-
-def check_lockfile1():
-    # Check if lock file exists for given backup job
-        # If lock file exists: check PID
-            # If PID exists: return ("Backup running")
-            # Else if PID does not exist: return ("Cleanup needed")
-        # Else if lock file does not exist: return("OK. Ready for backup")
-    print("Lock 1")
+    config = read_config(central_config_file_path)
+    if arguments.runner:
+        config["runner"] = arguments.runner
+    scheduler = Scheduler(config)
+    if arguments.dry_run:
+        for (fire_time, seq, schedule) in sorted(scheduler.queue):
+            prediction = scheduler.predict(schedule, scheduler.run_type(schedule))
+            print(fire_time.strftime('%Y-%m-%d %H:%M'), schedule.key, "->", prediction["backup_type"], "predicted", format_seconds(prediction["duration"]))
+        if scheduler.window is not None:
+            now = datetime.now()
+            (window_start, window_end) = window_bounds(scheduler.window, now)
+            print(describe_forecast(scheduler.forecast_window(window_end, now), window_start, window_end)[1])
+        sys.exit(EXIT_OK)
+    checkSchedule(scheduler)
+
+def checkSchedule(scheduler):
+    """
+    Runs the scheduler until it is stopped with SIGTERM or SIGINT. Job files are
+    parsed once, and re-read on SIGHUP.
+
+    Parameters
+    ----------
+    scheduler :     The Scheduler to run
+
+    """
+    stop = []
+    #The handler only asks for the reload: reload() takes locks and logs, which is not safe in a signal handler.
+    #An Event, so that SIGHUP also cuts the sleep until the next fire time short
+    reload_requested = threading.Event()
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_requested.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.append(signum))
+    log_and_print(arguments.verbosity_level,"info","Scheduler started with "+str(len(scheduler.queue))+" schedules",main_log_file)
+    while not stop:
+        if reload_requested.is_set():
+            reload_requested.clear()
+            scheduler.reload()
+        scheduler.run_pending(datetime.now())
+        reload_requested.wait(scheduler.seconds_until_next(datetime.now()))
+    log_and_print(arguments.verbosity_level,"info","Scheduler stopped. "+str(len(scheduler.running))+" backup jobs are still running",main_log_file)
+    scheduler.runner.close()
+
+def check_lockfile1(dataset_name):
+    """
+    Checks the lock of a backup job, also when the job was not started by this scheduler,
+    and returns its status: 'Backup running', 'Cleanup needed' if the last run died without
+    releasing the lock, or 'OK. Ready for backup'
+
+    Parameters
+    ----------
+    dataset_name :  Name of the root dataset of the backup job
+
+    """
+    (status, owner) = lock_status(dataset_path(dataset_name)+"/lock")
+    if status == "running":
+        return "Backup running"
+    elif status in ("stale", "cleanup-needed"):
+        log_and_print(arguments.verbosity_level,"warning","Lock of backup job "+dataset_name+" was left by "+describe_owner(owner),main_log_file)
+        return "Cleanup needed"
+    return "OK. Ready for backup"
+
+
+def read_config(config_file_path):
+    """
+    Reads the central config file and returns the scheduler settings as a dictionary.
+    Settings that are not in the file get their default value. The settings are
+    read from the [scheduler] section:
+        job_directory, state_file, executor,
+        max_jobs (global cap), max_jobs_per_client, max_jobs_per_pool,
+        runner ('process' or 'pool', see ProcessRunner and PoolRunner),
+        backup_window (like '22:00-06:00', the time the jobs should be done in),
+        window_warning (minutes before the backup window to warn if the jobs will not fit in it)
+
+    Parameters
+    ----------
+    config_file_path :  Path to the central config file
+
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file_path)
+    if not config.has_section("scheduler"):
+        config.add_section("scheduler")
+    section = config["scheduler"]
+    return {
+        "job_directory": section.get("job_directory", job_directory),
+        "state_file": section.get("state_file", state_file_path),
+        "executor": section.get("executor", executor_path),
+        "max_jobs": section.getint("max_jobs", 8),
+        "max_jobs_per_client": section.getint("max_jobs_per_client", 1),
+        "max_jobs_per_pool": section.getint("max_jobs_per_pool", 4),
+        "runner": section.get("runner", "process"),
+        "backup_window": section.get("backup_window", ""),
+        "window_warning": section.getint("window_warning", 60),
+    }
+
+
+def parse_window(text):
+    """
+    Returns the start and end of a backup window like '22:00-06:00' as minutes after midnight,
+    or None if no window is set. A window that ends before it starts wraps around midnight.
+
+    """
+    if not text.strip():
+        return None
+    (start, end) = (part.strip().split(":") for part in text.split("-"))
+    return (int(start[0]) * 60 + int(start[1]), int(end[0]) * 60 + int(end[1]))
+
+
+def window_bounds(window, now):
+    """
+    Returns the start and end of the backup window that 'now' is in, or else of the next one
+
+    Parameters
+    ----------
+    window :    Start and end of the window from parse_window
+    now :       The current time
+
+    """
+    (start_minute, end_minute) = window
+    length = timedelta(minutes=(end_minute - start_minute) % (24 * 60) or 24 * 60)
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    for day in (-1, 0, 1):
+        start = midnight + timedelta(days=day, minutes=start_minute)
+        if now < start + length:
+            return (start, start + length)
+
+
+def describe_forecast(forecast, window_start, window_end):
+    """
+    Returns the log level and message for the forecast of a backup window, from Scheduler.forecast_window
+
+    """
+    window = window_start.strftime('%Y-%m-%d %H:%M')+" - "+window_end.strftime('%H:%M')
+    unknown = (". No prediction for "+", ".join(forecast["unknown"])) if forecast["unknown"] else ""
+    if not forecast["late"]:
+        return ("info", "Backup window "+window+": "+str(forecast["runs"])+" runs are predicted to finish by "+forecast["finish"].strftime('%Y-%m-%d %H:%M')+unknown)
+    return ("warning", "Backup window "+window+" will overflow: "+str(forecast["runs"])+" runs are predicted to finish at "+forecast["finish"].strftime('%Y-%m-%d %H:%M')+
+            ". Ending after the window: "+", ".join("'"+key+"' at "+end.strftime('%H:%M') for (key, end) in forecast["late"])+unknown)
+
+
+def parse_cron_field(field, first, last):
+    """
+    Returns the set of values matched by one field of a cron style schedule.
+    Supports '*', single values, ranges 'a-b', lists 'a,b,c' and steps '*/n' or 'a-b/n'.
+
+    Parameters
+    ----------
+    field :     The field as written in the job file
+    first :     Lowest value allowed in the field
+    last :      Highest value allowed in the field
+
+    """
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/")
+            step = int(step)
+        if part == "*":
+            start, end = first, last
+        elif "-" in part:
+            start, end = (int(value) for value in part.split("-"))
+        else:
+            start = end = int(part)
+            if step != 1:
+                end = last
+        if start < first or end > last or start > end or step < 1:
+            raise ValueError("Value out of range in cron field: "+field)
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    """
+    One schedule line of a job file:
+    min hour day_month month day_week diff_every full_every backup_folder
+
+    Parameters
+    ----------
+    job :       Dictionary with the settings of the job the schedule belongs to
+    fields :    The fields of the schedule line
+
+    """
+
+    def __init__(self, job, fields):
+        self.job = job
+        self.minutes = parse_cron_field(fields[0], 0, 59)
+        self.hours = parse_cron_field(fields[1], 0, 23)
+        self.days = parse_cron_field(fields[2], 1, 31)
+        self.months = parse_cron_field(fields[3], 1, 12)
+        self.weekdays = set(day % 7 for day in parse_cron_field(fields[4], 0, 7)) #7 and 0 are both sunday
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+        self.diff_every = int(fields[5])
+        self.full_every = int(fields[6])
+        self.backup_folder = fields[7]
+        self.dataset_name = self.backup_folder.strip("/")
+        self.pool = self.dataset_name.split("/")[0]
+        self.key = " ".join(fields[:8])
+
+    def matches_day(self, day):
+        #Like cron: if both day of month and day of week are restricted, either one matching is enough
+        day_matches = day.day in self.days
+        weekday_matches = (day.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_matches and weekday_matches
+        return day_matches or weekday_matches
+
+    def next_fire_time(self, after):
+        """
+        Returns the first time after 'after' that the schedule fires
+
+        """
+        fire_time = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = fire_time + timedelta(days=366 * 5)
+        while fire_time < limit:
+            if fire_time.month not in self.months:
+                fire_time = (fire_time.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.matches_day(fire_time):
+                fire_time = fire_time.replace(hour=0, minute=0) + timedelta(days=1)
+            elif fire_time.hour not in self.hours:
+                fire_time = fire_time.replace(minute=0) + timedelta(hours=1)
+            elif fire_time.minute not in self.minutes:
+                fire_time += timedelta(minutes=1)
+            else:
+                return fire_time
+        raise ValueError("Schedule never fires: "+self.key)
+
+    def next_backup_type(self, run_counters):
+        """
+        Returns the backup type of the next run of the schedule: 'full' every full_every
+        run, 'diff' every diff_every run, and 'inc' for the runs in between
+
+        Parameters
+        ----------
+        run_counters :  Dictionary with the number of runs started for each schedule
+
+        """
+        run_number = run_counters.get(self.key, 0) + 1
+        if self.full_every and run_number % self.full_every == 0:
+            return "full"
+        elif self.diff_every and run_number % self.diff_every == 0:
+            return "diff"
+        else:
+            return "inc"
+
+
+def parse_job_file(job_file_path):
+    """
+    Parses a job file, and returns a list of its schedules.
+    Besides the schedule lines, a job file has 'key = value' lines with the settings of the job:
+        client = hostname of the client (required)
+        volumes = space separated list of logical volumes to back up (required)
+        options = extra options for server_backupExecutor.py, like '--parallel 2'
+        bwlimit, ionice, nice, io_read_max = the budget of the job, read by the executor (see budgets.py)
+        backup_type = 'auto' lets the executor pick full, diff or inc for each run (see backup_planner.py),
+                      with diff_every and full_every of the schedule as the latest points for a diff or full backup
+    Everything after a '#' is a comment.
+
+    Parameters
+    ----------
+    job_file_path :     Path to the job file
+
+    """
+    job = {"job_file": job_file_path, "client": None, "volumes": [], "options": []}
+    schedule_fields = []
+    with open(job_file_path, "r", encoding="utf-8") as job_file:
+        for line_number, line in enumerate(job_file, 1):
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            if "=" in line:
+                key, value = (part.strip() for part in line.split("=", 1))
+                if key == "client":
+                    job["client"] = value
+                elif key in ("volumes", "options"):
+                    job[key] = value.split()
+                else:
+                    job[key] = value
+                continue
+            fields = line.split()
+            if len(fields) != 8:
+                log_and_print(arguments.verbosity_level,"warning","Ignoring invalid line "+str(line_number)+" in job file "+job_file_path+": "+line,main_log_file)
+                continue
+            schedule_fields.append(fields)
+
+    if not job["client"] or not job["volumes"]:
+        log_and_print(arguments.verbosity_level,"critical","Job file "+job_file_path+" must define 'client' and 'volumes'. Job ignored",main_log_file)
+        return []
+    return [CronSchedule(job, fields) for fields in schedule_fields]
+
+
+class ProcessRunner:
+    """
+    Runs every backup job as its own server_backupExecutor.py process. The processes
+    are left running when the scheduler stops.
+
+    Parameters
+    ----------
+    config :    Scheduler settings from read_config
+
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+    def start(self, command):
+        """
+        Starts the executor command of a backup job, and returns its Popen
+
+        """
+        return subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def close(self):
+        pass
+
+
+class JobHandle:
+    """
+    A backup job running in a PoolRunner, with the poll() of a Popen, so the
+    Scheduler handles both runners the same way
+
+    Parameters
+    ----------
+    future :    Future of the job, with its JobResult as the result
+
+    """
+
+    def __init__(self, future):
+        self.future = future
+
+    def poll(self):
+        """
+        Returns None while the job runs, and then the exit code from its JobResult.
+        A job that raised is returned as EXIT_CRITICAL.
+
+        """
+        if not self.future.done():
+            return None
+        try:
+            return self.future.result().exit_code
+        except Exception as e:
+            log_and_print(arguments.verbosity_level,"critical","Backup job failed with an unhandled error: "+repr(e),main_log_file)
+            return EXIT_CRITICAL
+
+
+class PoolRunner:
+    """
+    Runs the backup jobs as BackupJob objects on a pool of max_jobs threads in this process,
+    instead of a process per job. The jobs share one SSHConnectionManager, so each client is
+    connected to once, however many of its jobs run, and the connections of a client are
+    closed when its last job finishes. A failed job only gives its exit code.
+    The log format of the scheduler is used by every job.
+
+    Parameters
+    ----------
+    config :    Scheduler settings from read_config
+
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=config["max_jobs"])
+        self.ssh_connections = SSHConnectionManager(arguments.verbosity_level, main_log_file)
+        self.running_clients = collections.Counter()
+        self._lock = threading.Lock()
+
+    def start(self, command):
+        """
+        Starts a backup job on the pool, with the options of the executor command, and returns a JobHandle
+
+        """
+        options = job_arg_parser().parse_args(command[1:])
+        with self._lock:
+            self.running_clients[options.client] += 1
+        return JobHandle(self.executor.submit(self.run_job, options))
+
+    def run_job(self, options):
+        try:
+            return BackupJob(options, self.ssh_connections).run()
+        finally:
+            with self._lock:
+                self.running_clients[options.client] -= 1
+                if not self.running_clients[options.client]:
+                    del self.running_clients[options.client]
+                    self.ssh_connections.close_client(options.client, ssh_user)
+
+    def close(self):
+        """
+        Waits for the running backup jobs to finish, and closes every connection
+
+        """
+        self.executor.shutdown(wait=True)
+        self.ssh_connections.close_all()
+
+
+RUNNERS = {"process": ProcessRunner, "pool": PoolRunner}
+
+
+class Scheduler:
+    """
+    Keeps a priority queue with the next fire time of every schedule, and starts a
+    backup job for the schedules that are due, with the runner set in the config.
+    A backup job is only started when it stays within the global, per client and per
+    ZFS pool limits on concurrently running jobs. Each run is predicted when it becomes due
+    (see duration_predictor.py), and the jobs that wait are started longest first, so that
+    the big jobs do not end up last in the backup window, and the short ones fill the gaps
+    the limits leave. Runs without a prediction go first.
+    With a backup_window, the runs of the window are forecast window_warning minutes before it
+    starts, and a warning is logged if they are not predicted to fit in it.
+
+    Parameters
+    ----------
+    config :    Scheduler settings from read_config
+
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.running = {} #Popen or JobHandle of each running backup job -> its schedule
+        self.runner = RUNNERS[config["runner"]](config)
+        self.pending = collections.deque()
+        self.sequence = itertools.count() #Keeps the queue order stable for schedules that fire at the same time
+        self.run_counters = self.load_run_counters()
+        self.predictions = {} #Prediction of the run of each pending or running schedule
+        self.started = {} #Popen or JobHandle of each running backup job -> the time it was started
+        self.window = parse_window(config["backup_window"])
+        self.forecast_start = None #Start of the last backup window that was forecast
+        self.reload()
+
+    def reload(self):
+        """
+        Parses all the job files and rebuilds the queue of fire times
+
+        """
+        self.queue = []
+        now = datetime.now()
+        for job_file_path in sorted(glob.glob(os.path.join(self.config["job_directory"], "*.job"))):
+            try:
+                schedules = parse_job_file(job_file_path)
+                for schedule in schedules:
+                    heapq.heappush(self.queue, (schedule.next_fire_time(now), next(self.sequence), schedule))
+            except (OSError, ValueError) as e:
+                log_and_print(arguments.verbosity_level,"critical","Unable to read job file "+job_file_path+": "+str(e),main_log_file)
+        log_and_print(arguments.verbosity_level,"info","Loaded "+str(len(self.queue))+" schedules from "+self.config["job_directory"],main_log_file)
+
+    def load_run_counters(self):
+        if not os.path.isfile(self.config["state_file"]):
+            return {}
+        with open(self.config["state_file"], "r", encoding="utf-8") as state:
+            return json.load(state)
+
+    def save_run_counters(self):
+        temporary_path = self.config["state_file"] + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as state:
+            json.dump(self.run_counters, state, indent=1, sort_keys=True)
+        os.replace(temporary_path, self.config["state_file"])
+
+    def seconds_until_next(self, now):
+        if not self.queue:
+            return POLL_INTERVAL
+        return max(0.5, min(POLL_INTERVAL, (self.queue[0][0] - now).total_seconds()))
+
+    def run_pending(self, now):
+        """
+        Moves the schedules that are due to the list of pending jobs, reaps finished
+        backup jobs, and starts as many pending jobs as the limits allow
+
+        Parameters
+        ----------
+        now :   The current time
+
+        """
+        while self.queue and self.queue[0][0] <= now:
+            (fire_time, seq, schedule) = heapq.heappop(self.queue)
+            if schedule in self.running.values() or schedule in self.pending:
+                log_and_print(arguments.verbosity_level,"warning","Previous run of '"+schedule.key+"' has not finished. Skipping the run at "+str(fire_time),main_log_file)
+            else:
+                self.pending.append(schedule)
+                prediction = self.predictions[schedule] = self.predict(schedule, self.run_type(schedule))
+                log_and_print(arguments.verbosity_level,"info","Run of '"+schedule.key+"' is due. Predicted: "+prediction["backup_type"]+" backup of "+format_seconds(prediction["duration"])+
+                              (", "+str(int(prediction["bytes"]))+" bytes" if prediction["bytes"] is not None else ""),main_log_file)
+            heapq.heappush(self.queue, (schedule.next_fire_time(now), next(self.sequence), schedule))
+
+        for process in list(self.running):
+            returncode = process.poll()
+            if returncode is not None:
+                schedule = self.running.pop(process)
+                elapsed = (now - self.started.pop(process, now)).total_seconds()
+                prediction = self.predictions.pop(schedule, None) or {"duration": None}
+                level = "info" if returncode == EXIT_OK else "critical"
+                log_and_print(arguments.verbosity_level,level,"Backup job '"+schedule.key+"' finished with exit code "+str(returncode)+" after "+format_seconds(elapsed)+
+                              " (predicted "+format_seconds(prediction["duration"])+")",main_log_file)
+
+        waiting = collections.deque()
+        for schedule in sorted(self.pending, key=self.start_order):
+            if self.can_start(schedule):
+                self.start(schedule)
+            else:
+                waiting.append(schedule)
+        self.pending = waiting
+        self.check_window(now)
+
+    def run_type(self, schedule, run_offset=0):
+        """
+        Returns the backup type of a run of a schedule: 'auto' for a job file with 'backup_type = auto',
+        else the type from the run counters, run_offset runs after the next one
+
+        """
+        if schedule.job.get("backup_type") == "auto":
+            return "auto"
+        return schedule.next_backup_type(dict(self.run_counters, **{schedule.key: self.run_counters.get(schedule.key, 0) + run_offset}))
+
+    def predict(self, schedule, backup_type):
+        """
+        Returns the prediction of a run of a schedule, see predict_next_run. A job that can not be
+        read, like one that has not run yet, gets a prediction without a duration.
+
+        """
+        if os.path.isdir(dataset_path(schedule.dataset_name)):
+            try:
+                return predict_next_run(schedule.dataset_name, backup_type, schedule.diff_every, schedule.full_every)
+            except (OSError, ValueError, sqlite3.Error) as e:
+                log_and_print(arguments.verbosity_level,"warning","Unable to predict the run of '"+schedule.key+"': "+str(e),main_log_file)
+        return predict_run([], "full" if backup_type == "auto" else backup_type)
+
+    def start_order(self, schedule):
+        #Longest predicted run first. Stable, so runs that are alike keep the order they became due in
+        duration = self.predictions.get(schedule, {}).get("duration")
+        return (0, 0) if duration is None else (1, -duration)
+
+    def check_window(self, now):
+        """
+        Forecasts the backup window once, window_warning minutes before it starts, and logs
+        a warning if the runs are not predicted to fit in it
+
+        """
+        if self.window is None:
+            return
+        (window_start, window_end) = window_bounds(self.window, now)
+        if self.forecast_start == window_start or now < window_start - timedelta(minutes=self.config["window_warning"]):
+            return
+        self.forecast_start = window_start
+        (level, message) = describe_forecast(self.forecast_window(window_end, now), window_start, window_end)
+        log_and_print(arguments.verbosity_level,level,message,main_log_file)
+
+    def forecast_window(self, window_end, now):
+        """
+        Simulates the scheduler from now until the runs that are due before window_end are done,
+        with the predicted durations, the limits and the longest first order of run_pending.
+        The jobs that are running take the rest of their predicted time. Returns a dictionary with
+        the number of runs, the time the last one ends, the runs that end after window_end as a
+        list of (schedule key, end time), and the schedule keys of runs without a prediction,
+        which are counted as taking no time.
+
+        Parameters
+        ----------
+        window_end :    End of the backup window
+        now :           The current time
+
+        """
+        predictions = {} #(schedule key, backup type) -> prediction, so a schedule that fires often is predicted once per type
+        def duration(schedule, backup_type):
+            key = (schedule.key, backup_type)
+            if key not in predictions:
+                predictions[key] = self.predict(schedule, backup_type)
+            return predictions[key]["duration"]
+
+        running = [] #(end time, schedule)
+        for (process, schedule) in self.running.items():
+            seconds = self.predictions.get(schedule, {}).get("duration")
+            running.append((max(now, self.started.get(process, now) + timedelta(seconds=seconds or 0)), schedule))
+        due = [(now, schedule, self.predictions.get(schedule, {}).get("duration")) for schedule in self.pending]
+        for (fire_time, seq, schedule) in self.queue:
+            run_offset = 0
+            while fire_time < window_end:
+                due.append((fire_time, schedule, duration(schedule, self.run_type(schedule, run_offset))))
+                run_offset += 1
+                fire_time = schedule.next_fire_time(fire_time)
+        due.sort(key=lambda run: run[0])
+
+        forecast = {"runs": 0, "finish": now, "late": [], "unknown": []}
+        waiting = []
+        time_now = now
+        while due or waiting:
+            running = [run for run in running if run[0] > time_now]
+            while due and due[0][0] <= time_now:
+                (fire_time, schedule, seconds) = due.pop(0)
+                if schedule not in [run[1] for run in running] + [run[0] for run in waiting]:
+                    waiting.append((schedule, seconds))
+            waiting.sort(key=lambda run: (0, 0) if run[1] is None else (1, -run[1]))
+            for run in list(waiting):
+                (schedule, seconds) = run
+                if self.can_start(schedule, [run[1] for run in running]):
+                    waiting.remove(run)
+                    end = time_now + timedelta(seconds=seconds or 0)
+                    running.append((end, schedule))
+                    forecast["runs"] += 1
+                    forecast["finish"] = max(forecast["finish"], end)
+                    if seconds is None and schedule.key not in forecast["unknown"]:
+                        forecast["unknown"].append(schedule.key)
+                    if end > window_end:
+                        forecast["late"].append((schedule.key, end))
+            events = [run[0] for run in running if run[0] > time_now]
+            if due:
+                events.append(due[0][0])
+            if not events:
+                break #Nothing running and nothing due: the waiting runs can never start with these limits
+            time_now = min(events)
+        return forecast
+
+    def can_start(self, schedule, running_schedules=None):
+        if running_schedules is None:
+            running_schedules = list(self.running.values())
+        if len(running_schedules) >= self.config["max_jobs"]:
+            return False
+        if sum(1 for running in running_schedules if running.job["client"] == schedule.job["client"]) >= self.config["max_jobs_per_client"]:
+            return False
+        if sum(1 for running in running_schedules if running.pool == schedule.pool) >= self.config["max_jobs_per_pool"]:
+            return False
+        return True
+
+    def start(self, schedule):
+        if check_lockfile1(schedule.dataset_name) == "Backup running":
+            log_and_print(arguments.verbosity_level,"warning","Backup job "+schedule.dataset_name+" is already running outside the scheduler. Skipping the run of '"+schedule.key+"'",main_log_file)
+            self.predictions.pop(schedule, None)
+            return
+        if schedule.job.get("backup_type") == "auto":
+            #The executor picks the type, with the counters of the schedule as the latest points for a diff or full backup
+            type_options = ['-t', 'auto', '--diff-every', str(schedule.diff_every), '--full-every', str(schedule.full_every)]
+        else:
+            type_options = ['-t', schedule.next_backup_type(self.run_counters)]
+        command = [self.config["executor"], '-c', schedule.job["client"], '-p', schedule.dataset_name] + type_options + [
+                   '--job-file', schedule.job["job_file"], '--config', central_config_file_path,
+                   '-v', str(arguments.verbosity_level)] + schedule.job["options"] + ['--'] + schedule.job["volumes"]
+        log_and_print(arguments.verbosity_level,"info","Starting backup job: "+" ".join(command),main_log_file)
+        try:
+            process = self.runner.start(command)
+        except (OSError, SystemExit) as e:
+            log_and_print(arguments.verbosity_level,"critical","Unable to start backup job '"+schedule.key+"': "+str(e),main_log_file)
+            self.predictions.pop(schedule, None)
+            return
+        self.running[process] = schedule
+        self.started[process] = datetime.now()
+        self.run_counters[schedule.key] = self.run_counters.get(schedule.key, 0) + 1
+        self.save_run_counters()
 
 
 if __name__ == "__main__":
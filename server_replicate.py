@@ -0,0 +1,38 @@
+#! /usr/bin/env python3.6
+
+import sys, argparse, os.path
+from shared_functions import *
+from backup_catalog import open_catalog
+from ssh_connections import SSHConnectionManager
+from metrics import METRICS_DIRECTORY
+from replication import Replicator, DEFAULT_BUFFER_SIZE
+
+main_log_file = zfsync_path("/backup/backupreplication.log")
+
+arg_parser = argparse.ArgumentParser(description='Server side script that replicates the backups of a backup job to another pool, like after replication failed, or to seed a new replica. Backup jobs with --replicate-to do this after every successful backup.')
+arg_parser.add_argument('-p','--dataset-name', help='Name of the root dataset of the backup job. Example: backup/job1', required=True)
+arg_parser.add_argument('-t','--target', help="Pool to replicate to: 'tank/zfsync' for a pool on this server, 'host:tank/zfsync' for a pool on another host. The job is replicated to TARGET/JOBNAME", required=True)
+arg_parser.add_argument('--buffer', type=int, default=DEFAULT_BUFFER_SIZE, help='Megabytes of a stream that may be buffered between zfs send and zfs receive')
+arg_parser.add_argument('--metrics-dir', default=METRICS_DIRECTORY, help='Directory for the Prometheus textfile of the replication')
+arg_parser.add_argument('-n','--dry-run', action='store_true', help='Print the zfs commands for the backups that are not replicated yet, from the current state of the target, and exit')
+arg_parser.add_argument('-v','--verbosity-level',nargs='?', const=3, type=int, default=3, help='Level of verbosity for logging and printing. 0 = no logging/printing, 1 = errors, 2 = warning + error, 3 = warning+error+info')
+arguments = arg_parser.parse_args()
+
+def main():
+    if not os.path.isdir(dataset_path(arguments.dataset_name)):
+        log_and_print(arguments.verbosity_level,"critical","Root dataset for backup job, "+arguments.dataset_name+" does not exist. Exiting!",main_log_file)
+        return EXIT_CRITICAL
+    catalog = open_catalog(arguments.dataset_name)
+    ssh_connections = SSHConnectionManager(arguments.verbosity_level, main_log_file)
+    try:
+        replicator = Replicator(arguments.dataset_name, arguments.target, catalog, arguments.verbosity_level, main_log_file, arguments.buffer * 1024 * 1024, ssh_connections)
+        exit_code = replicator.run(arguments.dry_run)
+        if not arguments.dry_run:
+            replicator.export_metrics(arguments.metrics_dir)
+    finally:
+        ssh_connections.close_all()
+        catalog.close()
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,404 @@
+#! /usr/bin/env python3.6
+
+import subprocess, os.path, sys, argparse, time, threading, concurrent.futures, collections, tempfile, fnmatch, hashlib, json
+from datetime import datetime
+from shared_functions import *
+from backup_catalog import open_catalog
+from ssh_connections import SSHConnectionManager
+from rsync_shards import scan_tree, plan_shards, balance_units, sum_stats, PER_FILE_WEIGHT
+from rsync_stats import parse_rsync_stats, parse_progress2_line
+from file_index import walk_tree
+from block_transfer import send_changed_blocks, receive_changed_blocks, DEFAULT_BLOCK_SIZE
+from backup_job import client_script_path, ssh_user, PROGRESS_INTERVAL
+
+main_log_file = zfsync_path("/backup/backuprestore.log")
+RESTORE_STATE_DIRECTORY = zfsync_path("/var/lib/zfsync/restore") #How far each stream of an image restore got, to resume an interrupted restore
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H-%M-%S' #Format of the timestamp in the backup dataset names
+TIME_FORMATS = (TIMESTAMP_FORMAT, '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d') #Accepted by --at
+
+arg_parser = argparse.ArgumentParser(description='Server side script that restores a logical volume from the backups of a backup job, to the client or to a local directory.')
+arg_parser.add_argument('-p','--dataset-name', help='Name of the root dataset of the backup job. Example: backup/job1', required=True)
+arg_parser.add_argument('-l','--volume', help='Full path of the logical volume that was backed up. Example: /dev/vg_root/lv_root', required=True)
+arg_parser.add_argument('-a','--at', default='latest-successful', help="Backup to restore: 'latest-successful', 'latest' (even if it failed), or the last successful backup as of a time, like 2019-06-05T11-11-11 or '2019-06-05 11:11'. A date alone means midnight at its start")
+arg_parser.add_argument('-c','--client', help='Client to restore to. Without it, the volume is restored to a local directory, like scratch space to pick files from')
+arg_parser.add_argument('-d','--destination', help='Directory to restore the files into, on the client or local. For an image backup: the image file, or a directory to put it in')
+arg_parser.add_argument('--lv', help='Logical volume on the client to write an image backup onto. It must not be mounted')
+arg_parser.add_argument('-i','--include', action='append', default=[], help='Only restore the paths that match this glob, relative to the volume, like etc/nginx or *.conf. A directory that matches is restored with everything in it. Can be given more than once')
+arg_parser.add_argument('-e','--exclude', action='append', default=[], help='Do not restore the paths that match this glob. Wins over --include. Can be given more than once')
+arg_parser.add_argument('-j','--streams', type=int, default=4, help='Number of rsync or block streams that run at the same time')
+arg_parser.add_argument('--partial-dir', default='.zfsync-partial', help='Directory in the destination where rsync keeps partly restored files, so that running the same restore again resumes them')
+arg_parser.add_argument('--delete', action='store_true', help='Delete files in the destination that are not in the backup. Not with --include or --exclude')
+arg_parser.add_argument('--bwlimit', type=int, help='Highest rate of the whole restore in bytes per second, shared by the streams')
+arg_parser.add_argument('--restart', action='store_true', help='Restore an image from the start, instead of resuming an interrupted restore of it')
+arg_parser.add_argument('-n','--dry-run', action='store_true', help='Print the backup that would be restored and the plan, and exit')
+arg_parser.add_argument('-v','--verbosity-level',nargs='?', const=3, type=int, default=3, help='Level of verbosity for logging and printing. 0 = no logging/printing, 1 = errors, 2 = warning + error, 3 = warning+error+info')
+arguments = arg_parser.parse_args()
+if (arguments.destination is None) == (arguments.lv is None):
+    arg_parser.error("one of -d/--destination or --lv is required")
+if arguments.lv and not arguments.client:
+    arg_parser.error("--lv needs -c/--client")
+if arguments.delete and (arguments.include or arguments.exclude):
+    arg_parser.error("--delete can not be used with --include or --exclude")
+
+def main():
+    root_dataset_name = arguments.dataset_name.strip("/")
+    if not os.path.isdir(dataset_path(root_dataset_name)):
+        log_and_print(arguments.verbosity_level,"critical","Root dataset of the backup job "+root_dataset_name+" does not exist",main_log_file)
+        sys.exit(EXIT_CRITICAL)
+    catalog = open_catalog(root_dataset_name)
+    try:
+        backup = resolve_backup(catalog, arguments.at)
+    except ValueError as e:
+        log_and_print(arguments.verbosity_level,"critical",str(e),main_log_file)
+        sys.exit(EXIT_CRITICAL)
+    finally:
+        catalog.close()
+    if backup is None:
+        log_and_print(arguments.verbosity_level,"critical","No backup of "+root_dataset_name+" matches '"+arguments.at+"'. Backups of a rebuilt catalog have status 'unknown', and are only found with 'latest'",main_log_file)
+        sys.exit(EXIT_CRITICAL)
+    if backup["status"] != "successful":
+        log_and_print(arguments.verbosity_level,"warning","The backup to restore has status '"+backup["status"]+"'",main_log_file)
+
+    lv_name = arguments.volume.split("/")[-1]
+    source = dataset_path(backup["dataset"])+"/"+lv_name
+    log_and_print(arguments.verbosity_level,"info","Restoring "+arguments.volume+" from "+backup["dataset"]+" ("+backup["backup_type"]+", "+backup["timestamp"]+")",main_log_file)
+
+    ssh_connections = SSHConnectionManager(arguments.verbosity_level, main_log_file)
+    try:
+        if os.path.isdir(source):
+            if arguments.lv:
+                log_and_print(arguments.verbosity_level,"critical","The backup of "+arguments.volume+" is a copy of its files. Mount a file system for it on the client, and restore into it with -d",main_log_file)
+                exit_code = EXIT_CRITICAL
+            else:
+                exit_code = restore_files(source, arguments.client, arguments.destination, ssh_connections)
+        elif os.path.isfile(source+".img"):
+            if arguments.include or arguments.exclude:
+                log_and_print(arguments.verbosity_level,"critical","The backup of "+arguments.volume+" is an image, --include and --exclude do not apply",main_log_file)
+                exit_code = EXIT_CRITICAL
+            else:
+                exit_code = restore_image(source+".img", arguments.client, arguments.lv or arguments.destination, ssh_connections)
+        else:
+            log_and_print(arguments.verbosity_level,"critical","Backup "+backup["dataset"]+" has no copy of "+arguments.volume,main_log_file)
+            exit_code = EXIT_CRITICAL
+    finally:
+        ssh_connections.close_all()
+    sys.exit(exit_code)
+
+
+def resolve_backup(catalog, at):
+    """
+    Returns the backup to restore from the catalog, as a dictionary, or None if there is none.
+    Raises ValueError if 'at' is not understood.
+
+    Parameters
+    ----------
+    catalog :   BackupCatalog of the backup job
+    at :        'latest-successful', 'latest', or a time in one of TIME_FORMATS
+
+    """
+    if at == "latest-successful":
+        return catalog.last_backup(statuses=("successful",))
+    if at == "latest":
+        #A running backup is still being written
+        return catalog.last_backup(statuses=("successful", "failed", "unknown"))
+    for time_format in TIME_FORMATS:
+        try:
+            not_after = datetime.strptime(at, time_format).strftime(TIMESTAMP_FORMAT)
+        except ValueError:
+            continue
+        return catalog.last_backup(statuses=("successful",), not_after=not_after)
+    raise ValueError("Unknown time for --at: "+at+". Use 'latest-successful', 'latest', or a time like 2019-06-05T11-11-11 or '2019-06-05 11:11'")
+
+
+def matches(path, patterns):
+    """
+    Returns True if a glob matches a path relative to the volume, or one of its parent directories
+
+    """
+    components = path.split("/")
+    for depth in range(1, len(components) + 1):
+        prefix = "/".join(components[:depth])
+        if any(fnmatch.fnmatchcase(prefix, pattern.strip("/")) for pattern in patterns):
+            return True
+    return False
+
+
+def select_files(source, includes, excludes, streams):
+    """
+    Returns the paths in the copy of a volume that --include and --exclude select, spread
+    over up to 'streams' lists of about the same weight, for one rsync with --files-from each.
+    The copy is local, so it is walked here, with the same glob rules for rsync and the log.
+
+    Parameters
+    ----------
+    source :    The copy of the volume in the backup dataset
+    includes :  Globs of the paths to restore. Empty to restore everything
+    excludes :  Globs of the paths not to restore
+    streams :   The number of rsync streams
+
+    """
+    units = []
+    for (path, kind, size, mtime_ns, ctime_ns, inode) in walk_tree(source):
+        if matches(path, excludes) or (includes and not matches(path, includes)):
+            continue
+        units.append((path, size + PER_FILE_WEIGHT, kind == "d"))
+    if not units:
+        return []
+    return [[path for (path, is_dir) in shard] for shard in balance_units(units, min(streams, len(units)))]
+
+
+def restore_files(source, client, destination, ssh_connections):
+    """
+    Restores the copy of a volume's files with rsync, into a directory on the client or a local one.
+    The copy is split into --streams parts of about the same weight, see plan_shards, or into lists
+    of the selected files with --include and --exclude, and each part gets an rsync of its own.
+    Files that are already restored are skipped, and partly restored files are kept in --partial-dir,
+    so running the same restore again after an interruption resumes it. Returns an exit code.
+
+    Parameters
+    ----------
+    source :            The copy of the volume in the backup dataset
+    client :            The client to restore to, or None for a local directory
+    destination :       The directory to restore into
+    ssh_connections :   SSHConnectionManager for the client
+
+    """
+    if client:
+        transfer_options = ['-e', ssh_connections.rsync_ssh_command(client, ssh_user), source+"/", ssh_user+'@'+client+':'+destination.rstrip("/")+"/"]
+    else:
+        transfer_options = [source+"/", destination.rstrip("/")+"/"]
+
+    filter_paths = []
+    try:
+        if arguments.include or arguments.exclude:
+            file_lists = select_files(source, arguments.include, arguments.exclude, arguments.streams)
+            if not file_lists:
+                log_and_print(arguments.verbosity_level,"warning","No files match --include and --exclude",main_log_file)
+                return EXIT_WARNING
+            log_and_print(arguments.verbosity_level,"info",str(sum(len(paths) for paths in file_lists))+" paths selected, restored with "+str(len(file_lists))+" streams",main_log_file)
+            stream_options = []
+            for paths in file_lists:
+                (fd, filter_path) = tempfile.mkstemp(prefix="zfsync-restore-", suffix=".files")
+                with open(fd, "w", encoding="utf-8", errors="surrogateescape") as files_from:
+                    files_from.write("\0".join(paths)+"\0")
+                filter_paths.append(filter_path)
+                stream_options.append(['--from0', '--files-from='+filter_path])
+        else:
+            shard_rules = plan_shards(scan_tree(source), arguments.streams) if arguments.streams > 1 else []
+            stream_options = []
+            for rules in shard_rules:
+                (fd, filter_path) = tempfile.mkstemp(prefix="zfsync-restore-", suffix=".rules")
+                with open(fd, "w", encoding="utf-8", errors="surrogateescape") as filter_file:
+                    filter_file.write("\n".join(rules)+"\n")
+                filter_paths.append(filter_path)
+                stream_options.append(['--filter=. '+filter_path])
+            stream_options = stream_options or [[]]
+            log_and_print(arguments.verbosity_level,"info","Restoring the whole volume with "+str(len(stream_options))+" streams",main_log_file)
+
+        rsync_command = ['rsync', '--info=progress2', '--stats', '-aAX', '--partial-dir='+arguments.partial_dir] + (['--delete'] if arguments.delete else [])
+        if arguments.bwlimit:
+            #rsync takes the limit in KiB/s
+            rsync_command.append('--bwlimit='+str(max(1, arguments.bwlimit // len(stream_options) // 1024)))
+        if arguments.dry_run:
+            for options in stream_options:
+                print(" ".join(rsync_command + options + transfer_options))
+            return EXIT_OK
+        if not client:
+            os.makedirs(destination, exist_ok=True)
+
+        start_time = time.time()
+        (returncode, stats) = run_rsync_streams(rsync_command, stream_options, transfer_options)
+    finally:
+        for filter_path in filter_paths:
+            os.remove(filter_path)
+    duration = time.time() - start_time
+    if returncode:
+        log_and_print(arguments.verbosity_level,"critical","Restore failed, rsync exited with "+str(returncode)+". Run the same restore again to resume it",main_log_file)
+        return EXIT_CRITICAL
+    log_and_print(arguments.verbosity_level,"info","Restore finished in "+str(round(duration, 1))+" seconds: "+str(stats.get("files_transferred"))+" files, "
+                  +str(stats.get("literal_bytes"))+" bytes transferred, "+str(stats.get("transfer_rate"))+" bytes/sec",main_log_file)
+    return EXIT_OK
+
+
+def run_rsync_streams(rsync_command, stream_options, transfer_options):
+    """
+    Runs one rsync per stream at the same time, and logs their combined progress every
+    PROGRESS_INTERVAL seconds. Returns a tuple with the first non-zero exit code of the
+    streams or 0, and their stats added up.
+
+    Parameters
+    ----------
+    rsync_command :     The rsync command and options, without the transfer options
+    stream_options :    The extra options of each stream, like its filter rules or file list
+    transfer_options :  The '-e', source and destination arguments for rsync
+
+    """
+    progress = [None] * len(stream_options)
+    progress_lock = threading.Lock()
+    next_progress_time = [time.time() + PROGRESS_INTERVAL]
+
+    def run_stream(number, options):
+        output_tail = collections.deque(maxlen=40)
+        rsync_process = subprocess.Popen(rsync_command + options + transfer_options, encoding='utf-8', errors='surrogateescape',
+                                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        for output in iter(rsync_process.stdout.readline, ""):
+            stream_progress = parse_progress2_line(output)
+            if stream_progress is None:
+                if output.strip():
+                    write_log("[stream "+str(number)+"] "+output, main_log_file)
+                    output_tail.append(output)
+                continue
+            with progress_lock:
+                progress[number] = stream_progress
+                if time.time() >= next_progress_time[0]:
+                    next_progress_time[0] = time.time() + PROGRESS_INTERVAL
+                    running = [stream for stream in progress if stream is not None]
+                    log_and_print(arguments.verbosity_level,"info","Restore progress: "+str(sum(stream["bytes"] for stream in running))+" bytes, streams at "
+                                  +", ".join(str(stream["percent"])+"%" for stream in running),main_log_file)
+        rsync_process.stdout.close()
+        return (rsync_process.wait(), parse_rsync_stats(output_tail))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(stream_options)) as executor:
+        results = list(executor.map(lambda stream: run_stream(*stream), enumerate(stream_options)))
+    returncode = next((code for (code, stats) in results if code), 0)
+    return (returncode, sum_stats([stats for (code, stats) in results]))
+
+
+def state_path(image_path, client, target):
+    key = hashlib.sha1((image_path+"\0"+(client or "")+"\0"+target).encode("utf-8", "surrogateescape")).hexdigest()
+    return os.path.join(RESTORE_STATE_DIRECTORY, key+".json")
+
+def load_state(path):
+    try:
+        with open(path, "r", encoding="utf-8") as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return None
+
+def save_state(path, state):
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as state_file:
+        json.dump(state, state_file, sort_keys=True)
+    os.replace(temporary_path, path)
+
+
+def restore_image(image_path, client, target, ssh_connections):
+    """
+    Restores an image backup onto a logical volume of the client, or into a local image file.
+    The image is split into --streams ranges that are sent at the same time, each as a block
+    stream (see block_transfer.py). The receiver reports how far each range is on disk, and that
+    is kept in a state file, so running the same restore again after an interruption only sends
+    the rest. Returns an exit code.
+
+    Parameters
+    ----------
+    image_path :        The image file in the backup dataset
+    client :            The client to restore to, or None for a local image file
+    target :            Logical volume on the client, or the local image file or a directory for it
+    ssh_connections :   SSHConnectionManager for the client
+
+    """
+    if not client and os.path.isdir(target):
+        target = os.path.join(target, os.path.basename(image_path))
+    size = os.path.getsize(image_path)
+    block_size = DEFAULT_BLOCK_SIZE
+    streams = max(1, min(arguments.streams, (size + block_size - 1) // block_size))
+    range_size = ((size + streams - 1) // streams + block_size - 1) // block_size * block_size
+    ranges = [[start, min(start + range_size, size), start] for start in range(0, size, range_size)] or [[0, 0, 0]]
+
+    os.makedirs(RESTORE_STATE_DIRECTORY, exist_ok=True)
+    path = state_path(image_path, client, target)
+    state = load_state(path)
+    if state is not None and not arguments.restart and state["size"] == size and state["mtime"] == os.path.getmtime(image_path):
+        ranges = state["ranges"]
+        log_and_print(arguments.verbosity_level,"info","Resuming the restore: "+str(sum(synced - start for (start, end, synced) in ranges))+" of "+str(size)+" bytes are already restored",main_log_file)
+    state = {"image": image_path, "client": client, "target": target, "size": size, "mtime": os.path.getmtime(image_path), "ranges": ranges}
+    log_and_print(arguments.verbosity_level,"info","Restoring "+str(size)+" bytes onto "+(client+":" if client else "")+target+" with "+str(len(ranges))+" streams",main_log_file)
+    if arguments.dry_run:
+        for (start, end, synced) in ranges:
+            print("Bytes "+str(synced)+" to "+str(end)+" of "+image_path+" onto "+(client+":" if client else "")+target)
+        return EXIT_OK
+    save_state(path, state)
+    if not client and not os.path.exists(target):
+        #Created before the streams start, since they open it at the same time
+        with open(target, "wb") as image:
+            image.truncate(size)
+
+    state_lock = threading.Lock()
+    rate_limit = arguments.bwlimit // len(ranges) if arguments.bwlimit else None
+
+    def synced(number, offset):
+        with state_lock:
+            ranges[number][2] = max(ranges[number][2], min(offset, ranges[number][1]))
+            save_state(path, state)
+
+    def send_range(number):
+        (start, end, offset) = ranges[number]
+        if offset >= end:
+            return EXIT_OK
+        if client:
+            command = client_script_path+" block-receive -l "+target+" --size "+str(size)+" -v "+str(arguments.verbosity_level)
+            (ssh_stdin, ssh_stdout, ssh_stderr) = ssh_connections.open_command(client, ssh_user, command)
+            output_lines = []
+            def read_output(stream, lines):
+                while True:
+                    line = stream.readline()
+                    if not line:
+                        return
+                    line = line if isinstance(line, str) else line.decode('utf-8', 'replace')
+                    result = parse_result([line])
+                    if result is not None and "synced" in result:
+                        synced(number, result["synced"])
+                    else:
+                        lines.append(line)
+            readers = [threading.Thread(target=read_output, args=(stream, output_lines), daemon=True) for stream in (ssh_stdout, ssh_stderr)]
+            for reader in readers:
+                reader.start()
+            try:
+                send_changed_blocks(image_path, b"", ssh_stdin, block_size, rate_limit, offset, end)
+                ssh_stdin.channel.shutdown_write()
+            except OSError as e:
+                output_lines.append(str(e))
+            for reader in readers:
+                reader.join()
+            exit_code = ssh_stdout.channel.recv_exit_status()
+            for line in output_lines:
+                write_log("[stream "+str(number)+"] "+line, main_log_file)
+        else:
+            (read_fd, write_fd) = os.pipe()
+            errors = []
+            def receive():
+                try:
+                    with os.fdopen(read_fd, "rb") as stream:
+                        receive_changed_blocks(stream, target, None, lambda synced_offset: synced(number, synced_offset))
+                except (OSError, EOFError, ValueError) as e:
+                    errors.append(str(e))
+            receiver = threading.Thread(target=receive, daemon=True)
+            receiver.start()
+            try:
+                with os.fdopen(write_fd, "wb") as stream:
+                    send_changed_blocks(image_path, b"", stream, block_size, rate_limit, offset, end)
+            except OSError as e:
+                errors.append(str(e))
+            receiver.join()
+            for error in errors:
+                write_log("[stream "+str(number)+"] "+error, main_log_file)
+            exit_code = EXIT_CRITICAL if errors else EXIT_OK
+        if not exit_code:
+            synced(number, end)
+        return exit_code
+
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        exit_codes = list(executor.map(send_range, range(len(ranges))))
+    duration = time.time() - start_time
+    if any(exit_codes):
+        log_and_print(arguments.verbosity_level,"critical",str(len(exit_codes) - exit_codes.count(EXIT_OK))+" of "+str(len(ranges))+" restore streams failed. Run the same restore again to resume it",main_log_file)
+        return EXIT_CRITICAL
+    os.remove(path)
+    log_and_print(arguments.verbosity_level,"info","Restore finished in "+str(round(duration, 1))+" seconds, "+str(round(size / duration if duration else 0))+" bytes/sec",main_log_file)
+    return EXIT_OK
+
+
+if __name__ == "__main__":
+    main()
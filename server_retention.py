@@ -0,0 +1,244 @@
+#! /usr/bin/env python3.6
+
+import subprocess, os.path, sys, argparse, time
+from datetime import datetime, timedelta
+from shared_functions import *
+from backup_catalog import open_catalog
+(EXIT_OK, EXIT_WARNING, EXIT_CRITICAL, EXIT_UNKNOWN) = (0,1,2,3)
+
+retention_file_path = zfsync_path("/etc/zfsync/backup.retention")
+main_log_file = zfsync_path("/backup/backupretention.log")
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H-%M-%S' #Format of the timestamp in the backup dataset names
+
+arg_parser = argparse.ArgumentParser(description='Server side script that destroys backups that are older than their retention period.')
+arg_parser.add_argument('-r','--retention-file', default=retention_file_path, help='Retention file to read. Default: '+retention_file_path)
+arg_parser.add_argument('-n','--dry-run', action='store_true', help='Print the plan of what would be promoted and destroyed, and exit')
+arg_parser.add_argument('-b','--batch-size', type=int, default=50, help='Maximum number of snapshots to destroy in one zfs command')
+arg_parser.add_argument('-p','--pause', type=float, default=2.0, help='Seconds to wait between zfs commands, to spread the load on the pool')
+arg_parser.add_argument('-m','--max-destroy', type=int, default=0, help='Maximum number of backup datasets to destroy per backup set in this run. 0 = no limit')
+arg_parser.add_argument('-v','--verbosity-level',nargs='?', const=3, type=int, default=3, help='Level of verbosity for logging and printing. 0 = no logging/printing, 1 = errors, 2 = warning + error, 3 = warning+error+info')
+arguments = arg_parser.parse_args()
+
+def main():
+    exit_code = EXIT_OK
+    for (backup_folder, retention_full, retention_incremental) in parse_retention_file(arguments.retention_file):
+        root_dataset_name = backup_folder.strip("/")
+        if not os.path.isdir(dataset_path(root_dataset_name)):
+            log_and_print(arguments.verbosity_level,"warning","Backup set "+backup_folder+" does not exist. Skipping",main_log_file)
+            exit_code = max(exit_code, EXIT_WARNING)
+            continue
+        plan = plan_pruning(root_dataset_name, retention_full, retention_incremental)
+        if plan is None:
+            exit_code = EXIT_CRITICAL
+            continue
+        if arguments.dry_run:
+            print("# Plan for "+backup_folder+" (full: "+str(retention_full)+" days, incremental: "+str(retention_incremental)+" days)")
+            for step in plan:
+                print(" ".join(step))
+            continue
+        if execute_plan(root_dataset_name, plan):
+            exit_code = EXIT_CRITICAL
+    sys.exit(exit_code)
+
+
+def parse_retention_file(retention_file):
+    """
+    Parses a retention file, and returns a list of (backup_folder, retention_full, retention_incremental)
+    tuples. Retention is in days. The retention for incremental backups can not be higher than
+    for full backups, so it is lowered to the full retention if it is.
+
+    Parameters
+    ----------
+    retention_file :    Path to the retention file
+
+    """
+    backup_sets = []
+    with open(retention_file, "r", encoding="utf-8") as retention:
+        for line_number, line in enumerate(retention, 1):
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            fields = line.split()
+            if len(fields) != 3:
+                log_and_print(arguments.verbosity_level,"warning","Ignoring invalid line "+str(line_number)+" in "+retention_file+": "+line,main_log_file)
+                continue
+            (backup_folder, retention_full, retention_incremental) = (fields[0], int(fields[1]), int(fields[2]))
+            if retention_incremental > retention_full:
+                log_and_print(arguments.verbosity_level,"warning","Incremental retention is higher than full retention for "+backup_folder+". Using "+str(retention_full)+" days",main_log_file)
+                retention_incremental = retention_full
+            backup_sets.append((backup_folder, retention_full, retention_incremental))
+    return backup_sets
+
+
+def expired_backups(catalog, retention_full, retention_incremental, now=None):
+    """
+    Returns the datasets of the backups in the catalog that are older than their retention,
+    newest first. The newest successful full backup, the newest backup, and backups that
+    are still running are never expired, so that later diff and inc backups have a base.
+
+    Parameters
+    ----------
+    catalog :               BackupCatalog of the backup job
+    retention_full :        Days to keep full backups
+    retention_incremental : Days to keep diff and inc backups
+
+    """
+    now = now or datetime.now()
+    cutoff_full = (now - timedelta(days=retention_full)).strftime(TIMESTAMP_FORMAT)
+    cutoff_incremental = (now - timedelta(days=retention_incremental)).strftime(TIMESTAMP_FORMAT)
+    keep = set()
+    for backup in (catalog.last_backup("full"), catalog.last_backup(statuses=None)):
+        if backup is not None:
+            keep.add(backup["dataset"])
+
+    expired = []
+    for backup in catalog.backups(older_than=max(cutoff_full, cutoff_incremental)):
+        if backup["dataset"] in keep or backup["status"] == "running":
+            continue
+        cutoff = cutoff_full if backup["backup_type"] == "full" else cutoff_incremental
+        if backup["timestamp"] < cutoff:
+            expired.append(backup["dataset"])
+    expired.reverse()
+    return expired
+
+
+def read_origins(root_dataset_name):
+    """
+    Returns a dictionary with the origin snapshot of every dataset in the backup job,
+    as a (dataset, snapshot name) tuple, or None for datasets that are not clones,
+    and a dictionary with the snapshot names of every dataset.
+    Returns None, None if the datasets can not be listed.
+
+    Parameters
+    ----------
+    root_dataset_name :     ZFS name of the root dataset of the backup job
+
+    """
+    datasets = subprocess.run(['zfs', 'list', '-H', '-t', 'filesystem,snapshot', '-o', 'name,origin', '-s', 'createtxg', '-r', root_dataset_name],
+                              encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if datasets.returncode:
+        log_and_print(arguments.verbosity_level,"critical",datasets.stderr,main_log_file)
+        return None, None
+    origins = {}
+    snapshots = {}
+    for line in datasets.stdout.splitlines():
+        (name, origin) = line.split("\t")
+        if "@" in name:
+            (dataset, snapshot) = name.split("@", 1)
+            snapshots.setdefault(dataset, []).append(snapshot)
+        elif name != root_dataset_name:
+            origins[name] = None if origin == "-" else tuple(origin.split("@", 1))
+    return origins, snapshots
+
+
+def plan_pruning(root_dataset_name, retention_full, retention_incremental):
+    """
+    Returns the list of zfs operations needed to remove the expired backups of a backup set.
+    Each operation is a tuple: ('promote', clone), ('destroy', dataset) or
+    ('destroy-snapshots', dataset, 'snap1,snap2,...').
+    Expired backups are handled newest first, so that clones are destroyed before the
+    datasets they were cloned from. When an expired dataset still has clones that are kept,
+    the clone of its newest snapshot is promoted first. The promoted clone takes over the
+    snapshots the other clones depend on, and the expired dataset can be destroyed.
+    Finally, the '_snap' snapshots that no clone depends on any longer are destroyed in batches.
+    Returns None if the datasets of the backup set can not be listed.
+
+    Parameters
+    ----------
+    root_dataset_name :     ZFS name of the root dataset of the backup job
+    retention_full :        Days to keep full backups
+    retention_incremental : Days to keep diff and inc backups
+
+    """
+    catalog = open_catalog(root_dataset_name)
+    expired = expired_backups(catalog, retention_full, retention_incremental)
+    catalog.close()
+    origins, snapshots = read_origins(root_dataset_name)
+    if origins is None:
+        return None
+
+    plan = []
+    destroyed = set()
+    for dataset in expired:
+        if arguments.max_destroy and len(destroyed) >= arguments.max_destroy:
+            break
+        if dataset not in origins:
+            continue #Already gone from ZFS
+        clones = [clone for clone in origins if clone not in destroyed and origins[clone] and origins[clone][0] == dataset]
+        if clones:
+            dataset_snapshots = snapshots.get(dataset, [])
+            promoted = max(clones, key=lambda clone: dataset_snapshots.index(origins[clone][1]) if origins[clone][1] in dataset_snapshots else -1)
+            origin_snapshot = origins[promoted][1]
+            plan.append(("promote", promoted))
+            #Simulate 'zfs promote': the snapshots up to the origin snapshot move to the promoted clone
+            position = dataset_snapshots.index(origin_snapshot) + 1 if origin_snapshot in dataset_snapshots else len(dataset_snapshots)
+            moved_snapshots = dataset_snapshots[:position]
+            snapshots[promoted] = moved_snapshots + snapshots.get(promoted, [])
+            snapshots[dataset] = dataset_snapshots[position:]
+            origins[promoted] = origins[dataset]
+            for clone in origins:
+                if clone != promoted and origins[clone] and origins[clone][0] == dataset and origins[clone][1] in moved_snapshots:
+                    origins[clone] = (promoted, origins[clone][1])
+            origins[dataset] = (promoted, origin_snapshot)
+        plan.append(("destroy", dataset))
+        destroyed.add(dataset)
+
+    #Snapshots made for clones that are gone only hold on to space
+    used_snapshots = set(origins[clone] for clone in origins if clone not in destroyed and origins[clone])
+    for dataset in origins:
+        if dataset in destroyed:
+            continue
+        unused = [snapshot for snapshot in snapshots.get(dataset, []) if snapshot.endswith("_snap") and (dataset, snapshot) not in used_snapshots]
+        for start in range(0, len(unused), arguments.batch_size):
+            plan.append(("destroy-snapshots", dataset, ",".join(unused[start:start+arguments.batch_size])))
+    return plan
+
+
+def execute_plan(root_dataset_name, plan):
+    """
+    Runs the zfs operations of a plan from plan_pruning, with a pause between each
+    operation. Destroyed datasets are removed from the catalog, and the parent
+    snapshots in the catalog are updated after promotions.
+    Returns 0 if every operation succeeded, or else 1.
+
+    Parameters
+    ----------
+    root_dataset_name :     ZFS name of the root dataset of the backup job
+    plan :                  List of operations from plan_pruning
+
+    """
+    catalog = open_catalog(root_dataset_name)
+    failed = 0
+    for step in plan:
+        if step[0] == "promote":
+            command = ['zfs', 'promote', step[1]]
+        elif step[0] == "destroy":
+            command = ['zfs', 'destroy', '-r', step[1]]
+        else:
+            command = ['zfs', 'destroy', step[1]+'@'+step[2]]
+        proc = subprocess.run(command, encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode:
+            log_and_print(arguments.verbosity_level,"critical","Failed: "+" ".join(command)+": "+proc.stderr,main_log_file)
+            failed = 1
+            if step[0] == "promote":
+                #The dataset it was promoted for can not be destroyed now, and neither can the steps after it
+                break
+        else:
+            log_and_print(arguments.verbosity_level,"info","Done: "+" ".join(command),main_log_file)
+            if step[0] == "destroy":
+                catalog.remove_backup(step[1])
+        time.sleep(arguments.pause)
+
+    origins, snapshots = read_origins(root_dataset_name)
+    for dataset in (origins or {}):
+        backup = catalog.get_backup(dataset)
+        if backup is not None and origins[dataset]:
+            parent_snapshot = "@".join(origins[dataset])
+            if backup["parent_snapshot"] != parent_snapshot:
+                catalog.set_parent_snapshot(dataset, parent_snapshot)
+    catalog.close()
+    return failed
+
+
+if __name__ == "__main__":
+    main()
@@ -1,61 +1,177 @@
-import sys, subprocess, os
-from datetime import datetime
+import sys, os, json, threading, queue, time, atexit
 (EXIT_OK, EXIT_WARNING, EXIT_CRITICAL, EXIT_UNKNOWN) = (0,1,2,3)
+RESULT_PREFIX = "zfsync-result: " #Marks the line with the machine readable result of a client command
+#Directory that every fixed path of zfsync is relative to. Empty in production; the benchmarks
+#point it at a scratch directory, where shims stand in for zfs, LVM, mount and ssh
+ZFSYNC_ROOT = os.environ.get("ZFSYNC_ROOT", "").rstrip("/")
 
-def delete_lockfile(lock_file_path):
+def zfsync_path(path):
     """
-    This function deletes a lock file to mark that a backup job process is
-    no longer running.
-    The function takes one parameter: lock_file_path
+    Returns a fixed path, like '/etc/zfsync/lock', under ZFSYNC_ROOT
 
-    Parameters
-    ----------
-    lock_file_path :     The path of the lock file to be deleted
+    """
+    return ZFSYNC_ROOT + path
 
+def dataset_path(dataset_name):
     """
+    Returns the mount path of a ZFS dataset. Datasets are mounted at their name, like /backup/job1
 
-    proc = subprocess.run(['rm', '-f', lock_file_path], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if proc.returncode:
-        print(proc.stderr)
-        sys.exit(EXIT_UNKNOWN)
-    else:
-        print("Lock file deleted")
+    """
+    return zfsync_path("/" + dataset_name)
 
-def create_lockfile(lock_file_path):
+def is_mount_point(path):
     """
-    This function creates a lock file to mark that a backup job process is
-    already running.
-    The function takes one parameter: lock_file_path
+    Returns True if something is mounted on path. Under ZFSYNC_ROOT the mount shim of the
+    benchmarks mounts by replacing the directory with a symlink, which also counts.
 
-    Parameters
-    ----------
-    lock_file_path :     The path of the lock file to be created
+    """
+    if ZFSYNC_ROOT and os.path.islink(path):
+        return True
+    return os.path.ismount(path)
+
+LOG_LEVELS = {"critical": 1, "warning": 2, "info": 3}
+LOG_BATCH_SIZE = 512 #Maximum number of log records written in one batch
+
+class _CloseLog:
+    #Queued by close_log, so the file is closed after the records before it are written
+    def __init__(self, log_file):
+        self.log_file = log_file
 
+class _LogWriter(threading.Thread):
     """
-    proc = subprocess.run(['touch', lock_file_path], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if proc.returncode:
-        print(proc.stderr)
-        sys.exit(EXIT_WARNING)
-    else:
-        print("Lock file created")
+    Background thread that writes queued log records. Log files are kept open until close_log,
+    and records are written in batches, so callers of log_and_print never wait for disk.
+    Records are either text lines, or JSON lines when the log format is 'json'.
 
-def check_lockfile(lock_file_path):
     """
-    This function checks for the presense of a lock file and returns true or false
-    The function takes one parameter: lock_file_path
 
-    Parameters
-    ----------
-    lock_file_path :     The path of the lock file to be checked
+    def __init__(self):
+        threading.Thread.__init__(self, name="log-writer", daemon=True)
+        self.records = queue.Queue()
+        self.log_format = "text"
+        self.handles = {}
+        self.last_second = None
+        self.last_timestamp = ""
+
+    def format_time(self, timestamp):
+        second = int(timestamp)
+        if second != self.last_second:
+            self.last_second = second
+            self.last_timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+        return self.last_timestamp
+
+    def format_record(self, record):
+        (timestamp, level, message, log_file) = record
+        if level is None:
+            return message #Raw output, like from rsync
+        if self.log_format == "json":
+            return json.dumps({"time": self.format_time(timestamp), "level": level, "message": message}) + "\n"
+        return self.format_time(timestamp) + " - " + level + " - " + message + "\n"
+
+    def write_batch(self, batch):
+        written = set()
+        for record in batch:
+            log_file = record[3]
+            try:
+                handle = self.handles.get(log_file)
+                if handle is None:
+                    handle = open(log_file, "a+", encoding="utf-8")
+                    self.handles[log_file] = handle
+                handle.write(self.format_record(record))
+                written.add(log_file)
+            except OSError as e:
+                print("Unable to write to log file "+str(log_file)+": "+str(e), file=sys.stderr)
+        for log_file in written:
+            self.handles[log_file].flush()
+
+    def close(self, log_file):
+        handle = self.handles.pop(log_file, None)
+        if handle is not None:
+            try:
+                handle.close()
+            except OSError as e:
+                print("Unable to close log file "+str(log_file)+": "+str(e), file=sys.stderr)
+
+    def run(self):
+        while True:
+            record = self.records.get()
+            batch = []
+            while record is not None:
+                if isinstance(record, threading.Event):
+                    self.write_batch(batch)
+                    batch = []
+                    record.set()
+                elif isinstance(record, _CloseLog):
+                    self.write_batch(batch)
+                    batch = []
+                    self.close(record.log_file)
+                else:
+                    batch.append(record)
+                if len(batch) >= LOG_BATCH_SIZE:
+                    break
+                try:
+                    record = self.records.get_nowait()
+                except queue.Empty:
+                    record = None
+            self.write_batch(batch)
+
+_log_writer = None
+_log_writer_lock = threading.Lock()
+
+def _get_log_writer():
+    global _log_writer
+    with _log_writer_lock:
+        if _log_writer is None:
+            _log_writer = _LogWriter()
+            _log_writer.start()
+            atexit.register(flush_logs)
+        return _log_writer
+
+def set_log_format(log_format):
+    """
+    Sets the format of the log files: 'text' for the classic
+    'date - level - message' lines, or 'json' for one JSON object per line
+
+    """
+    if log_format not in ("text", "json"):
+        raise ValueError("Unknown log format: "+str(log_format))
+    _get_log_writer().log_format = log_format
+
+def flush_logs(timeout=10):
+    """
+    Waits until every queued log record has been written. Called automatically at exit.
+
+    """
+    if _log_writer is None:
+        return
+    done = threading.Event()
+    _log_writer.records.put(done)
+    done.wait(timeout)
+
+def close_log(log_file):
+    """
+    Closes a log file once the records queued for it have been written, like the logs of a
+    backup job that has finished in a long running process. Later records open it again.
+
+    """
+    if _log_writer is None:
+        return
+    _log_writer.records.put(_CloseLog(log_file))
+
+def write_log(message, log_file):
+    """
+    Queues raw text, like output from rsync, to be written to a log file as it is,
+    in order with the records from log_and_print
 
     """
-    return os.path.isfile(lock_file_path)
+    _get_log_writer().records.put((None, None, message, log_file))
 
 def log_and_print(verbosity,level, message, log_file):
     """
     Writes message and its verbosity level to specified log file, and prints them.
     Timestamp is automatically added to log file.
     Specified verbosity level decides what gets logged and printed
+    The log file is written by a background thread, so this function does not wait for disk.
 
     Parameters
     ----------
@@ -67,22 +183,40 @@ def log_and_print(verbosity,level, message, log_file):
 
     """
 
-    if level == "critical":
-        level_as_int = 1
-    elif level == "warning":
-        level_as_int = 2
-    elif level == "info":
-        level_as_int = 3
-    else:
-        level_as_int = 0
+    level_as_int = LOG_LEVELS.get(level, 0)
 
     if int(verbosity) >= level_as_int:
-        date_now = datetime.today().strftime('%Y-%m-%d')
-        datetime_now = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
-        with open(log_file, "a+", encoding="utf-8") as log:
-            log.write(datetime_now + " - " + level + " - " + message + "\n")
-        log.close()
+        records = _get_log_writer().records
+        timestamp = time.time()
+        records.put((timestamp, level, message, log_file))
         print(level,"-",message)
         if level_as_int == 0:
             print("The level specified is not valid. Message will be logged, but this should be fixed")
-            log.write(datetime_now + "The level specified is not valid. Message will be logged, but this should be fixed \n")
+            records.put((timestamp, "warning", "The level specified is not valid. Message will be logged, but this should be fixed", log_file))
+
+def print_result(result):
+    """
+    Prints a machine readable result as a single line of JSON, marked with
+    RESULT_PREFIX so that it can be found among the other output of a command.
+
+    Parameters
+    ----------
+    result :    A JSON serializable object
+
+    """
+    print(RESULT_PREFIX + json.dumps(result, sort_keys=True), flush=True)
+
+def parse_result(output_lines):
+    """
+    Returns the last machine readable result printed by print_result in the given
+    output lines, or None if there is no result in the output.
+
+    Parameters
+    ----------
+    output_lines :  List of lines of output from a command
+
+    """
+    for line in reversed(output_lines):
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    return None
@@ -0,0 +1,133 @@
+import subprocess, json, os, math
+from shared_functions import zfsync_path
+
+TELEMETRY_DIRECTORY = zfsync_path("/etc/zfsync/telemetry") #Fill level samples of running snapshots, and the history of each logical volume
+HISTORY_LENGTH = 20 #Runs kept in the history of each logical volume
+SIZING_RUNS = 5 #The last runs that the size of a new snapshot is based on
+SIZE_MARGIN = 1.5 #A new snapshot gets this many times the space the last runs used
+SIZE_ROUNDING = 64 #Snapshot sizes are rounded up to this many megabytes
+
+def telemetry_path(lv_path, name):
+    """
+    Returns the path of a telemetry file of a logical volume, like
+    TELEMETRY_DIRECTORY/vg_lv.history.json. name is 'history', or a snapshot suffix
+    for the files of a running snapshot
+
+    """
+    return TELEMETRY_DIRECTORY+"/"+lv_path.split("/")[2]+"_"+lv_path.split("/")[3]+"."+name.lstrip("_")+".json"
+
+def read_json(path, default):
+    try:
+        with open(path, "r", encoding="utf-8") as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return default
+
+def write_json(path, data):
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as json_file:
+        json.dump(data, json_file, indent=1, sort_keys=True)
+    os.replace(temporary_path, path)
+
+def read_snapshot_usage(snapshot_paths):
+    """
+    Reads the size and fill level of one or more snapshots with one call to 'lvs'.
+    Returns a dictionary from snapshot path to a dictionary with 'size_mb', 'data_percent',
+    'used_mb' and 'invalid'. Snapshots that do not exist are left out.
+
+    Parameters
+    ----------
+    snapshot_paths :    Paths of the snapshots, like /dev/vg/lv_rsyncbackup_<timestamp>
+
+    """
+    lvs = subprocess.run(['lvs', '--noheadings', '--units', 'm', '--nosuffix', '--separator', ',', '-o', 'vg_name,lv_name,lv_size,data_percent,lv_attr']
+                         + [path[len("/dev/"):] for path in snapshot_paths], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    usage = {}
+    for line in lvs.stdout.splitlines():
+        fields = line.strip().split(",")
+        if len(fields) != 5:
+            continue
+        (vg_name, lv_name, size, percent, attributes) = fields
+        size_mb = float(size)
+        data_percent = float(percent) if percent else 0.0
+        usage["/dev/"+vg_name+"/"+lv_name] = {"size_mb": size_mb, "data_percent": data_percent, "used_mb": size_mb * data_percent / 100,
+                                              "invalid": len(attributes) > 4 and attributes[4] == "I"}
+    return usage
+
+def summarize_run(samples, size_mb, extensions):
+    """
+    Sums up the samples of one snapshot into a run for the history of the logical volume.
+    The write rate is the space used in the snapshot over the time it existed, in megabytes per second.
+
+    Parameters
+    ----------
+    samples :       List of (time, used_mb, data_percent, invalid) samples, oldest first
+    size_mb :       The size of the snapshot at the end
+    extensions :    How many times the snapshot was extended
+
+    """
+    if not samples:
+        return None
+    duration = samples[-1][0] - samples[0][0]
+    peak_used_mb = max(sample[1] for sample in samples)
+    return {"timestamp": samples[0][0], "duration": duration, "peak_used_mb": peak_used_mb,
+            "peak_percent": max(sample[2] for sample in samples), "size_mb": size_mb, "extensions": extensions,
+            "write_rate_mb_s": peak_used_mb / duration if duration > 0 else 0.0,
+            "invalid": any(sample[3] for sample in samples)}
+
+def append_history(lv_path, run):
+    """
+    Adds a run to the history of a logical volume, and keeps the last HISTORY_LENGTH runs
+
+    """
+    history = read_json(telemetry_path(lv_path, "history"), [])
+    history.append(run)
+    write_json(telemetry_path(lv_path, "history"), history[-HISTORY_LENGTH:])
+
+def planned_snapshot_size(lv_path, minimum_size):
+    """
+    Returns the size in megabytes for a new snapshot of a logical volume. The size is what
+    the last SIZING_RUNS runs used, from their write rate and duration, times SIZE_MARGIN.
+    A run where the snapshot overflowed counts as having used twice its size.
+    Never less than minimum_size.
+
+    Parameters
+    ----------
+    lv_path :       The path to the logical volume
+    minimum_size :  Size in megabytes to use without history, and the lowest size returned
+
+    """
+    needed = 0.0
+    for run in read_json(telemetry_path(lv_path, "history"), [])[-SIZING_RUNS:]:
+        used = max(run["peak_used_mb"], run["write_rate_mb_s"] * run["duration"])
+        if run.get("invalid"):
+            used = max(used, run["size_mb"] * 2)
+        needed = max(needed, used)
+    size = max(minimum_size, needed * SIZE_MARGIN)
+    return int(math.ceil(size / SIZE_ROUNDING) * SIZE_ROUNDING)
+
+def extension_needed(samples, size_mb, threshold_percent, lookahead):
+    """
+    Returns how many megabytes a snapshot should be extended by now, or 0. A snapshot is
+    extended when it is above threshold_percent, or when the write rate of the last samples
+    would take it there within lookahead seconds. It is extended by at least a fifth of its
+    size, and by enough for the write rate to be covered for ten lookahead periods.
+
+    Parameters
+    ----------
+    samples :           List of (time, used_mb, data_percent, invalid) samples, oldest first
+    size_mb :           The current size of the snapshot
+    threshold_percent : Fill level at which the snapshot is extended
+    lookahead :         Seconds until the next chance to extend the snapshot
+
+    """
+    if not samples:
+        return 0
+    (now, used_mb) = samples[-1][:2]
+    rate = 0.0
+    if len(samples) > 1 and now > samples[-2][0]:
+        rate = max(0.0, (used_mb - samples[-2][1]) / (now - samples[-2][0]))
+    if (used_mb + rate * lookahead) * 100 / size_mb < threshold_percent:
+        return 0
+    extension = max(size_mb / 5, rate * lookahead * 10)
+    return int(math.ceil(extension / SIZE_ROUNDING) * SIZE_ROUNDING)
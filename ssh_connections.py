@@ -0,0 +1,253 @@
+import subprocess, os, threading, time, shlex
+from shared_functions import *
+from metrics import Metrics
+
+SSH_CONTROL_DIR = "/tmp/zfsync-ssh" #Directory for the ControlMaster sockets used by rsync
+#'paramiko' runs control commands over a paramiko connection. 'ssh' runs them with the ssh binary
+#over the ControlMaster connection, which the benchmarks use with their local ssh shim
+SSH_TRANSPORT = os.environ.get("ZFSYNC_SSH_TRANSPORT", "paramiko")
+CONTROL_MASTER_TIMEOUT = 30 #Seconds to wait for a ControlMaster socket to come up
+
+class SSHConnectionManager:
+    """
+    Keeps one authenticated SSH connection per client for the length of a backup job, or for
+    all the jobs that run in one process. Every control command is run on a new channel of that
+    connection, so a client is only authenticated once no matter how many commands are sent to it.
+    Connections to different clients are opened without waiting for each other.
+    Data transfers that need the ssh binary (rsync) can share one ControlMaster
+    connection per client, which is started on first use and stopped by close_all().
+    With the 'ssh' transport, control commands also go over the ControlMaster connection.
+
+    Parameters
+    ----------
+    verbosity :     Level of verbosity for logging and printing
+    log_file :      Path to, and name of the log file to write to
+    control_dir :   Directory where the ControlMaster sockets are created
+    transport :     'paramiko' or 'ssh'
+    metrics :       Metrics that the time to connect is recorded in, as the 'ssh_connect' phase,
+                    unless a call gives the metrics of its own job
+
+    """
+
+    def __init__(self, verbosity, log_file, control_dir=SSH_CONTROL_DIR, transport=SSH_TRANSPORT, metrics=None):
+        self.verbosity = verbosity
+        self.log_file = log_file
+        self.control_dir = control_dir
+        self.transport = transport
+        self.metrics = metrics or Metrics()
+        self._clients = {}
+        self._masters = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _key_lock(self, key):
+        """
+        Returns the lock for the connections to one username@client
+
+        """
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get_client(self, client, username, metrics=None):
+        """
+        Returns a connected paramiko SSHClient for username@client. The connection
+        is opened on the first call, and reopened if the transport has died.
+        Raises the paramiko exception if the client can not be reached.
+
+        Parameters
+        ----------
+        client :        Hostname or IP address of the client
+        username :      The username that will be used to connect to the client
+        metrics :       Metrics of the job to record the time to connect in, instead of the manager's
+
+        """
+        key = (username, client)
+        with self._key_lock(key):
+            ssh = self._clients.get(key)
+            if ssh is not None:
+                transport = ssh.get_transport()
+                if transport is not None and transport.is_active():
+                    return ssh
+                ssh.close()
+                del self._clients[key]
+
+            from paramiko import SSHClient
+            ssh = SSHClient()
+            ssh.load_system_host_keys()
+            log_and_print(self.verbosity,"info", "Connecting to '"+client+"' via SSH as user '"+username+"'",self.log_file)
+            try:
+                with (metrics or self.metrics).span("ssh_connect"):
+                    ssh.connect(client, username = username)
+            except Exception:
+                ssh.close()
+                raise
+            #Keep the connection alive while long rsync runs keep it idle
+            ssh.get_transport().set_keepalive(30)
+            self._clients[key] = ssh
+            return ssh
+
+    def exec_command(self, client, username, command, metrics=None):
+        """
+        Runs a command on the client over a new channel of the shared connection.
+        Returns a tuple with stdout lines, stderr lines and the exit code.
+
+        Parameters
+        ----------
+        client :        Hostname or IP address of the client
+        username :      The username that will be used to connect to the client
+        command :       The command line to run on the client
+        metrics :       Metrics of the job to record the time to connect in, instead of the manager's
+
+        """
+        if self.transport == "ssh":
+            process = subprocess.run(shlex.split(self.rsync_ssh_command(client, username, metrics)) + [username+'@'+client, command], stdin=subprocess.DEVNULL,
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', errors='replace')
+            return (process.stdout.splitlines(True), process.stderr.splitlines(True), process.returncode)
+        ssh = self.get_client(client, username, metrics)
+        (ssh_stdin, ssh_stdout, ssh_stderr) = ssh.exec_command(command)
+        ssh_stdin.close()
+        stdout = ssh_stdout.readlines()
+        stderr = ssh_stderr.readlines()
+        exit_code = ssh_stdout.channel.recv_exit_status()
+        return (stdout, stderr, exit_code)
+
+    def open_command(self, client, username, command, metrics=None):
+        """
+        Starts a command on the client over a new channel of the shared connection,
+        and returns its stdin, stdout and stderr as file objects, for commands that
+        stream data. The exit code is read with stdout.channel.recv_exit_status().
+
+        Parameters
+        ----------
+        client :        Hostname or IP address of the client
+        username :      The username that will be used to connect to the client
+        command :       The command line to run on the client
+        metrics :       Metrics of the job to record the time to connect in, instead of the manager's
+
+        """
+        if self.transport == "ssh":
+            process = subprocess.Popen(shlex.split(self.rsync_ssh_command(client, username, metrics)) + [username+'@'+client, command], bufsize=1024 * 1024,
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            channel = ProcessChannel(process)
+            return (ProcessFile(process.stdin, channel), ProcessFile(process.stdout, channel), ProcessFile(process.stderr, channel))
+        ssh = self.get_client(client, username, metrics)
+        return ssh.exec_command(command, bufsize=1024 * 1024)
+
+    def control_path(self, client, username):
+        """
+        Returns the path of the ControlMaster socket for username@client
+
+        """
+        return os.path.join(self.control_dir, username+"@"+client+".sock")
+
+    def rsync_ssh_command(self, client, username, metrics=None):
+        """
+        Returns the remote shell command that rsync should use with '-e' to reach
+        the client. A ControlMaster connection to the client is started the first
+        time this is called, so that every rsync to the client reuses it. If the
+        master can not be started, plain 'ssh' is returned.
+
+        Parameters
+        ----------
+        client :        Hostname or IP address of the client
+        username :      The username that will be used to connect to the client
+        metrics :       Metrics of the job to record the time to start the master in, instead of the manager's
+
+        """
+        key = (username, client)
+        control_path = self.control_path(client, username)
+        with self._key_lock(key):
+            if key not in self._masters:
+                with (metrics or self.metrics).span("ssh_control_master") as span:
+                    self._masters[key] = self._start_control_master(client, username, control_path)
+                    if self._masters[key] is None:
+                        span["status"] = "error"
+            if self._masters[key] is None:
+                return "ssh"
+        return "ssh -o ControlMaster=no -o ControlPath="+control_path
+
+    def _start_control_master(self, client, username, control_path):
+        os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+        if os.path.exists(control_path):
+            #Left behind by an earlier job that did not exit cleanly
+            os.remove(control_path)
+        master = subprocess.Popen(['ssh', '-M', '-N', '-o', 'ControlPath='+control_path, '-o', 'ServerAliveInterval=30', username+'@'+client],
+                                  stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        deadline = time.time() + CONTROL_MASTER_TIMEOUT
+        while time.time() < deadline:
+            if master.poll() is not None:
+                log_and_print(self.verbosity,"warning","SSH ControlMaster for '"+client+"' exited: "+master.stderr.read().decode('utf-8', 'replace'),self.log_file)
+                return None
+            check = subprocess.run(['ssh', '-O', 'check', '-o', 'ControlPath='+control_path, username+'@'+client],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if not check.returncode:
+                log_and_print(self.verbosity,"info","SSH ControlMaster started for '"+client+"': "+control_path,self.log_file)
+                return master
+            time.sleep(0.2)
+        log_and_print(self.verbosity,"warning","Timed out waiting for SSH ControlMaster for '"+client+"'. Using plain ssh",self.log_file)
+        master.terminate()
+        master.wait()
+        return None
+
+    def close_client(self, client, username):
+        """
+        Closes the SSH connection and stops the ControlMaster to username@client, once no
+        job of the client is left to use them
+
+        """
+        key = (username, client)
+        with self._key_lock(key):
+            ssh = self._clients.pop(key, None)
+            if ssh is not None:
+                ssh.close()
+            master = self._masters.pop(key, None)
+            if master is None:
+                return
+            subprocess.run(['ssh', '-O', 'exit', '-o', 'ControlPath='+self.control_path(client, username), username+'@'+client],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                master.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                master.terminate()
+                master.wait()
+
+    def close_all(self):
+        """
+        Closes every SSH connection and stops every ControlMaster started by this manager
+
+        """
+        with self._lock:
+            keys = set(self._clients) | set(self._masters)
+        for (username, client) in keys:
+            self.close_client(client, username)
+
+
+class ProcessChannel:
+    """
+    Stands in for the paramiko channel of a command that was started with the ssh binary,
+    so callers of open_command work the same with both transports
+
+    """
+
+    def __init__(self, process):
+        self.process = process
+
+    def shutdown_write(self):
+        self.process.stdin.close()
+
+    def recv_exit_status(self):
+        return self.process.wait()
+
+
+class ProcessFile:
+    """
+    A pipe of a command started with the ssh binary, with the 'channel' attribute of a paramiko file
+
+    """
+
+    def __init__(self, pipe, channel):
+        self.pipe = pipe
+        self.channel = channel
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
@@ -0,0 +1,175 @@
+import os, fcntl
+from shared_functions import dataset_path
+
+STATUS_FILE_NAME = "status.txt" #Stored in the mount point of the root dataset of each backup job
+INDEX_FILE_NAME = "status.idx"
+RECORD_SIZE = 64 #Every record is padded to this many bytes, newline included
+JOURNAL_HEADER = "#zfsync status journal 1" #First record of every journal, tells it apart from the status files from before the journal
+
+class StatusJournal:
+    """
+    Append-only journal with the status of every run of a backup job. Each record is
+    one line of exactly RECORD_SIZE bytes: 'status,backup_name[,extra]' padded with spaces,
+    after a first record with JOURNAL_HEADER.
+    Since the records have a fixed size, the last N records are read by seeking from
+    the end of the file. The offset of the last successful record is kept in a small
+    index file, so it is found without scanning the history either.
+
+    Parameters
+    ----------
+    root_dataset_name :     ZFS name of the root dataset of the backup job. Example: 'backup/job1'
+    path :                  Path to the journal. Defaults to status.txt in the root dataset
+
+    """
+
+    def __init__(self, root_dataset_name, path=None):
+        self.path = path or dataset_path(root_dataset_name)+"/"+STATUS_FILE_NAME
+        self.index_path = os.path.join(os.path.dirname(self.path), INDEX_FILE_NAME)
+        if os.path.isfile(self.path) and not self._has_header():
+            self._convert_old_journal()
+
+    def _has_header(self):
+        with open(self.path, "rb") as status:
+            return status.read(RECORD_SIZE) == format_header().encode("utf-8")
+
+    def _convert_old_journal(self):
+        #Status files from before the journal had lines of any length. They are rewritten once.
+        #Lines that are not 'status,backup_name[,extra]', or too long for a record, are left out
+        with open(self.path, "r", encoding="utf-8", errors="replace") as status:
+            lines = [line.strip() for line in status if line.strip() and not line.startswith("#")]
+        records = []
+        for line in lines:
+            if "," not in line:
+                continue
+            try:
+                records.append((line, format_record(*line.split(",", 2))))
+            except ValueError:
+                continue
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as status:
+            status.write(format_header())
+            for (line, record) in records:
+                status.write(record)
+        os.replace(temporary_path, self.path)
+        last_success = None
+        for number, (line, record) in enumerate(records, 1):
+            if line.startswith("successful,"):
+                last_success = number * RECORD_SIZE
+        self._write_index(last_success)
+
+    def _write_index(self, offset):
+        temporary_path = self.index_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as index:
+            index.write("" if offset is None else str(offset))
+        os.replace(temporary_path, self.index_path)
+
+    def _rebuild_index(self):
+        #Only needed if the index file was lost. Scans the journal backwards for the last success
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path, "rb") as status:
+            position = status.seek(0, os.SEEK_END) - RECORD_SIZE
+            while position >= RECORD_SIZE:
+                status.seek(position)
+                if parse_record(status.read(RECORD_SIZE))[0] == "successful":
+                    self._write_index(position)
+                    return str(position)
+                position -= RECORD_SIZE
+        self._write_index(None)
+        return None
+
+    def append(self, status, backup_name, extra=""):
+        """
+        Appends a record to the journal, and updates the index if the run was successful
+
+        Parameters
+        ----------
+        status :        Status of the run, like 'successful' or 'failed'
+        backup_name :   Name of the backup, like '2019-06-05T11-11-11_full'
+        extra :         Optional extra information, like the result of a verification
+
+        """
+        record = format_record(status, backup_name, extra).encode("utf-8")
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            offset = os.lseek(fd, 0, os.SEEK_END)
+            if offset == 0:
+                os.write(fd, format_header().encode("utf-8"))
+                offset = RECORD_SIZE
+            os.write(fd, record)
+            if status == "successful":
+                self._write_index(offset)
+        finally:
+            os.close(fd)
+
+    def last(self, count=1):
+        """
+        Returns the last 'count' records, newest first, as (status, backup_name, extra) tuples
+
+        """
+        if not os.path.isfile(self.path):
+            return []
+        with open(self.path, "rb") as status:
+            size = status.seek(0, os.SEEK_END)
+            start = max(RECORD_SIZE, size - count * RECORD_SIZE)
+            status.seek(start)
+            data = status.read(size - start) if size > start else b""
+        records = [parse_record(data[position:position+RECORD_SIZE]) for position in range(0, len(data), RECORD_SIZE)]
+        records.reverse()
+        return records
+
+    def last_status(self):
+        """
+        Returns the last record, or None if the job has never run
+
+        """
+        records = self.last(1)
+        return records[0] if records else None
+
+    def last_success(self):
+        """
+        Returns the last successful record, or None if the job has never run successfully
+
+        """
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as index:
+                offset = index.read().strip()
+        except FileNotFoundError:
+            offset = self._rebuild_index()
+        if not offset:
+            return None
+        with open(self.path, "rb") as status:
+            status.seek(int(offset))
+            return parse_record(status.read(RECORD_SIZE))
+
+
+def format_record(status, backup_name, extra=""):
+    """
+    Returns a journal record padded to RECORD_SIZE bytes. Raises ValueError if it does not fit.
+
+    """
+    record = status + "," + backup_name + ("," + extra if extra else "")
+    length = len(record.encode("utf-8"))
+    if length >= RECORD_SIZE or "\n" in record:
+        raise ValueError("Status record does not fit in "+str(RECORD_SIZE)+" bytes: "+record)
+    return record + " " * (RECORD_SIZE - 1 - length) + "\n"
+
+
+def format_header():
+    """
+    Returns the first record of a journal, padded to RECORD_SIZE bytes
+
+    """
+    return JOURNAL_HEADER + " " * (RECORD_SIZE - 1 - len(JOURNAL_HEADER)) + "\n"
+
+
+def parse_record(data):
+    """
+    Returns a (status, backup_name, extra) tuple from a record read from the journal
+
+    """
+    fields = data.decode("utf-8").strip().split(",", 2)
+    while len(fields) < 3:
+        fields.append("")
+    return tuple(fields)
@@ -0,0 +1,136 @@
+import os, random, re, subprocess, time, zlib
+from file_index import walk_tree
+
+#Suffixes of files that are already compressed, given to rsync with --skip-compress and left out of the samples
+SKIP_COMPRESS = ("3g2/3gp/7z/aac/ace/apk/avi/bz2/deb/dmg/ear/f4v/flac/flv/gpg/gz/iso/jar/jpeg/jpg/lrz/lz/lz4/lzma/lzo/"
+                 "m1a/m1v/m2a/m2ts/m2v/m4a/m4b/m4p/m4r/m4v/mka/mkv/mov/mp1/mp2/mp3/mp4/mpa/mpeg/mpg/mpv/mts/odb/odf/odg/"
+                 "odi/odm/odp/ods/odt/oga/ogg/ogm/ogv/ogx/opus/otg/oth/otp/ots/ott/oxt/png/qt/rar/rpm/rz/rzip/spx/squashfs/"
+                 "sxc/sxd/sxg/sxm/sxw/sz/tbz/tbz2/tgz/tlz/ts/txz/tzo/vob/war/webm/webp/whl/xz/z/zip/zst")
+SKIP_COMPRESS_SUFFIXES = frozenset(SKIP_COMPRESS.split("/"))
+COMPRESS_THRESHOLD = 0.8 #Compress if the data is expected to shrink to less than this
+STRONG_THRESHOLD = 0.5 #Below this zstd is used instead of lz4, since the extra CPU time pays off
+FAST_LINK_RATE = 200 * 1024 * 1024 #Bytes per second. On links this fast only very compressible data is compressed
+RESAMPLE_AFTER = 7 * 86400 #Seconds before the compressibility of a volume is sampled again
+VERSION_PATTERN = re.compile(r"version\s+(\d+)\.(\d+)\.(\d+)")
+
+def is_skipped(path):
+    return os.path.splitext(path)[1][1:].lower() in SKIP_COMPRESS_SUFFIXES
+
+def sample_compressibility(root_path, max_files=200, chunk_size=64 * 1024, time_limit=5.0):
+    """
+    Estimates how well the files in a directory tree compress. The tree is walked for at most
+    time_limit seconds, a random sample of max_files regular files is taken from what was seen,
+    and a chunk from the middle of each is compressed with zlib level 1.
+    Files with a suffix in SKIP_COMPRESS count as not compressing at all.
+    Returns a dictionary with the estimated 'ratio' (compressed size over original size),
+    the number of files and bytes sampled, and the share of the bytes seen that was skipped.
+
+    Parameters
+    ----------
+    root_path :     The directory to sample, like the mount path of a snapshot
+    max_files :     The most files to read from
+    chunk_size :    Bytes to read from each file
+    time_limit :    Seconds to spend walking the tree
+
+    """
+    deadline = time.monotonic() + time_limit
+    sample = []
+    seen = 0
+    total_bytes = 0
+    skipped_bytes = 0
+    for (path, kind, size, mtime, ctime, inode) in walk_tree(root_path):
+        if time.monotonic() > deadline:
+            break
+        if kind != "f" or size == 0:
+            continue
+        total_bytes += size
+        if is_skipped(path):
+            skipped_bytes += size
+            continue
+        #Reservoir sampling, so every file seen has the same chance to be in the sample
+        seen += 1
+        if len(sample) < max_files:
+            sample.append((path, size))
+        elif random.randrange(seen) < max_files:
+            sample[random.randrange(max_files)] = (path, size)
+
+    sampled_bytes = 0
+    compressed_bytes = 0
+    for (path, size) in sample:
+        try:
+            with open(os.path.join(root_path, path), "rb") as sampled_file:
+                sampled_file.seek(max(0, size // 2 - chunk_size // 2))
+                data = sampled_file.read(chunk_size)
+        except OSError:
+            continue
+        sampled_bytes += len(data)
+        compressed_bytes += len(zlib.compress(data, 1))
+
+    sample_ratio = compressed_bytes / sampled_bytes if sampled_bytes else 1.0
+    skipped_share = skipped_bytes / total_bytes if total_bytes else 0.0
+    return {"ratio": sample_ratio * (1 - skipped_share) + skipped_share, "sample_ratio": sample_ratio, "files": len(sample),
+            "sampled_bytes": sampled_bytes, "skipped_share": skipped_share}
+
+def parse_rsync_version(text):
+    """
+    Returns the version in the output of 'rsync --version' as a tuple, like (3, 1, 2), or None
+
+    """
+    version = VERSION_PATTERN.search(text or "")
+    return tuple(int(part) for part in version.groups()) if version else None
+
+def local_rsync_version():
+    try:
+        return parse_rsync_version(subprocess.run(['rsync', '--version'], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout)
+    except OSError:
+        return None
+
+def choose_compression(ratio, local_version, remote_version, last_rate=None):
+    """
+    Picks the wire compression for a volume. Returns a dictionary with 'algorithm'
+    ('none', 'zlib', 'lz4' or 'zstd') and 'level'.
+    Data that is expected to shrink to less than COMPRESS_THRESHOLD is compressed, or less
+    than STRONG_THRESHOLD if the last transfer ran faster than FAST_LINK_RATE.
+    lz4 and zstd need rsync 3.2 on both ends; older versions get zlib at level 1.
+
+    Parameters
+    ----------
+    ratio :             Expected compressed size over original size
+    local_version :     Version of rsync on the server, as a tuple
+    remote_version :    Version of rsync on the client, as a tuple
+    last_rate :         Transfer rate of the last run in bytes per second, or None
+
+    """
+    threshold = STRONG_THRESHOLD if last_rate and last_rate > FAST_LINK_RATE else COMPRESS_THRESHOLD
+    if ratio is None or ratio >= threshold:
+        return {"algorithm": "none", "level": None}
+    if local_version and remote_version and min(local_version, remote_version) >= (3, 2, 0):
+        if ratio < STRONG_THRESHOLD:
+            return {"algorithm": "zstd", "level": 3}
+        return {"algorithm": "lz4", "level": None}
+    return {"algorithm": "zlib", "level": 1}
+
+def compression_options(choice):
+    """
+    Returns the rsync options for a choice from choose_compression
+
+    """
+    if choice["algorithm"] == "none":
+        return []
+    if choice["algorithm"] == "zlib":
+        return ['-z', '--compress-level='+str(choice["level"]), '--skip-compress='+SKIP_COMPRESS]
+    options = ['-z', '--compress-choice='+choice["algorithm"], '--skip-compress='+SKIP_COMPRESS]
+    if choice["level"] is not None:
+        options.append('--compress-level='+str(choice["level"]))
+    return options
+
+def achieved_ratio(stats):
+    """
+    Returns the compression that rsync achieved on the wire, from its stats: the bytes received
+    over the literal data, or None if nothing was sent. The file list and protocol overhead are
+    included in the bytes received, so the ratio is a little pessimistic for small transfers.
+
+    """
+    if not stats.get("literal_bytes") or not stats.get("bytes_received"):
+        return None
+    return stats["bytes_received"] / (stats["literal_bytes"] + stats.get("file_list_size", 0))